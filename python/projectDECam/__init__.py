@@ -7,3 +7,5 @@ version = __version__
 """
 
 from . import projectlib_fromlist
+from . import projectlib_batch
+from . import projectlib_api
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+"""
+
+ Stage-level Python API to embed the projection of DECam exposures in
+ other pipelines. The stages of project_DECam_fromlist are separate
+ functions that take and return arrays and WCS headers, so they can be
+ chained in memory without the _proj.fits -> TIFF -> PNG -> PNG
+ round-trips of the file interface:
+
+   from projectDECam import projectlib_api as api
+
+   projection = api.project(imgfiles, pixscale=1.0)   # Projection(array, weight, header)
+   image8 = api.stretch(projection)                   # Image8(array, header)
+   catalog = api.read_catalogs(catfiles)              # structured array
+   overlay = api.overlay(image8, catalog)             # Image8 with the ellipses (RGB)
+   thumb = api.thumbnail(image8, outfile='expo_TN.png')
+
+ Nothing is written to disk unless a stage is given an outfile (the
+ PNGs carry the WCS of the header as text chunks). The options that
+ are not given take the defaults of projectDECamPNG (see defaults()).
+ The 8-bit images are in PNG orientation (north up, the first FITS row
+ at the bottom), like the PNGs.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import collections
+
+import numpy
+
+from projectDECam import projectlib_stretch
+from projectDECam import projectlib_catalogs
+from projectDECam import projectlib_ellipses
+from projectDECam import projectlib_pyramid
+from projectDECam import projectlib_pngmeta
+from projectDECam import projectlib_projfile
+
+# The results of the stages
+Projection = collections.namedtuple('Projection', ['array', 'weight', 'header'])
+Image8 = collections.namedtuple('Image8', ['array', 'header'])
+
+# The pixel-scale of the DECam CCDs, the catalog sizes are in these pixels
+INPUT_PIXEL_SCALE = 0.263
+
+_DEFAULTS = {}
+
+
+def defaults():
+
+    """ The per-exposure options of projectDECamPNG and their defaults """
+
+    if not _DEFAULTS:
+        import argparse
+        from projectDECam import projectlib_fromlist
+        parser = argparse.ArgumentParser()
+        projectlib_fromlist.add_options(parser)
+        _DEFAULTS.update(vars(parser.parse_args([])))
+    return dict(_DEFAULTS)
+
+
+def option(name, value):
+    """ The value of an option, or its projectDECamPNG default if None """
+    return defaults()[name] if value is None else value
+
+
+def write_png(outfile, array8, header=None, png_level=None, png_filter=None, nthreads=None):
+
+    """ Write an 8-bit image as a PNG with the WCS of header (if given) """
+
+    text = projectlib_pngmeta.wcs_text(header) if header is not None else None
+    projectlib_stretch.write_png(outfile, array8,
+                                 compress_level=option('png_level', png_level),
+                                 png_filter=option('png_filter', png_filter),
+                                 nthreads=nthreads or option('NTHREADS_png', None) or None,
+                                 text=text)
+    return
+
+
+def project(imgfiles, pixscale=None, weight_thresh=None, noBack=None, engine='numpy',
+            footprint_cache=None, nocache=None, outfile=None, scratchdir=None, **kwargs):
+
+    """
+    Project the CCDs of an exposure. Returns a Projection with the
+    image, its weight (None for SWarp) and header
+    ----------
+    imgfiles: list
+        The multi-extension CCD files, with SCI in [0] and WGT in [2]
+    pixscale: float
+        The output pixel-scale in arcsec/pixel
+    weight_thresh: float, optional
+        SWarp's WEIGHT_THRESH, at the input pixel-scale
+    engine: str
+        'numpy' (in-process) or 'swarp'. SWarp needs to write the image
+        to disk, to outfile or to a temporary file in scratchdir
+    outfile: str, optional
+        Write the projected image to this FITS file
+    kwargs:
+        Other projectDECamPNG options: the storage of outfile (compress,
+        qlevel, qmethod, proj_weight) and for the SWarp engine (i.e.
+        NTHREADS_swarp, timeout_swarp)
+    """
+
+    pixscale = option('pixscale', pixscale)
+    noBack = option('noBack', noBack)
+    imgfiles = sorted(imgfiles)
+    if outfile:
+        projectlib_projfile.check_compression(option('compress', kwargs.get('compress')),
+                                              option('qlevel', kwargs.get('qlevel')))
+
+    if engine == 'swarp':
+        return swarp(imgfiles, pixscale=pixscale, weight_thresh=weight_thresh, noBack=noBack,
+                     footprint_cache=footprint_cache, nocache=nocache, outfile=outfile,
+                     scratchdir=scratchdir, **kwargs)
+    if engine != 'numpy':
+        raise ValueError(f"Unknown projection engine: {engine}")
+
+    from projectDECam import projectlib_numpy
+    from projectDECam import projectlib_footprint
+    if weight_thresh:
+        weight_thresh = float(weight_thresh)*(INPUT_PIXEL_SCALE/pixscale)**2
+    footprints = projectlib_footprint.get_footprints(imgfiles, cachefile=footprint_cache,
+                                                     use_cache=not option('nocache', nocache))
+    array, weight, header = projectlib_numpy.project_exposure(imgfiles,
+                                                              footprints=footprints,
+                                                              pixscale=pixscale,
+                                                              weight_thresh=weight_thresh,
+                                                              noBack=noBack,
+                                                              input_pixscale=INPUT_PIXEL_SCALE)
+    if outfile:
+        projectlib_projfile.write_image(outfile, array, header,
+                                        weight=weight if option('proj_weight', kwargs.get('proj_weight')) else None,
+                                        compress=option('compress', kwargs.get('compress')),
+                                        qlevel=option('qlevel', kwargs.get('qlevel')),
+                                        qmethod=option('qmethod', kwargs.get('qmethod')))
+    return Projection(array, weight, header)
+
+
+def swarp(imgfiles, outfile=None, scratchdir=None, **kwargs):
+
+    """
+    Project with SWarp through project_DECam_fromlist, and read the
+    image back. Without an outfile, SWarp writes into a temporary
+    directory that is removed afterwards
+    """
+
+    from projectDECam import projectlib_fromlist
+    tmpdir = None
+    if outfile:
+        if not outfile.endswith('_proj.fits'):
+            raise ValueError(f"The SWarp outfile must end in _proj.fits: {outfile}")
+        basename = outfile[:-len('_proj.fits')]
+    else:
+        tmpdir = tempfile.mkdtemp(prefix='projectDECam_', dir=scratchdir)
+        basename = os.path.join(tmpdir, 'expo')
+    opts = defaults()
+    opts.update({key: value for key, value in kwargs.items() if value is not None})
+    opts.update(imglist=imgfiles, cataloglist=None, basename=basename, engine='swarp',
+                scratchdir=scratchdir or tmpdir, defer=True)
+    try:
+        exposure = projectlib_fromlist.project_DECam_fromlist(**opts)
+        exposure.swarp_exposure(noSWarp=False, noBack=opts['noBack'], keep=opts['keepfiles'])
+        array, header = projectlib_projfile.read_image(exposure.swarp_outname, header=True)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return Projection(array, None, header)
+
+
+def stretch(image, header=None, grayscale=None, outfile=None, png_level=None, png_filter=None,
+            nthreads=None):
+
+    """
+    Stretch a projected image into an 8-bit image with the stiff-like
+    levels of projectDECamPNG. Returns an Image8
+    ----------
+    image: Projection, 2D array or str
+        The projected image, or a FITS file (plain or tile-compressed)
+        that is read in strips
+    header: header, optional
+        The WCS header of an array [default=the header of the Projection/file]
+    grayscale: float
+        The quantile of the max level
+    outfile: str, optional
+        Write the PNG (with the WCS) to this file
+    """
+
+    grayscale = option('grayscale', grayscale)
+    t0 = time.time()
+    if isinstance(image, str):
+        array8 = projectlib_stretch.stretch_file(image, ext=projectlib_projfile.image_ext(image),
+                                                 max_level=grayscale)
+        if header is None:
+            header = projectlib_projfile.read_header(image)
+    else:
+        if isinstance(image, Projection):
+            header = image.header if header is None else header
+            image = image.array
+        array8 = projectlib_stretch.stretch_image(image, max_level=grayscale)
+    print(f"# NumPy stretch time: {time.time()-t0:.2f}s")
+    if outfile:
+        write_png(outfile, array8, header, png_level=png_level, png_filter=png_filter, nthreads=nthreads)
+    return Image8(array8, header)
+
+
+def read_catalogs(catfiles, nthreads=None, cachefile=None, force=False):
+
+    """ Read the SEx catalogs of an exposure into a single structured array """
+
+    return projectlib_catalogs.read_catalogs(sorted(catfiles),
+                                             nthreads=option('NTHREADS_cat', nthreads),
+                                             cachefile=cachefile, force=force)
+
+
+def catalog_shapes(catalog, header):
+
+    """
+    The positions (FITS pixels of the image of header), Kron ellipses
+    (in input pixels), angles and flags of the objects of a catalog.
+    Returns (x, y, a, b, theta, flags)
+    """
+
+    from despyastro import wcsutil
+    wcs = wcsutil.WCS(header)
+    x, y = wcs.sky2image(catalog['ALPHA_J2000'], catalog['DELTA_J2000'])
+    a = catalog['A_IMAGE']*catalog['KRON_RADIUS']
+    b = catalog['B_IMAGE']*catalog['KRON_RADIUS']
+    return x, y, a, b, catalog['THETA_IMAGE'], catalog['IMAFLAGS_ISO']
+
+
+def render(gray, shapes, mode=None, pixscale=None, min_ell_size=None, max_density=None,
+           density_bin=None, nthreads=None):
+
+    """
+    Draw the ellipses of catalog_shapes over an 8-bit image with the
+    raster renderers: every ellipse (mode='full') or level-of-detail
+    (mode='lod', with the sizes scaled to the output pixels). Returns
+    the RGB array
+    """
+
+    mode = option('overlay', mode)
+    nthreads = option('NTHREADS_ell', nthreads)
+    x, y, a, b, theta, flags = shapes
+    if mode == 'lod':
+        scale = INPUT_PIXEL_SCALE/option('pixscale', pixscale)
+        return projectlib_ellipses.render_overlay_lod(gray, x, y, a*scale, b*scale, theta, flags,
+                                                      min_size=option('min_ell_size', min_ell_size),
+                                                      max_density=option('max_density', max_density),
+                                                      density_bin=option('density_bin', density_bin),
+                                                      nthreads=nthreads)
+    return projectlib_ellipses.render_overlay(gray, x, y, a, b, theta, flags, nthreads=nthreads)
+
+
+def overlay(image8, catalog, header=None, mode=None, pixscale=None, outfile=None, **kwargs):
+
+    """
+    Draw the objects of a catalog over an 8-bit image, flagged objects
+    in blue and the rest in red. Returns an Image8 with the RGB array
+    ----------
+    image8: Image8 or 2D uint8 array
+        The stretched image
+    catalog: structured array
+        The catalog from read_catalogs
+    header: header, optional
+        The WCS header of the image [default=image8.header]
+    mode: str
+        'full' or 'lod' (see render)
+    outfile: str, optional
+        Write the PNG (with the WCS) to this file
+    kwargs:
+        The LOD options of render and the PNG options of write_png
+    """
+
+    if isinstance(image8, Image8):
+        header = image8.header if header is None else header
+        image8 = image8.array
+    if header is None:
+        raise ValueError("Need the WCS header of the image to place the objects")
+    png_kwargs = {key: kwargs.pop(key) for key in ('png_level', 'png_filter') if key in kwargs}
+    t0 = time.time()
+    rgb = render(image8, catalog_shapes(catalog, header), mode=mode, pixscale=pixscale, **kwargs)
+    print(f"# Ellipses draw time: {time.time()-t0:.2f}s")
+    if outfile:
+        write_png(outfile, rgb, header, **png_kwargs)
+    return Image8(rgb, header)
+
+
+def thumbnail(image8, TNsize=None, outfile=None):
+
+    """
+    The thumbnail of an 8-bit (gray or RGB) image, as an array.
+    Written to outfile if given
+    """
+
+    array = image8.array if isinstance(image8, Image8) else image8
+    thumb = projectlib_pyramid.thumbnail(numpy.asarray(array), option('TNsize', TNsize))
+    if outfile:
+        projectlib_stretch.write_png(outfile, thumb)
+    return thumb
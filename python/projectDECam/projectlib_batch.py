@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""
+
+ Batch mode for projectDECamPNG: project many exposures in a single
+ invocation using a bounded pool of worker processes.
+
+ The input is a manifest file with one exposure per line:
+
+   imglist  catlist  basename
+
+ where catlist can be '-' or 'None' when there are no catalogs. Lines
+ starting with '#' are ignored.
+
+ Each job gets its own scratch directory (under --scratchdir or the
+ system temporary location) so SWarp's coadd.weight.fits and resampled
+ files from different exposures never collide, and the available
+ cores are split between the number of concurrent exposures and the
+ NTHREADS_swarp/NTHREADS_stiff/NTHREADS_png of each of them.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import traceback
+import asyncio
+import contextlib
+import multiprocessing
+
+from projectDECam import projectlib_fromlist as proj
+from projectDECam import projectlib_runner
+
+
+def read_manifest(manifest):
+
+    """
+    Read the batch manifest and return a list of
+    (imglist, catlist, basename) tuples
+    """
+
+    rows = []
+    with open(manifest) as fobj:
+        for nline, line in enumerate(fobj, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            vals = line.split()
+            if len(vals) == 2:
+                imglist, basename = vals
+                catlist = None
+            elif len(vals) == 3:
+                imglist, catlist, basename = vals
+            else:
+                sys.exit(f"# ERROR: cannot parse line {nline} of {manifest}: {line}")
+            if catlist in ('-', 'None', 'none'):
+                catlist = None
+            rows.append((imglist, catlist, basename))
+    return rows
+
+
+def split_cores(njobs, nproc=0, ncores=0):
+
+    """
+    Split the cores between the number of concurrent exposures (nproc)
+    and the threads given to each exposure. Returns (nproc, nthreads)
+    ----------
+    njobs: int
+        Number of exposures in the batch
+    nproc: int, optional
+        Number of concurrent exposures [0=auto]
+    ncores: int, optional
+        Total number of cores to use [0=all]
+    """
+
+    if ncores <= 0:
+        ncores = multiprocessing.cpu_count()
+    if nproc <= 0:
+        # SWarp and stiff do not scale much beyond a handful of threads,
+        # so rather run more exposures at once
+        nproc = max(1, ncores//4)
+    nproc = max(1, min(nproc, njobs, ncores))
+    nthreads = max(1, ncores//nproc)
+    return nproc, nthreads
+
+
+@contextlib.contextmanager
+def redirect_output(logfile):
+
+    """
+    Redirect stdout/stderr at the file-descriptor level, so the output
+    of SWarp and stiff ends up in the same log as the python prints
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    with open(logfile, 'a') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+
+def run_job(job, runner=None):
+
+    """
+    Run a single exposure of the batch inside the worker process, or
+    inside a thread of the pipeline when given its runner. Returns a
+    (basename, status, time, stages) tuple with status 0 for success
+    and stages the {stage: wall time} of the stages that ran
+    """
+
+    kwargs = dict(job['kwargs'])
+    basename = kwargs['basename']
+    t0 = time.time()
+    status = 0
+    exposure = None
+
+    outpath = os.path.split(basename)[0]
+    if outpath and not os.path.exists(outpath):
+        os.makedirs(outpath, exist_ok=True)
+
+    scratch_root = job['scratchdir']
+    if scratch_root and not os.path.exists(scratch_root):
+        os.makedirs(scratch_root, exist_ok=True)
+    kwargs['scratchdir'] = tempfile.mkdtemp(prefix=f"{os.path.basename(basename)}_",
+                                            dir=scratch_root)
+    if runner is not None:
+        # The threads of the pipeline share stdout, the tools' logs are prefixed
+        kwargs['runner'] = runner
+        output = contextlib.nullcontext()
+    else:
+        output = redirect_output(f"{basename}.log")
+    try:
+        with output:
+            try:
+                exposure = proj.project_DECam_fromlist(defer=True, **kwargs)
+                exposure.run()
+            # The library exits on errors, keep the pool alive
+            except SystemExit as err:
+                status = err.code if isinstance(err.code, int) and err.code else 1
+                print(f"# ERROR: {basename} exited with: {err.code}")
+            except Exception:
+                status = 1
+                traceback.print_exc()
+            print(f"# Total time: {proj.elapsed_time(t0)}")
+    finally:
+        shutil.rmtree(kwargs['scratchdir'], ignore_errors=True)
+    stages = {}
+    if exposure is not None:
+        stages = {record['stage']: record['wall'] for record in exposure.telemetry.records}
+    return basename, status, time.time() - t0, stages
+
+
+def build_jobs(rows, scratchdir=None, **kwargs):
+
+    """ Build the list of jobs (dictionaries) for the pool """
+
+    jobs = []
+    for imglist, catlist, basename in rows:
+        job_kwargs = dict(kwargs)
+        job_kwargs['imglist'] = imglist
+        job_kwargs['cataloglist'] = catlist
+        job_kwargs['basename'] = basename
+        # Without catalogs we cannot draw ellipses
+        if catlist is None:
+            job_kwargs['noEll'] = True
+        jobs.append({'kwargs': job_kwargs, 'scratchdir': scratchdir})
+    return jobs
+
+
+def run_batch(rows, nproc=0, ncores=0, scratchdir=None, **kwargs):
+
+    """
+    Project a list of (imglist, catlist, basename) exposures on a
+    bounded process pool. The extra kwargs are the per-exposure options
+    of project_DECam_fromlist. Returns the list of failed basenames
+    """
+
+    t0 = time.time()
+    nproc, nthreads = split_cores(len(rows), nproc=nproc, ncores=ncores)
+    # Only fill in the threads for the tools set to auto
+    if not kwargs.get('NTHREADS_swarp'):
+        kwargs['NTHREADS_swarp'] = nthreads
+    if not kwargs.get('NTHREADS_stiff'):
+        kwargs['NTHREADS_stiff'] = nthreads
+    if not kwargs.get('NTHREADS_png'):
+        kwargs['NTHREADS_png'] = nthreads
+
+    print(f"# Will project {len(rows)} exposures using {nproc} processes")
+    print(f"# NTHREADS_swarp: {kwargs['NTHREADS_swarp']} NTHREADS_stiff: {kwargs['NTHREADS_stiff']}")
+
+    jobs = build_jobs(rows, scratchdir=scratchdir, **kwargs)
+    failed = []
+    # maxtasksperchild keeps the memory from piling up on long nights
+    with multiprocessing.Pool(processes=nproc, maxtasksperchild=16) as pool:
+        for k, (basename, status, jtime, _) in enumerate(pool.imap_unordered(run_job, jobs), start=1):
+            if status == 0:
+                print(f"# [{k}/{len(jobs)}] Done: {basename} in {jtime:.2f}s")
+            else:
+                print(f"# [{k}/{len(jobs)}] FAILED: {basename} (status={status}) -- see {basename}.log")
+                failed.append(basename)
+            sys.stdout.flush()
+
+    print(f"# Batch of {len(jobs)} exposures done in: {proj.elapsed_time(t0)}")
+    if failed:
+        print(f"# WARNING: {len(failed)} exposures failed")
+    return failed
+
+
+def run_pipeline(rows, nexp=2, limits=None, scratchdir=None, **kwargs):
+
+    """
+    Project a list of (imglist, catlist, basename) exposures in a
+    single process, overlapping the SWarp (and stiff) calls of some
+    exposures with the Python stages of others. nexp exposures are in
+    flight at once and the limits (per tool, see projectlib_runner)
+    bound how many SWarp/stiff/Python stages run at the same time.
+    Returns the list of failed basenames
+    """
+
+    t0 = time.time()
+    runner = projectlib_runner.Runner(limits=limits)
+    jobs = build_jobs(rows, scratchdir=scratchdir, **kwargs)
+    print(f"# Will project {len(rows)} exposures, {nexp} in flight, limits: {runner.limits}")
+
+    def make_job(job):
+        return lambda: run_job(job, runner=runner)
+
+    results = asyncio.run(runner.run_threads([make_job(job) for job in jobs], nthreads=nexp))
+    failed = []
+    for job, result in zip(jobs, results):
+        basename = job['kwargs']['basename']
+        if isinstance(result, BaseException) or result[1] != 0:
+            print(f"# FAILED: {basename}")
+            failed.append(basename)
+        else:
+            print(f"# Done: {basename} in {result[2]:.2f}s")
+
+    print(f"# Pipeline of {len(jobs)} exposures done in: {proj.elapsed_time(t0)}")
+    if failed:
+        print(f"# WARNING: {len(failed)} exposures failed")
+    return failed
+
+
+def cmdline():
+
+    """ Parse the command line arguments and options using argparse"""
+
+    import argparse
+
+    USAGE = "\n"
+    USAGE = USAGE + "  %(prog)s <manifest> [options] \n"
+    USAGE = USAGE + "  i.e.: \n"
+    USAGE = USAGE + "  %(prog)s file-with-imglist-catlist-basename --nproc 8\n"
+
+    epilog = "Author: Felipe Menanteau, NCSA/University of Illinois (felipe@illinois.edu)"
+    description = "Projects a batch of DECam exposures listed in a manifest file " \
+                  "(imglist catlist basename) using a pool of processes"
+    parser = argparse.ArgumentParser(usage=USAGE,
+                                     epilog=epilog,
+                                     description=description,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("manifest", default=None,
+                        help="Manifest with imglist, catlist and basename per line")
+    parser.add_argument("--nproc", type=int, default=0,
+                        help="Number of exposures to process concurrently [0=auto]")
+    parser.add_argument("--ncores", type=int, default=0,
+                        help="Total number of cores to split between exposures [0=all]")
+    parser.add_argument("--pipeline", action="store_true", default=False,
+                        help="Run in one process, overlapping the SWarp of an exposure "
+                        "with the Python stages of another")
+    parser.add_argument("--nexp", type=int, default=2,
+                        help="Pipeline: number of exposures in flight")
+    parser.add_argument("--max_swarp", type=int, default=1,
+                        help="Pipeline: max concurrent SWarp calls")
+    parser.add_argument("--max_stiff", type=int, default=1,
+                        help="Pipeline: max concurrent stiff calls")
+    parser.add_argument("--max_python", type=int, default=1,
+                        help="Pipeline: max concurrent Python stages")
+    proj.add_options(parser)
+
+    args = parser.parse_args()
+    try:
+        args = proj.check_options(args)
+    except ValueError as err:
+        parser.error(str(err))
+
+    print("# Will run:")
+    print(f"# {parser.prog}")
+    for key, val in sorted(vars(args).items()):
+        print("# \t--%-10s\t%s" % (key, val))
+    return args
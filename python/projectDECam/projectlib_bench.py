@@ -0,0 +1,672 @@
+#!/usr/bin/env python
+
+"""
+
+ Reproducible benchmarks for project_DECam_fromlist and color_tile
+ (technicolor) on synthetic data, so we can track the performance of
+ each stage between releases.
+
+ The harness:
+   1. writes synthetic 62-CCD exposures/catalogs and coadd tiles with
+      projectlib_synthetic (cached in the work directory)
+   2. puts the stand-in swarp/stiff executables first in the PATH
+      (unless --real_tools)
+   3. runs every combination of pixscale, number of objects and
+      threads (and the TECHNICOLOR_CASES of stretch and RGB scaling),
+      each in a fresh process, collecting the per-stage records of
+      projectlib_telemetry
+   4. writes a JSON report with the environment and the results, and
+      optionally compares it with the report of a previous release
+
+ The 'storage' bench writes the image of a synthetic tile with every
+ STORAGE_CASES setting of --compress/--qlevel and reports the size
+ ratio, the write/read throughput, the time of region and strip reads
+ and the quantization error.
+
+ The 'import' bench times the start-up of projectDECamPNG with
+ python -X importtime (importing projectlib_fromlist, parsing the
+ command line) and fails if it imports any of the LAZY_MODULES, that
+ should only be loaded by the stages that use them:
+
+   python -m projectDECam.projectlib_bench --bench import --compare old.json
+
+   python -m projectDECam.projectlib_bench --workdir /scratch/bench --out bench.json
+   python -m projectDECam.projectlib_bench --workdir /scratch/bench --compare old.json
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import itertools
+import subprocess
+import multiprocessing
+
+import numpy
+
+from projectDECam import projectlib_synthetic
+from projectDECam import projectlib_telemetry
+
+# Bump if the report layout changes
+REPORT_VERSION = 1
+# A stage is flagged when it is this much slower than in the reference
+REGRESSION_FACTOR = 1.2
+
+# The modules that projectlib_fromlist must only import in the stages
+# that use them, never at start-up
+LAZY_MODULES = ['matplotlib', 'pylab', 'PIL', 'despyastro', 'drawDECam']
+
+# The start-up paths we time with -X importtime: (stage, code, lazy)
+# where lazy means that none of the LAZY_MODULES may be imported
+IMPORT_CASES = [('import', "import projectDECam.projectlib_fromlist", True),
+                ('cmdline', "import sys; sys.argv = ['projectDECamPNG', 'img.list', 'expo', '--dryrun']; "
+                 "from projectDECam import projectlib_fromlist; projectlib_fromlist.cmdline()", True),
+                ('batch', "import projectDECam.projectlib_batch", True),
+                ('service', "import projectDECam.projectlib_service", True)]
+
+# The color_tile settings of the 'technicolor' bench: (stretch, rgb_mode)
+TECHNICOLOR_CASES = [('stiff', 'stiff'), ('numpy', 'stiff'), ('numpy', 'lupton')]
+
+# The _proj.fits storage settings of the 'storage' bench: (compress, qlevel)
+STORAGE_CASES = [('none', 0), ('gzip_2', 0), ('rice', 4), ('rice', 16), ('gzip_2', 16), ('hcompress', 4)]
+
+
+def environment():
+
+    """ The environment of the benchmark, to know what we compare """
+
+    import fitsio
+    env = {'host': socket.gethostname(),
+           'platform': platform.platform(),
+           'python': platform.python_version(),
+           'numpy': numpy.__version__,
+           'fitsio': fitsio.__version__,
+           'ncpu': multiprocessing.cpu_count(),
+           'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    try:
+        env['git'] = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                             cwd=os.path.dirname(__file__),
+                                             stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        env['git'] = None
+    return env
+
+
+def setup_tools(workdir, real_tools=False):
+
+    """
+    Prepare the environment inherited by the benchmark processes: the
+    stand-in executables first in the PATH, projectDECam in the
+    PYTHONPATH and a PROJECTDECAM_DIR with the config files
+    """
+
+    pkgroot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    pythonpath = os.environ.get('PYTHONPATH')
+    os.environ['PYTHONPATH'] = f"{pkgroot}:{pythonpath}" if pythonpath else pkgroot
+    if not real_tools:
+        bindir = projectlib_synthetic.write_stubs(os.path.join(workdir, 'bin'))
+        os.environ['PATH'] = f"{bindir}:{os.environ['PATH']}"
+    if 'PROJECTDECAM_DIR' not in os.environ:
+        # The stand-ins ignore the configuration files, but we need to pass them
+        etcdir = os.path.join(workdir, 'etc')
+        os.makedirs(etcdir, exist_ok=True)
+        for name in ('default.swarp', 'default.stiff'):
+            open(os.path.join(etcdir, name), 'a').close()
+        os.environ['PROJECTDECAM_DIR'] = workdir
+    return
+
+
+def get_exposure(workdir, nobjects, shrink=8, cross_ra0=False):
+
+    """ Write (once) a synthetic exposure and return its image/catalog lists """
+
+    name = f"expo_n{nobjects}_s{shrink}" + ("_ra0" if cross_ra0 else "")
+    expdir = os.path.join(workdir, 'data', name)
+    imglist = os.path.join(expdir, 'img.list')
+    catlist = os.path.join(expdir, 'cat.list')
+    if not (os.path.exists(imglist) and os.path.exists(catlist)):
+        imgfiles, catfiles = projectlib_synthetic.make_exposure(expdir, nobjects=nobjects,
+                                                                shrink=shrink,
+                                                                cross_ra0=cross_ra0)
+        projectlib_synthetic.write_list(catlist, catfiles)
+        projectlib_synthetic.write_list(imglist, imgfiles)
+    return imglist, catlist
+
+
+def get_tile(workdir, nobjects, size=2500, fpack=False):
+
+    """
+    Write (once) a synthetic coadd tile and return its files per band,
+    fpacked (.fits.fz) as in the archive if fpack is True
+    """
+
+    name = f"tile_n{nobjects}_s{size}" + ("_fz" if fpack else "")
+    tiledir = os.path.join(workdir, 'data', name)
+    done = os.path.join(tiledir, 'bands.json')
+    if os.path.exists(done):
+        with open(done) as fobj:
+            return json.load(fobj)
+    files = projectlib_synthetic.make_tile(tiledir, nobjects=nobjects, size=size, fpack=fpack)
+    with open(done, 'w') as fobj:
+        json.dump(files, fobj)
+    return files
+
+
+def fromlist_kwargs(**kwargs):
+
+    """ The default options of project_DECam_fromlist, updated with kwargs """
+
+    from projectDECam import projectlib_fromlist
+    parser = argparse.ArgumentParser()
+    projectlib_fromlist.add_options(parser)
+    options = vars(parser.parse_args([]))
+    options.update(kwargs)
+    return vars(projectlib_fromlist.check_options(argparse.Namespace(**options)))
+
+
+def _run_fromlist(kwargs, logfile):
+
+    """ Run project_DECam_fromlist (in a fresh process) with its output to logfile """
+
+    with open(logfile, 'w') as log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        from projectDECam import projectlib_fromlist
+        projectlib_fromlist.project_DECam_fromlist(**kwargs)
+
+
+def _run_technicolor(config, files, outdir, telemetry_file, logfile):
+
+    """
+    Run the stages of technicolor (in a fresh process) on a synthetic
+    fpacked tile, resolved through a tile index synced from a stand-in
+    database with projectlib_tileindex
+    """
+
+    from projectDECam import projectlib_tileindex
+
+    import importlib.machinery
+    import importlib.util
+
+    with open(logfile, 'w') as log:
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        script = os.path.join(os.environ['PROJECTDECAM_DIR'], 'bin', 'color_tile')
+        if not os.path.exists(script):
+            script = os.path.join(os.path.dirname(__file__), '..', '..', 'bin', 'color_tile')
+        loader = importlib.machinery.SourceFileLoader('color_tile', script)
+        spec = importlib.util.spec_from_loader('color_tile', loader)
+        color_tile = importlib.util.module_from_spec(spec)
+        # Registered, and forked pools as when run as a script, so the
+        # pools can pickle its functions
+        sys.modules['color_tile'] = color_tile
+        multiprocessing.set_start_method('fork', force=True)
+        loader.exec_module(color_tile)
+
+        tilename = 'DES0000-3000'
+        archive_root = os.path.dirname(next(iter(files.values())))
+        standin_db = projectlib_tileindex.make_standin_db(
+            os.path.join(outdir, 'desar.sqlite'),
+            {tilename: {band: os.path.basename(f) for band, f in files.items()}},
+            tag='SYNTHETIC', archive_root=archive_root)
+        telemetry = projectlib_telemetry.Telemetry(jsonfile=telemetry_file, job=tilename,
+                                                   prefix='color_tile')
+        with telemetry.stage('setup'):
+            p = color_tile.technicolor(coadd_version='SYNTHETIC',
+                                       tilename=tilename,
+                                       outdir=outdir,
+                                       MP=config['nthreads'] > 1,
+                                       telemetry=telemetry,
+                                       tileindex=os.path.join(outdir, 'tiles.sqlite'),
+                                       refresh=True,
+                                       standin_db=standin_db,
+                                       force=True,
+                                       stretch=config['stretch'],
+                                       scratchdir=outdir,
+                                       rgb_mode=config['rgb_mode'],
+                                       defer=True)
+
+        if config['stretch'] == 'numpy':
+            with telemetry.stage('compose', nbands=len(p.filters)):
+                p.compose_tile()
+        else:
+            with telemetry.stage('funpack', nbands=len(p.filters)):
+                p.funpack_tile()
+            with telemetry.stage('stiff', nbands=len(p.filters)):
+                p.stiff_tile()
+            with telemetry.stage('png'):
+                p.tif2png_tile()
+        with telemetry.stage('TN'):
+            p.make_png_thumbnails()
+        with telemetry.stage('clean'):
+            p.clean_fits()
+            p.clean_tiff()
+
+
+def run_process(target, args):
+
+    """
+    Run a benchmark in a fresh (spawned) process, so the peak RSS and
+    the child CPU are those of the run. Returns the exit code
+    """
+
+    ctx = multiprocessing.get_context('spawn')
+    proc = ctx.Process(target=target, args=args)
+    proc.start()
+    proc.join()
+    return proc.exitcode
+
+
+def read_records(telemetry_file):
+
+    """ Read the telemetry records of a run """
+
+    if not os.path.exists(telemetry_file):
+        return []
+    with open(telemetry_file) as fobj:
+        return [json.loads(line) for line in fobj if line.strip()]
+
+
+def run_rows(bench, config, repeat, status, telemetry_file, logfile, failed):
+
+    """
+    The rows of the report of a run. A run that failed (non-zero exit
+    code) has no rows, its partial records are not valid timings, and
+    it is added to the failed list
+    """
+
+    if status != 0:
+        print(f"# ERROR: {bench} run failed with exit code {status}, see {logfile}")
+        failed.append({'bench': bench, 'config': config, 'repeat': repeat, 'exitcode': status,
+                       'log': logfile})
+        return []
+    return [result_row(bench, config, repeat, status, record) for record in read_records(telemetry_file)]
+
+
+def bench_fromlist(workdir, pixscales, nobjects_list, nthreads_list, repeat=1,
+                   shrink=8, cross_ra0=False, engine='swarp', stretch='stiff', quicklook=0):
+
+    """
+    Time the stages of project_DECam_fromlist over the grid of configs.
+    Returns the rows of the report and the list of failed runs
+    """
+
+    results = []
+    failed = []
+    grid = itertools.product(nobjects_list, pixscales, nthreads_list)
+    for nobjects, pixscale, nthreads in grid:
+        imglist, catlist = get_exposure(workdir, nobjects, shrink=shrink, cross_ra0=cross_ra0)
+        config = {'nobjects': nobjects, 'pixscale': pixscale, 'nthreads': nthreads,
+                  'shrink': shrink, 'cross_ra0': cross_ra0, 'engine': engine, 'stretch': stretch,
+                  'quicklook': quicklook}
+        for k in range(repeat):
+            tag = f"fromlist_n{nobjects}_p{pixscale}_t{nthreads}_{k}"
+            rundir = os.path.join(workdir, 'runs', tag)
+            os.makedirs(rundir, exist_ok=True)
+            telemetry_file = os.path.join(rundir, 'telemetry.jsonl')
+            if os.path.exists(telemetry_file):
+                os.remove(telemetry_file)
+            kwargs = fromlist_kwargs(imglist=imglist,
+                                     cataloglist=catlist,
+                                     basename=os.path.join(rundir, 'expo'),
+                                     scratchdir=rundir,
+                                     pixscale=pixscale,
+                                     force=True,
+                                     engine=engine,
+                                     stretch=stretch,
+                                     quicklook=quicklook,
+                                     NTHREADS_swarp=nthreads,
+                                     NTHREADS_stiff=nthreads,
+                                     NTHREADS_cat=nthreads,
+                                     footprint_cache=os.path.join(workdir, 'footprints.sqlite'),
+                                     telemetry_file=telemetry_file)
+            logfile = os.path.join(rundir, 'run.log')
+            t0 = time.time()
+            status = run_process(_run_fromlist, (kwargs, logfile))
+            print(f"# {tag}: status={status} in {time.time()-t0:.2f}s")
+            results += run_rows('fromlist', config, k, status, telemetry_file, logfile, failed)
+    return results, failed
+
+
+def bench_technicolor(workdir, nobjects_list, nthreads_list, repeat=1, size=2500,
+                      cases=TECHNICOLOR_CASES):
+
+    """
+    Time the stages of technicolor over the grid of configs and the
+    (stretch, rgb_mode) cases. Returns the rows of the report and the
+    list of failed runs
+    """
+
+    results = []
+    failed = []
+    for nobjects, nthreads, (stretch, rgb_mode) in itertools.product(nobjects_list, nthreads_list, cases):
+        files = get_tile(workdir, nobjects, size=size, fpack=True)
+        config = {'nobjects': nobjects, 'nthreads': nthreads, 'size': size, 'stretch': stretch,
+                  'rgb_mode': rgb_mode}
+        for k in range(repeat):
+            tag = f"technicolor_{stretch}_{rgb_mode}_n{nobjects}_t{nthreads}_{k}"
+            rundir = os.path.join(workdir, 'runs', tag)
+            os.makedirs(rundir, exist_ok=True)
+            telemetry_file = os.path.join(rundir, 'telemetry.jsonl')
+            if os.path.exists(telemetry_file):
+                os.remove(telemetry_file)
+            logfile = os.path.join(rundir, 'run.log')
+            t0 = time.time()
+            status = run_process(_run_technicolor, (config, files, rundir, telemetry_file, logfile))
+            print(f"# {tag}: status={status} in {time.time()-t0:.2f}s")
+            results += run_rows('technicolor', config, k, status, telemetry_file, logfile, failed)
+    return results, failed
+
+
+def bench_storage(workdir, nobjects, size=2500, repeat=1, cases=STORAGE_CASES, region=512, nregions=16):
+
+    """
+    Time the storage settings of _proj.fits on the r-band image of a
+    synthetic tile: the size, the write, full read, region reads (the
+    cutouts) and strip reads (the stretch) throughput, and the error of
+    the quantization in units of the noise
+    """
+
+    import fitsio
+    from projectDECam import projectlib_projfile
+    from projectDECam import projectlib_stretch
+
+    image, header = fitsio.read(get_tile(workdir, nobjects, size=size)['r'], header=True)
+    noise = 1.4826*numpy.median(numpy.abs(image - numpy.median(image)))
+    rng = numpy.random.default_rng(1)
+    corners = rng.integers(0, size - region, (nregions, 2))
+    outdir = os.path.join(workdir, 'storage')
+    os.makedirs(outdir, exist_ok=True)
+
+    results = []
+    for compress, qlevel in cases:
+        config = {'compress': compress, 'qlevel': qlevel, 'size': size}
+        filename = os.path.join(outdir, f"proj_{compress}_q{qlevel}.fits")
+        for k in range(repeat):
+            walls = {}
+            t0 = time.time()
+            projectlib_projfile.write_image(filename, image, header, compress=compress, qlevel=qlevel)
+            walls['write'] = time.time() - t0
+            t0 = time.time()
+            data = projectlib_projfile.read_image(filename)
+            walls['read'] = time.time() - t0
+            ext = projectlib_projfile.image_ext(filename)
+            t0 = time.time()
+            with fitsio.FITS(filename) as fits:
+                for y0, x0 in corners:
+                    fits[ext][y0:y0+region, x0:x0+region]
+            walls['region'] = time.time() - t0
+            t0 = time.time()
+            projectlib_stretch.stretch_file(filename, ext=ext)
+            walls['stretch'] = time.time() - t0
+
+            ratio = os.path.getsize(filename)/image.nbytes
+            max_err = float(numpy.abs(data - image).max()/noise)
+            print(f"# storage {compress} q{qlevel}: ratio {ratio:.3f}, "
+                  f"write {image.nbytes/walls['write']/1e6:.0f} MB/s, "
+                  f"read {image.nbytes/walls['read']/1e6:.0f} MB/s, "
+                  f"{nregions} regions in {walls['region']:.3f}s, stretch {walls['stretch']:.3f}s, "
+                  f"max error {max_err:.3f} sigma")
+            for stage, wall in walls.items():
+                results.append({'bench': 'storage', 'config': config, 'repeat': k, 'exitcode': 0,
+                                'stage': stage, 'status': 'ok', 'wall': wall, 'ratio': ratio,
+                                'max_err': max_err})
+    return results
+
+
+def parse_importtime(stderr):
+
+    """
+    Parse the -X importtime output. Returns a list of (module,
+    self_us, cumulative_us, toplevel) tuples
+    """
+
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us), int(cumulative_us),
+                     len(name) - len(name.lstrip()) <= 1))
+    return rows
+
+
+def import_time(code, python=sys.executable):
+
+    """
+    Time the imports of a piece of python code in a fresh interpreter
+    with -X importtime. Returns (import seconds, process seconds,
+    modules): the import time leaves out the modules that the bare
+    interpreter imports (site, encodings...)
+    """
+
+    baseline = subprocess.run([python, '-X', 'importtime', '-c', 'pass'],
+                              capture_output=True, text=True)
+    startup = {row[0] for row in parse_importtime(baseline.stderr)}
+    t0 = time.time()
+    proc = subprocess.run([python, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True, cwd=os.getcwd())
+    wall = time.time() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(f"Failed to run: {code}\n{proc.stderr[-2000:]}")
+    rows = parse_importtime(proc.stderr)
+    total = sum(row[2] for row in rows if row[3] and row[0] not in startup)/1e6
+    return total, wall, [row[0] for row in rows]
+
+
+def bench_imports(repeat=1):
+
+    """
+    Time the start-up of projectDECamPNG (-X importtime) and check that
+    it does not import the LAZY_MODULES. Returns the rows of the report
+    and the number of start-up runs that import them
+    """
+
+    results = []
+    nbad = 0
+    for stage, code, lazy in IMPORT_CASES:
+        for k in range(repeat):
+            seconds, wall, modules = import_time(code)
+            eager = sorted({name.split('.')[0] for name in modules} & set(LAZY_MODULES))
+            status = 'ok'
+            if lazy and eager:
+                status = f"eager: {','.join(eager)}"
+            print(f"# import {stage}: {seconds:.3f}s imports, {wall:.3f}s process, "
+                  f"{len(modules)} modules, {status}")
+            results.append({'bench': 'import', 'config': {}, 'repeat': k, 'exitcode': 0,
+                            'stage': stage, 'status': status, 'wall': seconds,
+                            'process_wall': wall, 'nmodules': len(modules)})
+            nbad += status != 'ok'
+    if nbad:
+        print(f"# ERROR: {nbad} start-up runs import one of: {', '.join(LAZY_MODULES)}")
+    return results, nbad
+
+
+def result_row(bench, config, repeat, status, record):
+
+    """ One row of the report from a telemetry record """
+
+    row = {'bench': bench,
+           'config': config,
+           'repeat': repeat,
+           'exitcode': status,
+           'stage': record['stage'],
+           'status': record.get('status')}
+    for key in ('wall', 'cpu_user', 'cpu_sys', 'child_user', 'child_sys', 'maxrss_kb',
+                'child_maxrss_kb', 'commands', 'cmd_maxrss_kb', 'read_bytes', 'write_bytes',
+                'nobjects', 'nccds'):
+        if key in record:
+            row[key] = record[key]
+    return row
+
+
+def config_key(row):
+    """ A hashable key of the bench, config and stage of a row """
+    return (row['bench'], json.dumps(row['config'], sort_keys=True), row['stage'])
+
+
+def summarize(results):
+
+    """
+    Reduce the repeats to the best (minimum) wall time per bench,
+    config and stage. Returns a dictionary keyed by config_key
+    """
+
+    summary = {}
+    for row in results:
+        # Failed runs (in older reports) are not valid timings
+        if row.get('exitcode', 0) != 0:
+            continue
+        key = config_key(row)
+        if key not in summary or row['wall'] < summary[key]['wall']:
+            summary[key] = row
+    return summary
+
+
+def print_report(results):
+
+    """ Print a table of the best times per config and stage """
+
+    summary = summarize(results)
+    print(f"# {'bench':12s} {'stage':8s} {'wall':>8s} {'cpu':>8s} {'child':>8s} {'RSS[MB]':>8s}  config")
+    for key in sorted(summary):
+        row = summary[key]
+        cpu = row.get('cpu_user', 0) + row.get('cpu_sys', 0)
+        child = row.get('child_user', 0) + row.get('child_sys', 0)
+        print(f"  {row['bench']:12s} {row['stage']:8s} {row['wall']:8.3f} {cpu:8.3f} {child:8.3f} "
+              f"{row.get('maxrss_kb', 0)/1024.:8.1f}  {key[1]}")
+    return
+
+
+def write_report(filename, results, env, failed=()):
+
+    """ Write the JSON report, with the list of failed runs """
+
+    with open(filename, 'w') as fobj:
+        json.dump({'version': REPORT_VERSION, 'environment': env, 'results': results,
+                   'failed': list(failed)}, fobj, indent=1, sort_keys=True)
+    print(f"# Wrote report: {filename}")
+    return
+
+
+def compare(reference, results, factor=REGRESSION_FACTOR, min_wall=0.05):
+
+    """
+    Compare the best wall times per stage with those of a reference
+    report. Returns the number of stages slower than factor times the
+    reference (ignoring stages faster than min_wall seconds)
+    """
+
+    with open(reference) as fobj:
+        ref = json.load(fobj)
+    if ref.get('version') != REPORT_VERSION:
+        print(f"# WARNING: reference report version {ref.get('version')} != {REPORT_VERSION}")
+    ref_summary = summarize(ref['results'])
+    summary = summarize(results)
+    print(f"# Comparing with {reference} ({ref['environment'].get('git')}, "
+          f"{ref['environment'].get('host')})")
+    nslow = 0
+    for key in sorted(summary):
+        if key not in ref_summary:
+            continue
+        old = ref_summary[key]['wall']
+        new = summary[key]['wall']
+        ratio = new/old if old > 0 else float('inf')
+        flag = ''
+        if ratio > factor and new > min_wall:
+            flag = 'SLOWER'
+            nslow += 1
+        elif ratio < 1.0/factor and old > min_wall:
+            flag = 'faster'
+        print(f"  {key[0]:12s} {key[2]:8s} {old:8.3f} -> {new:8.3f}  x{ratio:5.2f} {flag:6s}  {key[1]}")
+    print(f"# {nslow} stages slower than x{factor} the reference")
+    return nslow
+
+
+def cmdline():
+
+    """ Parse the command line arguments for the benchmark """
+
+    parser = argparse.ArgumentParser(description="Benchmark project_DECam_fromlist and technicolor "
+                                     "on synthetic DECam exposures and tiles",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--workdir", default='projectDECam_bench',
+                        help="Where to write the synthetic data and the runs")
+    parser.add_argument("--out", default=None,
+                        help="JSON report [default=WORKDIR/bench.json]")
+    parser.add_argument("--compare", default=None,
+                        help="Reference JSON report (i.e. from the previous release)")
+    parser.add_argument("--bench", nargs='+', default=['import', 'fromlist', 'technicolor', 'storage'],
+                        choices=['import', 'fromlist', 'technicolor', 'storage'],
+                        help="What to benchmark")
+    parser.add_argument("--pixscale", type=float, nargs='+', default=[1.0],
+                        help="Output pixel scales for fromlist")
+    parser.add_argument("--nobjects", type=int, nargs='+', default=[20000],
+                        help="Number of objects per exposure/tile")
+    parser.add_argument("--nthreads", type=int, nargs='+', default=[1, 4],
+                        help="Number of threads (NTHREADS_*, MP for technicolor)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Runs per config, the best is reported")
+    parser.add_argument("--shrink", type=int, default=8,
+                        help="Shrink factor of the synthetic CCDs (1=full 2048x4096)")
+    parser.add_argument("--tilesize", type=int, default=2500,
+                        help="Size of the synthetic coadd tiles [pixels]")
+    parser.add_argument("--cross_ra0", action="store_true", default=False,
+                        help="Center the synthetic exposures on RA=0")
+    parser.add_argument("--engine", default='swarp', choices=['swarp', 'numpy'],
+                        help="Projection engine for fromlist")
+    parser.add_argument("--stretch", default='stiff', choices=['stiff', 'numpy'],
+                        help="PNG stretch for fromlist")
+    parser.add_argument("--tile_stretch", nargs='+', default=['stiff', 'numpy'], choices=['stiff', 'numpy'],
+                        help="PNG stretch(es) for technicolor")
+    parser.add_argument("--rgb_mode", nargs='+', default=['stiff', 'lupton'], choices=['stiff', 'lupton'],
+                        help="RGB scaling(s) for technicolor with --tile_stretch numpy")
+    parser.add_argument("--quicklook", type=int, default=0,
+                        help="Time the quicklook mosaic binned by N instead of the projection")
+    parser.add_argument("--real_tools", action="store_true", default=False,
+                        help="Use the swarp/stiff in the PATH instead of the stand-ins")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = cmdline()
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    setup_tools(workdir, real_tools=args.real_tools)
+
+    results = []
+    failed = []
+    nbad = 0
+    if 'import' in args.bench:
+        rows, nbad = bench_imports(repeat=args.repeat)
+        results += rows
+    if 'fromlist' in args.bench:
+        rows, fails = bench_fromlist(workdir, args.pixscale, args.nobjects, args.nthreads,
+                                     repeat=args.repeat, shrink=args.shrink, cross_ra0=args.cross_ra0,
+                                     engine=args.engine, stretch=args.stretch, quicklook=args.quicklook)
+        results += rows
+        failed += fails
+    if 'technicolor' in args.bench:
+        cases = [(stretch, rgb_mode) for stretch, rgb_mode in TECHNICOLOR_CASES
+                 if stretch in args.tile_stretch and rgb_mode in args.rgb_mode]
+        rows, fails = bench_technicolor(workdir, args.nobjects, args.nthreads,
+                                        repeat=args.repeat, size=args.tilesize, cases=cases)
+        results += rows
+        failed += fails
+    if 'storage' in args.bench:
+        results += bench_storage(workdir, args.nobjects[0], size=args.tilesize, repeat=args.repeat)
+    print_report(results)
+    write_report(args.out or os.path.join(workdir, 'bench.json'), results, environment(), failed=failed)
+    nslow = compare(args.compare, results) if args.compare else 0
+    nbad += len(failed)
+    if failed:
+        print(f"# ERROR: {len(failed)} benchmark runs failed, their timings are not reported")
+    sys.exit(1 if nslow or nbad else 0)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+
+ Vectorized, parallel loader for the SExtractor (LDAC) catalogs of a
+ DECam exposure.
+
+ Only the columns needed to draw the detections are read from the
+ ext=2 table of each catalog, using a pool of threads. The row counts
+ are read first, so a single structured array for the whole exposure
+ is allocated once and filled in place, instead of growing the arrays
+ with numpy.append for every CCD.
+
+ The result can optionally be cached as a compact .npy file per
+ exposure, with a sidecar .key file holding the hash of the catalog
+ files (projectlib_manifest.files_hash) and the columns it was made
+ from, so a different list of catalogs rebuilds it.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import time
+import hashlib
+import concurrent.futures
+
+import fitsio
+import numpy
+
+from projectDECam import projectlib_manifest
+
+# The columns we need to draw the ellipses
+COLUMNS = ['ALPHA_J2000',
+           'DELTA_J2000',
+           'A_IMAGE',
+           'B_IMAGE',
+           'KRON_RADIUS',
+           'THETA_IMAGE',
+           'IMAFLAGS_ISO']
+
+# The compact output type
+DTYPE = [('ALPHA_J2000', 'f8'),
+         ('DELTA_J2000', 'f8'),
+         ('A_IMAGE', 'f4'),
+         ('B_IMAGE', 'f4'),
+         ('KRON_RADIUS', 'f4'),
+         ('THETA_IMAGE', 'f4'),
+         ('IMAFLAGS_ISO', 'i4')]
+
+# The LDAC objects table
+CATALOG_EXT = 2
+
+
+def catalog_nrows(catfile, ext=CATALOG_EXT):
+
+    """ Number of rows in the catalog table, from the header only """
+
+    with fitsio.FITS(catfile) as fits:
+        return fits[ext].get_nrows()
+
+
+def cache_key(catfiles, ext=CATALOG_EXT):
+
+    """ The key of a catalog cache: the catalog files, the table and the columns """
+
+    sha = hashlib.sha1()
+    sha.update(projectlib_manifest.files_hash(catfiles).encode())
+    sha.update(f"{ext}:{','.join(COLUMNS)}:{DTYPE}".encode())
+    return sha.hexdigest()
+
+
+def cache_keyfile(cachefile):
+
+    """ The sidecar file with the key of a .npy cache """
+
+    return f"{cachefile}.key"
+
+
+def cache_is_valid(cachefile, catfiles, ext=CATALOG_EXT):
+
+    """ The .npy cache is valid if it was made from the same catalogs and columns """
+
+    if not cachefile or not os.path.exists(cachefile):
+        return False
+    try:
+        with open(cache_keyfile(cachefile)) as fobj:
+            key = fobj.read().strip()
+    except FileNotFoundError:
+        return False
+    return key == cache_key(catfiles, ext=ext)
+
+
+def read_catalogs(catfiles, nthreads=8, ext=CATALOG_EXT, cachefile=None, force=False):
+
+    """
+    Read the relevant columns of a list of SEx catalogs into a single
+    structured array
+    ----------
+    catfiles: list
+        The catalog files of the exposure
+    nthreads: int
+        Number of threads to read the catalogs
+    ext: int
+        The extension of the objects table (2 for LDAC)
+    cachefile: str, optional
+        A .npy file to read from (if valid) or to write the result to
+    force: bool
+        Ignore a valid cache file
+    """
+
+    t0 = time.time()
+    if not force and cache_is_valid(cachefile, catfiles, ext=ext):
+        print(f"# Reading catalogs from cache: {cachefile}")
+        cat = numpy.load(cachefile)
+        print(f"# Read {len(cat)} objects in {time.time()-t0:.2f}s")
+        return cat
+
+    nthreads = max(1, min(nthreads, len(catfiles)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+        nrows = list(pool.map(lambda f: catalog_nrows(f, ext=ext), catfiles))
+        offsets = numpy.concatenate([[0], numpy.cumsum(nrows)]).astype(int)
+        cat = numpy.empty(offsets[-1], dtype=DTYPE)
+
+        def fill(k):
+            if nrows[k] == 0:
+                return 0
+            tbdata = fitsio.read(catfiles[k], ext=ext, columns=COLUMNS)
+            chunk = cat[offsets[k]:offsets[k+1]]
+            for name in COLUMNS:
+                chunk[name] = tbdata[name]
+            return nrows[k]
+
+        list(pool.map(fill, range(len(catfiles))))
+
+    print(f"# Read {len(catfiles)} SEx catalogs, {len(cat)} objects in {time.time()-t0:.2f}s")
+    if cachefile:
+        # Write to a temporary name first, so readers never see a partial
+        # file, and the key last, so it never goes with the wrong array
+        keyfile = cache_keyfile(cachefile)
+        if os.path.exists(keyfile):
+            os.remove(keyfile)
+        tmpfile = f"{cachefile}.tmp.npy"
+        numpy.save(tmpfile, cat)
+        os.replace(tmpfile, cachefile)
+        with open(f"{keyfile}.tmp", 'w') as fobj:
+            fobj.write(cache_key(catfiles, ext=ext) + "\n")
+        os.replace(f"{keyfile}.tmp", keyfile)
+        print(f"# Wrote catalog cache: {cachefile}")
+    return cat
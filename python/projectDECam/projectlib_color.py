@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+
+ In-process color composition for the coadd tiles, a NumPy replacement
+ for the grayscale and RGB stiff calls of color_tile.
+
+ The bands of a tile are aligned (same pixel grid), so we read them
+ together in strips of rows (fitsio, also from the fpacked HDUs) and
+ from the same strips we make:
+   - the 8-bit grayscale image of every band, with the stiff-like
+     levels of --grayscale
+   - the 8-bit RGB image, either with the stiff-like per-band levels of
+     --colorscale (mode='stiff') or with the Lupton et al. (2004) asinh
+     stretch (mode='lupton'), which keeps the colors of bright objects
+ Every band is read in full once, for the images, after a first
+ streaming pass for its levels (a quantile sketch, skipped if the
+ levels are given) that only reads every LEVELS_SUBSAMPLE-th row and
+ column, so it costs 1/LEVELS_SUBSAMPLE of a read (only those rows are
+ decompressed). Only the 8-bit outputs and one strip per band are in
+ memory.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import time
+import contextlib
+
+import fitsio
+import numpy
+
+from projectDECam import projectlib_quantile
+from projectDECam import projectlib_stretch
+from projectDECam import projectlib_pngmeta
+
+# The default softening of the Lupton asinh stretch
+LUPTON_Q = 8.0
+# The rows/columns subsampling of the levels pass, the quantiles of a
+# tile are still from millions of pixels
+LEVELS_SUBSAMPLE = 4
+
+
+def band_levels(files, ext=0, max_grayscale=0.95, max_colorscale=0.995,
+                satur_level=40000.0, subsample=LEVELS_SUBSAMPLE):
+
+    """
+    The sky and the grayscale/color max levels of every band, with one
+    streaming pass per band. Returns {band: {'sky', 'gray', 'color'}},
+    the same as technicolor.levels
+    ----------
+    files: dict
+        The band:filename dictionary
+    ext: int
+        The HDU of the images (1 for fpacked files)
+    subsample: int
+        Only read every subsample-th row and column
+    """
+
+    levels = {}
+    for band, filename in files.items():
+        sketch = projectlib_quantile.sketch_file(filename, ext=ext, rel_err=projectlib_stretch.REL_ERR,
+                                                 subsample=subsample, satur_level=satur_level)
+        sky, gray, color = sketch.quantile([0.5, max_grayscale, max_colorscale])
+        levels[band] = {'sky': sky, 'gray': gray, 'color': color}
+        print(f"# {band} -- sky: {sky:.4f} gray: {gray:.4f} color: {color:.4f}")
+    return levels
+
+
+def lupton_strip(strips, skys, vmaxs, Q=LUPTON_Q, out=None):
+
+    """
+    The Lupton et al. (2004) asinh composition of three aligned strips
+    (R,G,B): the bands are sky subtracted and scaled to their max
+    levels, and the asinh of the mean intensity is applied to all of
+    them, so the ratios between bands (the colors) are kept
+    ----------
+    strips: list
+        The R,G,B strips
+    skys, vmaxs: list
+        The sky and max levels of each band
+    Q: float
+        The softening of the asinh
+    out: (ny,nx,3) uint8 array, optional
+        Pre-allocated output
+    """
+
+    x = numpy.empty((3,) + strips[0].shape, dtype='f4')
+    for k, strip in enumerate(strips):
+        scale = 1.0/(vmaxs[k] - skys[k]) if vmaxs[k] > skys[k] else 1.0
+        numpy.subtract(strip, skys[k], out=x[k], casting='unsafe')
+        x[k] *= scale
+    x[~numpy.isfinite(x)] = 0.0
+    numpy.clip(x, 0.0, None, out=x)
+
+    intensity = x.sum(axis=0)/3.0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        ratio = numpy.where(intensity > 0, numpy.arcsinh(Q*intensity)/(numpy.arcsinh(Q)*intensity), 0.0)
+    x *= ratio.astype('f4')
+
+    # Saturate to the brightest band, to keep the color
+    xmax = x.max(axis=0)
+    big = xmax > 1.0
+    x[:, big] /= xmax[big]
+
+    if out is None:
+        out = numpy.empty(strips[0].shape + (3,), dtype=numpy.uint8)
+    x *= 255.0
+    x += 0.5
+    out[...] = numpy.moveaxis(x, 0, -1).astype(numpy.uint8)
+    return out
+
+
+def compose_files(files, rgb_filters=None, ext=0, levels=None, max_grayscale=0.95,
+                  max_colorscale=0.995, min_level=0.005, gamma=2.2, satur_level=40000.0,
+                  mode='stiff', Q=LUPTON_Q, gray=True, nrows=projectlib_quantile.NROWS,
+                  subsample=LEVELS_SUBSAMPLE):
+
+    """
+    Make the grayscale images of all bands and the RGB image from the
+    same strips of rows, after a subsampled first pass over every band
+    for its levels if they are not given. Returns ({band: 8-bit
+    array}, RGB 8-bit array or None), both north up (first FITS row at
+    the bottom) as stiff
+    ----------
+    files: dict
+        The band:filename dictionary, on the same pixel grid
+    rgb_filters: list, optional
+        The R,G,B bands, i.e. ['i','r','g']
+    ext: int
+        The HDU of the images (1 for fpacked files)
+    levels: dict, optional
+        The levels from band_levels, otherwise computed reading every
+        subsample-th row and column of every band
+    mode: str
+        The RGB scaling: 'stiff' (per-band levels) or 'lupton' (asinh)
+    Q: float
+        The softening of the Lupton asinh
+    gray: bool
+        Make the grayscale images
+    subsample: int
+        The subsampling of the levels pass
+    """
+
+    t0 = time.time()
+    if levels is None:
+        levels = band_levels(files, ext=ext, max_grayscale=max_grayscale,
+                             max_colorscale=max_colorscale, satur_level=satur_level,
+                             subsample=subsample)
+    bands = list(files.keys()) if gray else list(rgb_filters or [])
+
+    # The (vmin, vmax) display levels
+    glevels = {}
+    clevels = {}
+    for band in bands:
+        lev = levels[band]
+        glevels[band] = (projectlib_stretch.min_from_greylevel(lev['sky'], lev['gray'], min_level, gamma),
+                         lev['gray'])
+        clevels[band] = (projectlib_stretch.min_from_greylevel(lev['sky'], lev['color'], min_level, gamma),
+                         lev['color'])
+
+    with contextlib.ExitStack() as stack:
+        hdus = {band: stack.enter_context(fitsio.FITS(files[band]))[ext] for band in bands}
+        ny, nx = hdus[bands[0]].get_dims()
+        for band in bands:
+            if tuple(hdus[band].get_dims()) != (ny, nx):
+                raise ValueError(f"{files[band]} is not on the same grid as {files[bands[0]]}")
+
+        grays = {band: numpy.empty((ny, nx), dtype=numpy.uint8) for band in files} if gray else {}
+        rgb = numpy.empty((ny, nx, 3), dtype=numpy.uint8) if rgb_filters else None
+        for r0 in range(0, ny, nrows):
+            r1 = min(r0 + nrows, ny)
+            strips = {band: hdus[band][r0:r1, :] for band in bands}
+            # Flip so the first FITS row is at the bottom
+            rows = slice(ny - r1, ny - r0)
+            for band in grays:
+                vmin, vmax = glevels[band]
+                projectlib_stretch.stretch(strips[band], vmin, vmax, gamma=gamma, satur_level=satur_level,
+                                           flip=True, out=grays[band][rows])
+            if rgb is None:
+                continue
+            if mode == 'lupton':
+                rgb[rows] = lupton_strip([strips[b][::-1] for b in rgb_filters],
+                                         [levels[b]['sky'] for b in rgb_filters],
+                                         [levels[b]['color'] for b in rgb_filters], Q=Q)
+            else:
+                for k, band in enumerate(rgb_filters):
+                    vmin, vmax = clevels[band]
+                    projectlib_stretch.stretch(strips[band], vmin, vmax, gamma=gamma,
+                                               satur_level=satur_level, flip=True, out=rgb[rows, :, k])
+    print(f"# Composed {len(bands)} bands ({ny}x{nx}, mode: {mode}) in {time.time()-t0:.2f}s")
+    return grays, rgb
+
+
+def write_tile_pngs(files, base_outname, rgb_filters=None, wcs_filter=None, ext=0, levels=None,
+                    max_grayscale=0.95, max_colorscale=0.995, mode='stiff', Q=LUPTON_Q,
+                    subsample=LEVELS_SUBSAMPLE, compress_level=6):
+
+    """
+    Write the grayscale {base_outname}_{band}.png and the color
+    {base_outname}_RGB.png of a tile, with the WCS of the band images.
+    Returns the list of PNG files
+    """
+
+    grays, rgb = compose_files(files, rgb_filters=rgb_filters, ext=ext, levels=levels,
+                               max_grayscale=max_grayscale, max_colorscale=max_colorscale,
+                               mode=mode, Q=Q, subsample=subsample)
+    pngfiles = []
+    for band, array8 in grays.items():
+        pngfile = f"{base_outname}_{band}.png"
+        text = projectlib_pngmeta.wcs_text(fitsio.read_header(files[band], ext=ext))
+        projectlib_stretch.write_png(pngfile, array8, compress_level=compress_level, text=text)
+        print(f"# Wrote {pngfile}")
+        pngfiles.append(pngfile)
+    if rgb is not None:
+        pngfile = f"{base_outname}_RGB.png"
+        text = projectlib_pngmeta.wcs_text(fitsio.read_header(files[wcs_filter or rgb_filters[1]], ext=ext))
+        projectlib_stretch.write_png(pngfile, rgb, compress_level=compress_level, text=text)
+        print(f"# Wrote {pngfile}")
+        pngfiles.append(pngfile)
+    return pngfiles
@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+
+"""
+
+ Cutouts of sky regions from the CCDs of DECam exposures, i.e. stamps
+ around transient candidates, without projecting the full exposures.
+
+ The footprints of the CCDs (from the footprint cache, so the headers
+ are read once) are kept in a spatial index: the CCDs sorted by the
+ Dec of their centers, with the radius of the circle that contains
+ each of them. A region only looks at the CCDs within its Dec window
+ and keeps those whose circle overlaps its own.
+
+ For every overlapping CCD only the pixel section that covers the
+ region is read (fitsio section reads of SCI[0] and WGT[2]) and
+ projected with projectlib_numpy onto a small TAN image centered on
+ the region. The requests of a batch are grouped by CCD: every CCD
+ file is opened once and the overlapping sections of its requests are
+ merged into a single read.
+
+ The background is the same as for the full exposure (the meshes of
+ projectlib_numpy.background_map on the CCD grid): it is computed on a
+ window around each section, aligned to the meshes of the CCD and
+ padded by the meshes that the median filter and the interpolation
+ use, and sliced back to the section. A stamp smaller than a mesh
+ would otherwise subtract its own median, i.e. the flux of the source.
+
+   projectDECamCutout imglist outdir --radec 30.1 -29.8 --size 30
+   projectDECamCutout imglist outdir --requests candidates.txt
+
+ where the requests file has "ra dec [size] [name]" per line.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import sys
+import math
+import time
+import collections
+import concurrent.futures
+
+import fitsio
+import numpy
+from despyastro import wcsutil
+
+from projectDECam import projectlib_numpy
+from projectDECam import projectlib_footprint
+
+# A sky region: its center (deg), size (arcsec) and name
+Region = collections.namedtuple('Region', ['ra', 'dec', 'size', 'name'])
+# The result of a region: the image, its weight and TAN header, and
+# the number of CCDs that contributed
+Cutout = collections.namedtuple('Cutout', ['region', 'array', 'weight', 'header', 'nccds'])
+
+# Pixels around the sections, for the nearest-neighbour edges
+MARGIN = 2
+# The background meshes, as SWarp's BACK_SIZE and BACK_FILTERSIZE
+BACK_SIZE = 128
+BACK_FILTERSIZE = 7
+
+
+def region_name(ra, dec):
+    """ The default name of a region from its center """
+    return f"cutout_{ra:.5f}{dec:+.5f}"
+
+
+def read_regions(filename, size=30.0):
+
+    """
+    Read the regions of a requests file, one "ra dec [size] [name]"
+    per line with the size in arcsec [default=size]
+    """
+
+    regions = []
+    with open(filename) as fobj:
+        for nline, line in enumerate(fobj, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            vals = line.split()
+            try:
+                ra = float(vals[0])
+                dec = float(vals[1])
+                rsize = float(vals[2]) if len(vals) > 2 else size
+            except (IndexError, ValueError):
+                sys.exit(f"# ERROR: cannot parse line {nline} of {filename}: {line}")
+            name = vals[3] if len(vals) > 3 else region_name(ra, dec)
+            regions.append(Region(ra, dec, rsize, name))
+    return regions
+
+
+def radec2xyz(ra, dec):
+
+    """ The unit vectors of ra, dec in degrees """
+
+    ra = numpy.radians(numpy.asarray(ra, dtype='f8'))
+    dec = numpy.radians(numpy.asarray(dec, dtype='f8'))
+    return numpy.stack([numpy.cos(dec)*numpy.cos(ra),
+                        numpy.cos(dec)*numpy.sin(ra),
+                        numpy.sin(dec)], axis=-1)
+
+
+def angular_distance(xyz1, xyz2):
+
+    """ The angular distance (deg) between unit vectors """
+
+    dot = numpy.clip(numpy.sum(xyz1*xyz2, axis=-1), -1.0, 1.0)
+    return numpy.degrees(numpy.arccos(dot))
+
+
+class FootprintIndex:
+
+    """
+    Spatial index of CCD footprints: the CCDs sorted by the Dec of
+    their center, each with the radius of its bounding circle
+    """
+
+    def __init__(self, filenames, footprints):
+
+        self.filenames = list(filenames)
+        ra = numpy.asarray(footprints['ra'])
+        dec = numpy.asarray(footprints['dec'])
+        self.naxis1 = numpy.asarray(footprints['naxis1'])
+        self.naxis2 = numpy.asarray(footprints['naxis2'])
+        xyz = radec2xyz(ra, dec)
+        # The circle of each CCD: the center and the farthest corner
+        self.radius = angular_distance(xyz[:, :1, :], xyz[:, 1:, :]).max(axis=1)
+        self.max_radius = self.radius.max() if len(self.radius) else 0.0
+        self.order = numpy.argsort(dec[:, 0])
+        self.dec_sorted = dec[self.order, 0]
+        self.xyz = xyz[:, 0, :]
+
+    @classmethod
+    def from_files(cls, filenames, cachefile=None, use_cache=True, nthreads=8):
+        """ Build the index from the (cached) footprints of a list of CCD files """
+        footprints = projectlib_footprint.get_footprints(filenames, cachefile=cachefile,
+                                                         nthreads=nthreads, use_cache=use_cache)
+        return cls(filenames, footprints)
+
+    def query(self, ra, dec, radius):
+
+        """
+        The indices of the CCDs whose bounding circle overlaps the circle
+        of radius (deg) around ra, dec
+        """
+
+        window = radius + self.max_radius
+        k0 = numpy.searchsorted(self.dec_sorted, dec - window, side='left')
+        k1 = numpy.searchsorted(self.dec_sorted, dec + window, side='right')
+        candidates = self.order[k0:k1]
+        if len(candidates) == 0:
+            return candidates
+        dist = angular_distance(self.xyz[candidates], radec2xyz(ra, dec))
+        return numpy.sort(candidates[dist <= radius + self.radius[candidates]])
+
+
+def region_header(region, pixscale):
+
+    """ The TAN header of the output image of a region """
+
+    npix = max(1, int(math.ceil(region.size/pixscale)))
+    return projectlib_numpy.tan_header(region.ra % 360.0, region.dec, pixscale, nx=npix, ny=npix,
+                                       crpix1=(npix+1)/2.0, crpix2=(npix+1)/2.0)
+
+
+def region_border(header, nside=8):
+
+    """ The ra, dec of points along the border of the image of header """
+
+    nx = header['NAXIS1']
+    ny = header['NAXIS2']
+    tx = numpy.linspace(0.5, nx + 0.5, nside)
+    ty = numpy.linspace(0.5, ny + 0.5, nside)
+    x = numpy.concatenate([tx, tx, numpy.full(nside, 0.5), numpy.full(nside, nx + 0.5)])
+    y = numpy.concatenate([numpy.full(nside, 0.5), numpy.full(nside, ny + 0.5), ty, ty])
+    return wcsutil.WCS(header).image2sky(x, y)
+
+
+def ccd_section(wcs, naxis1, naxis2, ra, dec, margin=MARGIN):
+
+    """
+    The section (x0, x1, y0, y1) of a CCD (0-based, as slices) that
+    covers the points ra, dec, or None if it is off the CCD
+    """
+
+    x, y = wcs.sky2image(ra, dec)
+    x0 = max(int(math.floor(numpy.min(x) - 0.5)) - margin, 0)
+    x1 = min(int(math.ceil(numpy.max(x) - 0.5)) + margin + 1, naxis1)
+    y0 = max(int(math.floor(numpy.min(y) - 0.5)) - margin, 0)
+    y1 = min(int(math.ceil(numpy.max(y) - 0.5)) + margin + 1, naxis2)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, x1, y0, y1
+
+
+def merge_sections(sections):
+
+    """
+    Merge the overlapping sections of a CCD, so they are read once.
+    Takes a list of (section, key) and returns a list of (section, keys)
+    """
+
+    groups = []
+    for (x0, x1, y0, y1), key in sorted(sections, key=lambda s: s[0]):
+        for group in groups:
+            gx0, gx1, gy0, gy1 = group[0]
+            if x0 < gx1 and gx0 < x1 and y0 < gy1 and gy0 < y1:
+                group[0] = (min(x0, gx0), max(x1, gx1), min(y0, gy0), max(y1, gy1))
+                group[1].append(key)
+                break
+        else:
+            groups.append([(x0, x1, y0, y1), [key]])
+    return [(tuple(section), keys) for section, keys in groups]
+
+
+def section_header(hdr, section):
+
+    """ The header of a section of a CCD, with the WCS shifted to it """
+
+    x0, x1, y0, y1 = section
+    header = {key: hdr[key] for key in hdr.keys() if key not in ('COMMENT', 'HISTORY', '')}
+    header['NAXIS1'] = x1 - x0
+    header['NAXIS2'] = y1 - y0
+    header['CRPIX1'] = hdr['CRPIX1'] - x0
+    header['CRPIX2'] = hdr['CRPIX2'] - y0
+    return header
+
+
+def back_window(section, naxis1, naxis2, back_size=BACK_SIZE, filter_size=BACK_FILTERSIZE):
+
+    """
+    The window (x0, x1, y0, y1) of the CCD for the background of a
+    section: aligned to the meshes of the CCD and padded by the meshes
+    of the median filter plus one for the interpolation, so the
+    background of the section is the same as that of the full CCD
+    """
+
+    x0, x1, y0, y1 = section
+    pad = filter_size//2 + 1
+    bx0 = max((x0//back_size - pad)*back_size, 0)
+    by0 = max((y0//back_size - pad)*back_size, 0)
+    bx1 = min(((x1 - 1)//back_size + 1 + pad)*back_size, naxis1)
+    by1 = min(((y1 - 1)//back_size + 1 + pad)*back_size, naxis2)
+    return bx0, bx1, by0, by1
+
+
+def read_sections(filename, borders, naxis1, naxis2, noBack=False, back_size=BACK_SIZE,
+                  filter_size=BACK_FILTERSIZE):
+
+    """
+    Read the sections of a CCD needed by a set of regions, merging the
+    ones that overlap, and subtract their background unless noBack.
+    Returns the header, a list of (section, sci, wgt, keys) and the
+    number of pixels read
+    ----------
+    borders: dict
+        The ra, dec along the border of each region, by region key
+    """
+
+    with fitsio.FITS(filename) as fits:
+        hdr = fits[0].read_header()
+        wcs = wcsutil.WCS(hdr)
+        sections = []
+        for key, (ra, dec) in borders.items():
+            section = ccd_section(wcs, naxis1, naxis2, ra, dec)
+            if section is not None:
+                sections.append((section, key))
+        reads = []
+        npix = 0
+        for section, keys in merge_sections(sections):
+            x0, x1, y0, y1 = section
+            if noBack:
+                sci = fits[0][y0:y1, x0:x1].astype('f4')
+                wgt = fits[2][y0:y1, x0:x1].astype('f4')
+                npix += sci.size
+            else:
+                bx0, bx1, by0, by1 = back_window(section, naxis1, naxis2, back_size, filter_size)
+                sci = fits[0][by0:by1, bx0:bx1].astype('f4')
+                wgt = fits[2][by0:by1, bx0:bx1].astype('f4')
+                npix += sci.size
+                sci -= projectlib_numpy.background_map(sci, wgt, back_size=back_size,
+                                                       filter_size=filter_size)
+                rows = slice(y0 - by0, y1 - by0)
+                cols = slice(x0 - bx0, x1 - bx0)
+                sci = sci[rows, cols].copy()
+                wgt = wgt[rows, cols].copy()
+            reads.append((section, sci, wgt, keys))
+    return hdr, reads, npix
+
+
+def make_cutouts(imgfiles, regions, pixscale=projectlib_numpy.INPUT_PIXEL_SCALE, weight_thresh=None,
+                 noBack=False, index=None, footprint_cache=None, use_cache=True, nthreads=8,
+                 input_pixscale=projectlib_numpy.INPUT_PIXEL_SCALE):
+
+    """
+    Project the sky regions from the CCDs that overlap them, reading
+    only the sections of the CCDs they cover. Returns a list of Cutout
+    ----------
+    imgfiles: list
+        The multi-extension CCD files, with SCI in [0] and WGT in [2]
+    regions: list
+        The Region (ra, dec, size, name) to cut out
+    pixscale: float
+        The output pixel-scale in arcsec/pixel
+    weight_thresh: float, optional
+        SWarp's WEIGHT_THRESH, at the input pixel-scale
+    noBack: bool
+        Do not subtract the background (of the CCDs, as for the full
+        exposure)
+    index: FootprintIndex, optional
+        The index of imgfiles, otherwise built from the footprint cache
+    nthreads: int
+        Number of threads to read the CCDs
+    """
+
+    t0 = time.time()
+    if index is None:
+        index = FootprintIndex.from_files(imgfiles, cachefile=footprint_cache,
+                                          use_cache=use_cache, nthreads=nthreads)
+    if weight_thresh:
+        weight_thresh = float(weight_thresh)*(input_pixscale/pixscale)**2
+    fscale = (pixscale/input_pixscale)**2
+
+    # The output images and the CCDs each region needs
+    headers = []
+    out_wcs = []
+    out_sum = []
+    out_wsum = []
+    nccds = numpy.zeros(len(regions), dtype=int)
+    plan = collections.defaultdict(dict)
+    for k, region in enumerate(regions):
+        header = region_header(region, pixscale)
+        headers.append(header)
+        out_wcs.append(wcsutil.WCS(header))
+        out_sum.append(numpy.zeros((header['NAXIS2'], header['NAXIS1']), dtype='f4'))
+        out_wsum.append(numpy.zeros((header['NAXIS2'], header['NAXIS1']), dtype='f4'))
+        border = region_border(header)
+        radius = region.size*math.sqrt(2.0)/2.0/3600.
+        for i in index.query(region.ra, region.dec, radius):
+            plan[i][k] = border
+
+    # Read the CCDs in threads and project in this one, as they come
+    npix_read = 0
+    nthreads = max(1, min(nthreads, len(plan)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+        futures = [pool.submit(read_sections, index.filenames[i], borders,
+                               index.naxis1[i], index.naxis2[i], noBack=noBack)
+                   for i, borders in plan.items()]
+        for future in concurrent.futures.as_completed(futures):
+            hdr, reads, npix = future.result()
+            npix_read += npix
+            for section, sci, wgt, keys in reads:
+                header = section_header(hdr, section)
+                for k in keys:
+                    npix = projectlib_numpy.project_ccd(out_wcs[k], out_sum[k], out_wsum[k], sci, wgt,
+                                                        header, fscale=fscale,
+                                                        weight_thresh=weight_thresh)
+                    nccds[k] += npix > 0
+
+    cutouts = []
+    for k, region in enumerate(regions):
+        good = out_wsum[k] > 0
+        numpy.divide(out_sum[k], out_wsum[k], out=out_sum[k], where=good)
+        out_sum[k][~good] = 0.0
+        cutouts.append(Cutout(region, out_sum[k], out_wsum[k], headers[k], int(nccds[k])))
+    npix_all = int(numpy.sum(index.naxis1.astype('i8')*index.naxis2))
+    print(f"# Cut out {len(regions)} regions from {len(plan)}/{len(index.filenames)} CCDs, "
+          f"read {npix_read} of {npix_all} pixels in {time.time()-t0:.2f}s")
+    return cutouts
+
+
+def write_cutouts(cutouts, outdir, png=True, grayscale=0.98, keep_weight=False):
+
+    """
+    Write the cutouts as {outdir}/{name}.fits (and .png). The regions
+    that no CCD covers are skipped. Returns the list of files
+    """
+
+    from projectDECam import projectlib_api
+    os.makedirs(outdir, exist_ok=True)
+    files = []
+    for cutout in cutouts:
+        name = cutout.region.name
+        if cutout.nccds == 0:
+            print(f"# WARNING: no CCD covers {name} ({cutout.region.ra}, {cutout.region.dec})")
+            continue
+        fitsfile = os.path.join(outdir, f"{name}.fits")
+        weightname = os.path.join(outdir, f"{name}_wgt.fits") if keep_weight else None
+        projectlib_numpy.write_projection(fitsfile, cutout.array, cutout.header,
+                                          weight=cutout.weight, weightname=weightname)
+        files.append(fitsfile)
+        if png:
+            pngfile = os.path.join(outdir, f"{name}.png")
+            projectlib_api.stretch(cutout.array, cutout.header, grayscale=grayscale, outfile=pngfile)
+            files.append(pngfile)
+        print(f"# Wrote {fitsfile} from {cutout.nccds} CCDs")
+    return files
+
+
+def cmdline():
+
+    """ Parse the command line arguments and options using argparse"""
+
+    import argparse
+
+    USAGE = "\n"
+    USAGE = USAGE + "  %(prog)s <imglist> <outdir> [--radec RA DEC | --requests FILE] [options] \n"
+    USAGE = USAGE + "  i.e.: \n"
+    USAGE = USAGE + "  %(prog)s file-with-list-of-images /someplace/cutouts --radec 30.1 -29.8 --size 30\n"
+
+    epilog = "Author: Felipe Menanteau, NCSA/University of Illinois (felipe@illinois.edu)"
+    description = "Cut out sky regions from the CCDs of DECam exposures, reading only " \
+                  "the sections of the CCDs that overlap them"
+    parser = argparse.ArgumentParser(usage=USAGE,
+                                     epilog=epilog,
+                                     description=description,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("imglist", default=None,
+                        help="Image list(s) of the exposures, comma separated")
+    parser.add_argument("outdir", action="store",
+                        help="Output directory for the cutouts")
+    parser.add_argument("--radec", type=float, nargs=2, action="append", default=[],
+                        metavar=('RA', 'DEC'),
+                        help="Center of a region [deg], can be repeated")
+    parser.add_argument("--requests", action="store", default=None,
+                        help="File with one 'ra dec [size] [name]' region per line")
+    parser.add_argument("--size", type=float, default=30.0,
+                        help="Size of the regions [arcsec]")
+    parser.add_argument("--pixscale", type=float, default=projectlib_numpy.INPUT_PIXEL_SCALE,
+                        help="pixel-scale of the cutouts in arcsec/pix")
+    parser.add_argument("--weight_thresh", action="store", default=None,
+                        help="SWarps WEIGHT_THRESH value")
+    parser.add_argument("--noBack", action="store_true", default=False,
+                        help="Do not subtract the background")
+    parser.add_argument("--noPNG", action="store_true", default=False,
+                        help="Skip creation of PNG files")
+    parser.add_argument("--grayscale", type=float, default=0.98,
+                        help="grayscale for png creation [i.e. 0.98]")
+    parser.add_argument("--keep_weight", action="store_true", default=False,
+                        help="Also write the weight of the cutouts as NAME_wgt.fits")
+    parser.add_argument("--NTHREADS", type=int, default=8,
+                        help="Number of threads to read the CCDs")
+    parser.add_argument("--footprint_cache", action="store", default=None,
+                        help="SQLite cache of CCD footprints [default=$PROJECTDECAM_CACHE or ~/.cache/projectDECam]")
+    parser.add_argument("--nocache", action="store_true", default=False,
+                        help="Do not use the CCD footprint cache")
+
+    args = parser.parse_args()
+    if not args.radec and not args.requests:
+        parser.error("Need the regions: --radec RA DEC or --requests FILE")
+
+    print("# Will run:")
+    print(f"# {parser.prog}")
+    for key, val in sorted(vars(args).items()):
+        print("# \t--%-10s\t%s" % (key, val))
+    return args
+
+
+def run(args):
+
+    """ Cut out the regions of the command line """
+
+    from projectDECam import projectlib_fromlist
+    regions = [Region(ra, dec, args.size, region_name(ra, dec)) for ra, dec in args.radec]
+    if args.requests:
+        regions += read_regions(args.requests, size=args.size)
+    imgfiles = []
+    for imglist in args.imglist.split(','):
+        imgfiles += projectlib_fromlist.read_list(imglist)
+    cutouts = make_cutouts(sorted(imgfiles), regions,
+                           pixscale=args.pixscale,
+                           weight_thresh=args.weight_thresh,
+                           noBack=args.noBack,
+                           footprint_cache=args.footprint_cache,
+                           use_cache=not args.nocache,
+                           nthreads=args.NTHREADS)
+    write_cutouts(cutouts, args.outdir, png=not args.noPNG, grayscale=args.grayscale,
+                  keep_weight=args.keep_weight)
+    return sum(cutout.nccds == 0 for cutout in cutouts)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+"""
+
+ Direct raster ellipse renderer for the detection overlays
+ ($BASENAME_ell.png). The outlines of all ellipses are rasterized
+ straight into an RGB NumPy buffer on top of the 8-bit grayscale
+ image, in vectorized batches and optionally in parallel bands of
+ rows, so the output has exactly the size of the image (no DPI
+ rounding) and we avoid the matplotlib figure altogether.
+
+ It can be benchmarked against the matplotlib/drawDECam path with:
+
+   python -m projectDECam.projectlib_ellipses --nobjects 10000 100000 1000000
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import math
+import time
+import concurrent.futures
+
+import numpy
+
+# The colors used for IMAFLAGS_ISO==0 and IMAFLAGS_ISO>0
+RED = (255, 0, 0)
+BLUE = (0, 0, 255)
+
+# Number of objects per vectorized batch
+BATCH = 65536
+
+
+def gray2rgb(gray):
+
+    """ An RGB copy of an 8-bit grayscale array """
+
+    return numpy.repeat(gray[:, :, numpy.newaxis], 3, axis=2)
+
+
+def outline_points(x, y, a, b, theta, min_vertices=8, max_vertices=4096):
+
+    """
+    The pixel positions of the outlines of a set of ellipses. Each
+    ellipse is sampled with a number of vertices proportional to its
+    perimeter, so the outline has no gaps
+    ----------
+    x, y: arrays
+        The centers in (1-based) FITS pixel coordinates
+    a, b: arrays
+        The semi-major and semi-minor axes in pixels
+    theta: array
+        The position angle in degrees, counter-clockwise from x
+    Returns the 0-based (column, row) integer arrays, with rows counted
+    from the bottom of the image
+    """
+
+    a = numpy.asarray(a, dtype='f8')
+    b = numpy.asarray(b, dtype='f8')
+    # Ramanujan-like perimeter, with one vertex per ~0.7 pixel
+    perim = math.pi*(3*(a + b) - numpy.sqrt(numpy.abs((3*a + b)*(a + 3*b))))
+    nvert = numpy.clip(numpy.ceil(perim*1.5), min_vertices, max_vertices).astype(numpy.int64)
+
+    idx = numpy.repeat(numpy.arange(len(a)), nvert)
+    start = numpy.repeat(numpy.cumsum(nvert) - nvert, nvert)
+    t = (numpy.arange(idx.size) - start)*(2*math.pi)/nvert[idx]
+
+    th = numpy.radians(numpy.asarray(theta, dtype='f8'))[idx]
+    ct = numpy.cos(t)
+    st = numpy.sin(t)
+    ax = a[idx]*ct
+    by = b[idx]*st
+    px = numpy.asarray(x, dtype='f8')[idx] + ax*numpy.cos(th) - by*numpy.sin(th)
+    py = numpy.asarray(y, dtype='f8')[idx] + ax*numpy.sin(th) + by*numpy.cos(th)
+    # FITS pixel n covers [n-0.5, n+0.5)
+    col = numpy.floor(px + 0.5).astype(numpy.int64) - 1
+    row = numpy.floor(py + 0.5).astype(numpy.int64) - 1
+    return col, row
+
+
+def _draw_band(rgb, layers, row0, row1):
+
+    """
+    Draw the outlines falling in the rows [row0, row1) (counted from
+    the bottom) of the image, for every (x, y, a, b, theta, color) layer
+    in order
+    """
+
+    ny, nx = rgb.shape[:2]
+    for x, y, a, b, theta, color in layers:
+        if len(x) == 0:
+            continue
+        # Only the ellipses that can reach this band
+        keep = (y + a + 1 >= row0) & (y - a - 1 <= row1 + 1)
+        if not keep.any():
+            continue
+        sel = numpy.flatnonzero(keep)
+        for k in range(0, sel.size, BATCH):
+            s = sel[k:k+BATCH]
+            col, row = outline_points(x[s], y[s], a[s], b[s], theta[s])
+            inside = (col >= 0) & (col < nx) & (row >= row0) & (row < row1)
+            # PNG rows go from the top
+            rgb[ny - 1 - row[inside], col[inside]] = color
+    return
+
+
+def draw_ellipses(rgb, layers, nthreads=1):
+
+    """
+    Rasterize the outlines of several sets of ellipses into an RGB
+    buffer in place
+    ----------
+    rgb: 3D uint8 array
+        The (ny, nx, 3) image, in PNG orientation (first row at the top)
+    layers: list
+        List of (x, y, a, b, theta, color) tuples, drawn in order, with
+        x, y the centers in FITS pixel coordinates
+    nthreads: int
+        Number of threads, each drawing a band of rows
+    """
+
+    ny = rgb.shape[0]
+    layers = [tuple(numpy.asarray(v, dtype='f8') for v in layer[:5]) + (layer[5],)
+              for layer in layers]
+    nthreads = max(1, min(nthreads, ny))
+    if nthreads == 1:
+        _draw_band(rgb, layers, 0, ny)
+        return rgb
+
+    edges = numpy.linspace(0, ny, nthreads + 1).astype(int)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+        jobs = [pool.submit(_draw_band, rgb, layers, edges[k], edges[k+1])
+                for k in range(nthreads)]
+        for job in jobs:
+            job.result()
+    return rgb
+
+
+def render_overlay(gray, x, y, a, b, theta, flags, nthreads=1):
+
+    """
+    Make the RGB overlay image: ellipses with flags==0 in red and the
+    flagged ones in blue over the 8-bit grayscale image
+    """
+
+    rgb = gray2rgb(gray)
+    good = flags == 0
+    layers = [(x[good], y[good], a[good], b[good], theta[good], RED),
+              (x[~good], y[~good], a[~good], b[~good], theta[~good], BLUE)]
+    return draw_ellipses(rgb, layers, nthreads=nthreads)
+
+
+def density_layer(rgb, x, y, flags, counts_shape, density_bin, alpha_max=0.8, max_count=16):
+
+    """
+    Blend a coloured density layer of objects into an RGB buffer in
+    place: each cell of density_bin x density_bin pixels is coloured
+    from red (IMAFLAGS_ISO==0) to blue (all flagged) by the flagged
+    fraction, with an opacity that grows with the number of objects
+    """
+
+    ny, nx = rgb.shape[:2]
+    nby, nbx = counts_shape
+    col = numpy.clip(numpy.floor(x - 0.5).astype(numpy.int64), 0, nx - 1)//density_bin
+    row = numpy.clip(numpy.floor(y - 0.5).astype(numpy.int64), 0, ny - 1)//density_bin
+    cell = row*nbx + col
+    counts = numpy.bincount(cell, minlength=nby*nbx).reshape(nby, nbx)
+    flagged = numpy.bincount(cell, weights=(flags > 0), minlength=nby*nbx).reshape(nby, nbx)
+    if not counts.any():
+        return rgb
+
+    frac = numpy.divide(flagged, counts, out=numpy.zeros(counts.shape), where=counts > 0)
+    alpha = alpha_max*numpy.clip(numpy.log1p(counts)/math.log1p(max_count), 0, 1)
+    color = numpy.empty((nby, nbx, 3), dtype='f4')
+    for k in range(3):
+        color[:, :, k] = (1 - frac)*RED[k] + frac*BLUE[k]
+
+    # Blend in strips of cells, the cells go from the bottom up
+    for j in numpy.flatnonzero(counts.any(axis=1)):
+        r0 = j*density_bin
+        r1 = min(r0 + density_bin, ny)
+        a = numpy.repeat(alpha[j], density_bin)[:nx, numpy.newaxis]
+        c = numpy.repeat(color[j], density_bin, axis=0)[:nx]
+        rows = slice(ny - r1, ny - r0)
+        blend = rgb[rows]*(1 - a) + c*a
+        rgb[rows] = blend.astype(numpy.uint8)
+    return rgb
+
+
+def render_overlay_lod(gray, x, y, a, b, theta, flags, min_size=1.5, max_density=0.25,
+                       density_bin=4, nthreads=1):
+
+    """
+    Level-of-detail overlay: full ellipses are drawn only for the
+    resolved objects (a >= min_size pixels) outside of dense regions.
+    The unresolved objects, and every object in cells with more than
+    max_density objects per output pixel, are rendered as a density and
+    flag-fraction layer, so the cost scales with the number of output
+    pixels and not with the number of detections
+    ----------
+    gray: 2D uint8 array
+        The 8-bit image in PNG orientation
+    x, y: arrays
+        The centers in FITS pixel coordinates of the image
+    a, b: arrays
+        The semi-axes in pixels of the image
+    min_size: float
+        The minimum semi-major axis in pixels to draw an ellipse
+    max_density: float
+        The number of objects per output pixel above which a region is
+        drawn as density
+    density_bin: int
+        The size in pixels of the density cells
+    """
+
+    t0 = time.time()
+    rgb = gray2rgb(gray)
+    ny, nx = gray.shape
+    x = numpy.asarray(x, dtype='f8')
+    y = numpy.asarray(y, dtype='f8')
+    a = numpy.asarray(a, dtype='f8')
+    flags = numpy.asarray(flags)
+
+    on_image = (x >= 0.5) & (x < nx + 0.5) & (y >= 0.5) & (y < ny + 0.5)
+    nby = int(math.ceil(ny/float(density_bin)))
+    nbx = int(math.ceil(nx/float(density_bin)))
+    col = numpy.clip(numpy.floor(x - 0.5).astype(numpy.int64), 0, nx - 1)//density_bin
+    row = numpy.clip(numpy.floor(y - 0.5).astype(numpy.int64), 0, ny - 1)//density_bin
+    cell = row*nbx + col
+    counts = numpy.bincount(cell[on_image], minlength=nby*nbx)
+    dense = counts[cell] > max_density*density_bin**2
+
+    ellipse = on_image & (a >= min_size) & ~dense
+    points = on_image & ~ellipse
+    print(f"# LOD overlay: {ellipse.sum()} ellipses, {points.sum()} objects as density, "
+          f"{(~on_image).sum()} off the image")
+
+    density_layer(rgb, x[points], y[points], flags[points], (nby, nbx), density_bin,
+                  max_count=max(1, int(max_density*density_bin**2)))
+    good = ellipse & (flags == 0)
+    bad = ellipse & (flags > 0)
+    layers = [(x[good], y[good], a[good], b[good], theta[good], RED),
+              (x[bad], y[bad], a[bad], b[bad], theta[bad], BLUE)]
+    draw_ellipses(rgb, layers, nthreads=nthreads)
+    print(f"# LOD overlay time: {time.time()-t0:.2f}s")
+    return rgb
+
+
+def fake_objects(nobjects, nx, ny, seed=1):
+
+    """ Random objects to benchmark the renderers """
+
+    rng = numpy.random.default_rng(seed)
+    x = rng.uniform(1, nx, nobjects)
+    y = rng.uniform(1, ny, nobjects)
+    a = rng.lognormal(0.5, 0.6, nobjects)
+    b = a*rng.uniform(0.3, 1.0, nobjects)
+    theta = rng.uniform(-90, 90, nobjects)
+    flags = (rng.random(nobjects) < 0.1).astype('i4')
+    return x, y, a, b, theta, flags
+
+
+def benchmark_pylab(gray, x, y, a, b, theta, flags, outfile):
+
+    """ Time the matplotlib/drawDECam path as used before """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import pylab
+    from drawDECam import drawDECam as draw
+
+    t0 = time.time()
+    dpi = 90.
+    ny, nx = gray.shape
+    pylab.figure(1, figsize=(nx/dpi, ny/dpi))
+    pylab.axes([0, 0, 1, 1], frameon=False)
+    pylab.imshow(gray[::-1, :], origin='lower', cmap='gray', interpolation='none')
+    pylab.axis('off')
+    idx1 = flags == 0
+    idx2 = flags > 0
+    for idx, color in ((idx1, 'red'), (idx2, 'blue')):
+        draw.PEllipse_multi((x[idx], y[idx]), (a[idx], b[idx]), resolution=60,
+                            angle=theta[idx], facecolor='none', edgecolor=color, linewidth=0.5)
+    pylab.savefig(outfile, dpi=dpi)
+    pylab.close()
+    return time.time() - t0
+
+
+def benchmark(nobjects_list, nx=6000, ny=6000, nthreads=4, pylab=True, outdir='.'):
+
+    """
+    Benchmark the raster renderer (and the pylab path) for several
+    numbers of objects. Returns a list of dictionaries with the timings
+    """
+
+    from projectDECam import projectlib_stretch
+
+    gray = numpy.full((ny, nx), 20, dtype=numpy.uint8)
+    results = []
+    for nobjects in nobjects_list:
+        x, y, a, b, theta, flags = fake_objects(nobjects, nx, ny)
+        result = {'nobjects': nobjects, 'nx': nx, 'ny': ny}
+
+        t0 = time.time()
+        rgb = render_overlay(gray, x, y, a, b, theta, flags, nthreads=1)
+        result['raster'] = time.time() - t0
+
+        t0 = time.time()
+        rgb = render_overlay(gray, x, y, a, b, theta, flags, nthreads=nthreads)
+        result[f'raster_{nthreads}threads'] = time.time() - t0
+
+        t0 = time.time()
+        projectlib_stretch.write_png(os.path.join(outdir, f"bench_raster_{nobjects}.png"), rgb)
+        result['raster_png'] = time.time() - t0
+
+        if pylab:
+            try:
+                result['pylab'] = benchmark_pylab(gray, x, y, a, b, theta, flags,
+                                                  os.path.join(outdir, f"bench_pylab_{nobjects}.png"))
+            except ImportError as err:
+                print(f"# Skipping pylab benchmark: {err}")
+                pylab = False
+        results.append(result)
+        print("# " + " ".join(f"{k}: {v:.3f}" if isinstance(v, float) else f"{k}: {v}"
+                              for k, v in result.items()))
+    return results
+
+
+def cmdline():
+
+    """ Parse the command line arguments for the benchmark """
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the raster ellipse renderer "
+                                     "against the matplotlib/drawDECam path",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--nobjects", type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="Number of objects to draw")
+    parser.add_argument("--size", type=int, nargs=2, default=[6000, 6000],
+                        help="Size of the image nx ny")
+    parser.add_argument("--nthreads", type=int, default=4,
+                        help="Number of threads for the raster renderer")
+    parser.add_argument("--nopylab", action="store_true", default=False,
+                        help="Do not benchmark the matplotlib path")
+    parser.add_argument("--outdir", default='.',
+                        help="Where to write the benchmark PNGs")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = cmdline()
+    benchmark(args.nobjects, nx=args.size[0], ny=args.size[1], nthreads=args.nthreads,
+              pylab=not args.nopylab, outdir=args.outdir)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+
+ A persistent on-disk (SQLite) cache of CCD footprints. For every CCD
+ file it keeps NAXIS1/2, the RA/Dec of the center and of the four
+ corners, keyed by the file path, size and mtime, so re-processing the
+ same exposures (i.e. at a different pixscale) does not have to open
+ every header and build a WCS again.
+
+ The cache misses are read in parallel threads.
+
+ Typical use:
+
+   cache = FootprintCache()
+   fp = cache.get_footprints(imgfiles)
+   ra_center, dec_center = fp['ra'][:, 0], fp['dec'][:, 0]
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import time
+import sqlite3
+import concurrent.futures
+
+import fitsio
+import numpy
+
+# The default location of the cache, can be changed with the
+# PROJECTDECAM_CACHE environment variable
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'projectDECam', 'footprints.sqlite')
+
+COLUMNS = ['naxis1', 'naxis2',
+           'ra_c', 'dec_c',
+           'ra1', 'dec1', 'ra2', 'dec2', 'ra3', 'dec3', 'ra4', 'dec4']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS footprints (
+    path    TEXT PRIMARY KEY,
+    size    INTEGER,
+    mtime   REAL,
+    naxis1  INTEGER,
+    naxis2  INTEGER,
+    ra_c    REAL, dec_c REAL,
+    ra1     REAL, dec1  REAL,
+    ra2     REAL, dec2  REAL,
+    ra3     REAL, dec3  REAL,
+    ra4     REAL, dec4  REAL
+)
+"""
+
+
+def default_cachefile():
+
+    """ The cache file from PROJECTDECAM_CACHE or the default location """
+
+    return os.environ.get('PROJECTDECAM_CACHE', DEFAULT_CACHE)
+
+
+def file_identity(filename):
+
+    """ The (path, size, mtime) that identify a file in the cache """
+
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    return path, st.st_size, st.st_mtime
+
+
+def read_footprint(filename, ext=0):
+
+    """
+    Read the footprint of a CCD from its header: returns a tuple with
+    (naxis1, naxis2, ra_c, dec_c, ra1, dec1, ..., ra4, dec4)
+    """
+
+    # Only needed (with despyastro) when the footprint is not cached
+    from projectDECam import projectlib_numpy
+    hdr = fitsio.read_header(filename, ext=ext)
+    ra, dec = projectlib_numpy.ccd_footprint(hdr)
+    values = [int(hdr['NAXIS1']), int(hdr['NAXIS2'])]
+    for k in range(5):
+        values.extend([float(ra[k]), float(dec[k])])
+    return tuple(values)
+
+
+class FootprintCache:
+
+    """
+    SQLite cache of CCD footprints keyed by file path, size and mtime
+    """
+
+    def __init__(self, cachefile=None, nthreads=8):
+
+        if cachefile is None:
+            cachefile = default_cachefile()
+        self.cachefile = cachefile
+        self.nthreads = nthreads
+        cachedir = os.path.dirname(self.cachefile)
+        if cachedir and not os.path.exists(cachedir):
+            os.makedirs(cachedir, exist_ok=True)
+        self.con = sqlite3.connect(self.cachefile, timeout=60)
+        self.con.execute(SCHEMA)
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def lookup(self, identities):
+
+        """ Return the cached footprints that match path, size and mtime """
+
+        found = {}
+        query = "SELECT size, mtime, %s FROM footprints WHERE path=?" % ", ".join(COLUMNS)
+        for path, size, mtime in identities:
+            row = self.con.execute(query, (path,)).fetchone()
+            if row is not None and row[0] == size and row[1] == mtime:
+                found[path] = row[2:]
+        return found
+
+    def store(self, rows):
+
+        """ Store a list of (path, size, mtime, footprint) in the cache """
+
+        query = "INSERT OR REPLACE INTO footprints VALUES (%s)" % ",".join(["?"]*(3+len(COLUMNS)))
+        self.con.executemany(query, [(path, size, mtime) + tuple(fp) for path, size, mtime, fp in rows])
+        self.con.commit()
+
+    def get_footprints(self, filenames, ext=0):
+
+        """
+        Get the footprints of a list of CCD files, reading the headers of
+        the cache misses in parallel. Returns a dictionary with the
+        arrays: naxis1, naxis2, and ra/dec with shape (nfiles, 5), center
+        first and then the four corners
+        """
+
+        t0 = time.time()
+        identities = [file_identity(f) for f in filenames]
+        found = self.lookup(identities)
+        misses = [(f, ident) for f, ident in zip(filenames, identities) if ident[0] not in found]
+
+        if misses:
+            nthreads = max(1, min(self.nthreads, len(misses)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+                footprints = list(pool.map(lambda f: read_footprint(f, ext=ext), [m[0] for m in misses]))
+            rows = []
+            for (_, ident), fp in zip(misses, footprints):
+                found[ident[0]] = fp
+                rows.append(ident + (fp,))
+            self.store(rows)
+
+        values = numpy.array([found[ident[0]] for ident in identities], dtype='f8')
+        result = {'naxis1': values[:, 0].astype(int),
+                  'naxis2': values[:, 1].astype(int),
+                  'ra': values[:, 2::2],
+                  'dec': values[:, 3::2]}
+        print(f"# Footprints for {len(filenames)} CCDs ({len(misses)} cache misses) "
+              f"in {time.time()-t0:.2f}s")
+        return result
+
+
+def get_footprints(filenames, cachefile=None, nthreads=8, use_cache=True):
+
+    """
+    Get the footprints of a list of CCD files, through the cache unless
+    use_cache is False
+    """
+
+    if not use_cache:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+            values = numpy.array(list(pool.map(read_footprint, filenames)), dtype='f8')
+        return {'naxis1': values[:, 0].astype(int),
+                'naxis2': values[:, 1].astype(int),
+                'ra': values[:, 2::2],
+                'dec': values[:, 3::2]}
+    cache = FootprintCache(cachefile=cachefile, nthreads=nthreads)
+    try:
+        return cache.get_footprints(filenames)
+    finally:
+        cache.close()
@@ -29,6 +29,12 @@
   /somedir/anotherdir/myname_ell_TN.png
   /somedir/anotherdir/myname_proj.fits
 
+ With --quicklook N the steps are replaced by a mosaic of the CCDs
+ binned by N (projectlib_quicklook), written as:
+
+   $BASENAME_quicklook.png
+   $BASENAME_quicklook_TN.png
+
  Author:
   Felipe Menanteau, NCSA, Sept-Oct 2013.
   into a class library file May/June 2014
@@ -40,21 +46,26 @@ import os
 import sys
 import time
 import math
+import subprocess
+import contextlib
 
-# Python external packages
-import fitsio
+# Python external packages. The heavy ones (matplotlib/pylab, PIL,
+# despyastro and drawDECam) are imported by the stages that use them,
+# so --dryrun, --noPNG or --noEll runs do not pay for them
 import numpy
-# ------------------------------------------
-# trick to avoid X11 crash when no display
-# Needs to be done before calling pylab
-import matplotlib
-import pylab
-from PIL import Image
-
-from despyastro import wcsutil
-from despyastro import tableio
-from drawDECam import drawDECam as draw  # to use ellipses
-matplotlib.use('Agg')
+
+from projectDECam import projectlib_stretch
+from projectDECam import projectlib_quantile
+from projectDECam import projectlib_catalogs
+from projectDECam import projectlib_pyramid
+from projectDECam import projectlib_quicklook
+from projectDECam import projectlib_api
+from projectDECam import projectlib_pngmeta
+from projectDECam import projectlib_projfile
+from projectDECam import projectlib_pngenc
+from projectDECam import projectlib_manifest
+from projectDECam import projectlib_telemetry
+from projectDECam import projectlib_runner
 
 sout = sys.stdout
 
@@ -95,26 +106,177 @@ class project_DECam_fromlist:
             print(f"# Making {self.outpath}")
             os.makedirs(self.outpath)
 
-        # SWarp the exposure
-        self.swarp_exposure(noSWarp=self.noSWarp,
-                            noBack=self.noBack,
-                            keep=self.keepfiles)
-        # Create PNGs
-        if not self.noPNG:
-            print("# Running PNG Creation")
-            self.stiff_exposure()
-            self.make_png_thumbnail()
+        # The scratch directory for SWarp's weight and resampled files,
+        # the cwd unless we are told otherwise (i.e. batch mode)
+        if not self.scratchdir:
+            self.scratchdir = os.getcwd()
+        if not os.path.exists(self.scratchdir):
+            print(f"# Making {self.scratchdir}")
+            os.makedirs(self.scratchdir)
+
+        # The manifest of the stages, to only re-run what changed
+        self.manifest = projectlib_manifest.StageManifest(f"{self.basename}_manifest.json")
+        self.build_stage_keys()
+
+        # The per-stage resource usage records
+        self.telemetry = projectlib_telemetry.Telemetry(jsonfile=self.telemetry_file,
+                                                        promfile=self.prometheus_file,
+                                                        job=os.path.basename(self.basename))
+
+        # The runner for the external tools, it can be shared between
+        # the exposures of the batch pipeline
+        if getattr(self, 'runner', None) is None:
+            self.runner = projectlib_runner.Runner()
+
+        # The batch pipeline calls run() itself
+        if not getattr(self, 'defer', False):
+            self.run()
+        return
+
+    def run(self):
+
+        """ Run the stages for the exposure """
+
+        # The quicklook mosaic replaces all of the stages
+        if self.quicklook:
+            with self.runner.slot('python'), self.telemetry.stage('quicklook', nccds=len(self.imgfiles)):
+                self.quicklook_exposure()
+            self.telemetry.close()
+            return
+
+        # SWarp the exposure, the NumPy engine counts as a Python stage
+        if self.engine == 'numpy':
+            slot = self.runner.slot('python')
         else:
-            print("# Skipping PNG Creation")
+            slot = contextlib.nullcontext()
+        with self.telemetry.stage('swarp', nccds=len(self.imgfiles)), slot:
+            self.swarp_exposure(noSWarp=self.noSWarp,
+                                noBack=self.noBack,
+                                keep=self.keepfiles)
+
+        # The Python stages, they can overlap with the SWarp of another
+        # exposure in the pipeline
+        with self.runner.slot('python'):
+            # Create PNGs
+            if not self.noPNG:
+                print("# Running PNG Creation")
+                with self.telemetry.stage('png'):
+                    self.stiff_exposure()
+                with self.telemetry.stage('TN'):
+                    self.make_png_thumbnail()
+            else:
+                print("# Skipping PNG Creation")
+
+            # Draw detection
+            if not self.noEll:
+                print("# Running Ell Creation")
+                with self.telemetry.stage('ell', ncatalogs=len(getattr(self, 'catlist', []))):
+                    self.read_exposure_catalogs_files()  # This one is diferent for SQL
+                with self.telemetry.stage('ell_TN'):
+                    self.make_ell_thumbnail()
+            else:
+                print("# Skipping Ell on PNG")
+
+        self.telemetry.close()
+        return
+
+    def run_command(self, argv, tool, timeout=None):
+
+        """
+        Run an external tool (argv list) through the runner, with its
+        log prefixed by the tool and exposure. Raises
+        subprocess.CalledProcessError/TimeoutExpired on failure
+        """
+
+        prefix = f"{tool}:{os.path.basename(self.basename)}"
+        return self.runner.run_sync(argv, tool=tool, prefix=prefix, timeout=timeout,
+                                    telemetry=self.telemetry)
 
-        # Draw detection
-        if not self.noEll:
-            print("# Running Ell Creation")
-            self.read_exposure_catalogs_files()  # This one is diferent for SQL
-            self.make_ell_thumbnail()
+    def build_stage_keys(self):
+
+        """
+        Compute the keys of the stages (swarp -> png -> TN and
+        png + catalogs -> ell -> ell_TN) from the identity of their input
+        files, their parameters and the keys of the upstream stages
+        """
+
+        keys = {}
+        params = {'pixscale': self.pixscale,
+                  'weight_thresh': self.weight_thresh,
+                  'noBack': self.noBack,
+                  'engine': self.engine}
+        # Only in the key when used, so the plain files stay current
+        if self.compress != 'none' or self.proj_weight:
+            params.update(compress=self.compress,
+                          qlevel=self.qlevel,
+                          qmethod=self.qmethod,
+                          proj_weight=self.proj_weight)
+        keys['swarp'] = projectlib_manifest.stage_key(
+            'swarp',
+            inputs=projectlib_manifest.files_hash(self.imgfiles),
+            params=params)
+        keys['quicklook'] = projectlib_manifest.stage_key(
+            'quicklook',
+            inputs=projectlib_manifest.files_hash(self.imgfiles),
+            params={'quicklook': self.quicklook,
+                    'grayscale': self.grayscale,
+                    'TNsize': self.TNsize})
+        keys['png'] = projectlib_manifest.stage_key(
+            'png',
+            upstream=[keys['swarp']],
+            params={'grayscale': self.grayscale,
+                    'stretch': self.stretch,
+                    'stream_levels': self.stream_levels})
+        keys['TN'] = projectlib_manifest.stage_key(
+            'TN',
+            upstream=[keys['png']],
+            params={'TNsize': self.TNsize,
+                    'zoom': self.zoom,
+                    'tilesize': self.tilesize})
+        if self.cataloglist:
+            catalogs = projectlib_manifest.files_hash(self.catlist)
         else:
-            print("# Skipping Ell on PNG")
+            catalogs = None
+        keys['ell'] = projectlib_manifest.stage_key(
+            'ell',
+            inputs=catalogs,
+            upstream=[keys['png']],
+            params={'ellipses': self.ellipses,
+                    'overlay': self.overlay,
+                    'min_ell_size': self.min_ell_size,
+                    'max_density': self.max_density,
+                    'density_bin': self.density_bin})
+        keys['ell_TN'] = projectlib_manifest.stage_key(
+            'ell_TN',
+            upstream=[keys['ell']],
+            params={'TNsize': self.TNsize})
+        self.stage_keys = keys
+        return
 
+    def stage_is_current(self, stage, outputs):
+
+        """
+        Check if a stage can be skipped: its outputs exist and were made
+        from the same inputs and parameters, unless we --force
+        """
+
+        if self.force:
+            return False
+        current = self.manifest.is_current(stage, self.stage_keys[stage], outputs)
+        if current:
+            self.telemetry.add(status='up-to-date')
+        return current
+
+    def stage_done(self, stage, outputs):
+
+        """ Record a stage in the manifest, if its outputs were made """
+
+        missing = [output for output in outputs if not os.path.exists(output)]
+        if missing:
+            print(f"# WARNING: stage {stage} did not create: {', '.join(missing)}")
+            self.manifest.invalidate(stage)
+            return
+        self.manifest.record(stage, self.stage_keys[stage], outputs)
         return
 
     def read_filelists(self):
@@ -128,14 +290,20 @@ class project_DECam_fromlist:
         self.scilist = []
         self.wgtlist = []
 
-        # Read in the filelist
-        print(f"# Reading image list from {self.imglist}")
-        self.imgfiles = tableio.get_str(self.imglist, cols=0)
+        # Read in the filelist, or take the list of files (i.e. from
+        # projectlib_api)
+        if isinstance(self.imglist, (list, tuple)):
+            self.imgfiles = list(self.imglist)
+        else:
+            print(f"# Reading image list from {self.imglist}")
+            self.imgfiles = read_list(self.imglist)
 
         # If we want catalogs
-        if self.cataloglist:
+        if isinstance(self.cataloglist, (list, tuple)):
+            self.catlist = sorted(self.cataloglist)
+        elif self.cataloglist:
             print(f"# Reading catalogs list from: {self.cataloglist}")
-            self.catlist = tableio.get_str(self.cataloglist, cols=0)
+            self.catlist = read_list(self.cataloglist)
             self.catlist.sort()
 
         # Sort the files
@@ -153,6 +321,10 @@ class project_DECam_fromlist:
 
         """ Project using Swarp, the files that make and exposure"""
 
+        # The in-process alternative to SWarp
+        if self.engine == 'numpy':
+            return self.numpy_exposure(noSWarp, noBack=noBack)
+
         # Search swarp in the path
         swarp_exe = "swarp"
         if not inpath(swarp_exe, verb='yes'):
@@ -162,9 +334,10 @@ class project_DECam_fromlist:
         self.scinames = ",".join(self.scilist)
         self.wgtnames = ",".join(self.wgtlist)
         self.swarp_outname = os.path.join("%s_proj.fits" % self.basename)
+        self.swarp_wgtname = os.path.join(self.scratchdir, "coadd.weight.fits")
 
-        if os.path.exists(self.swarp_outname) and not self.force:
-            print("# SWarped file already exists")
+        if self.stage_is_current('swarp', [self.swarp_outname]):
+            print("# SWarped file already exists and is up to date")
             print("# Skipping SWArped image creation")
             return
 
@@ -172,45 +345,46 @@ class project_DECam_fromlist:
         t1 = time.time()
 
         # Call SWarp with the tweaked options from the production pipeline
-        opts = ''
         # NOTE: This only work if we use eups,might want more general solution
         try:
             print("# Loading configuration via PROJECTDECAM_DIR evironment variable")
-            opts = opts + f" -c  {os.environ['PROJECTDECAM_DIR']}/etc/default.swarp"
+            opts = ['-c', f"{os.environ['PROJECTDECAM_DIR']}/etc/default.swarp"]
         except KeyError:
             sys.exit("# ERROR: could not define files via PROJECTDECAM_DIR evironment variable")
 
         #######################################################################
         # Tries to fix the backgr calculation around large bright objects/stars
-        opts = opts + ' -BACK_SIZE 128'
-        opts = opts + ' -BACK_FILTERSIZE 7'
+        opts += ['-BACK_SIZE', '128']
+        opts += ['-BACK_FILTERSIZE', '7']
         #######################################################################
-        opts = opts + ' -WEIGHT_TYPE MAP_WEIGHT'
+        opts += ['-WEIGHT_TYPE', 'MAP_WEIGHT']
         # Only if we want it
         if self.weight_thresh:
-            opts = opts + ' -WEIGHT_THRESH %s' % self.weight_thresh
-        opts = opts + ' -WEIGHT_IMAGE %s' % self.wgtnames
-        opts = opts + ' -BLANK_BADPIXELS Y'
-        opts = opts + ' -FSCALASTRO_TYPE VARIABLE'
+            opts += ['-WEIGHT_THRESH', f"{self.weight_thresh}"]
+        opts += ['-WEIGHT_IMAGE', self.wgtnames]
+        opts += ['-BLANK_BADPIXELS', 'Y']
+        opts += ['-FSCALASTRO_TYPE', 'VARIABLE']
         if noBack:
-            opts = opts + ' -SUBTRACT_BACK N'
+            opts += ['-SUBTRACT_BACK', 'N']
         else:
-            opts = opts + ' -SUBTRACT_BACK Y'
-        opts = opts + ' -RESAMPLING_TYPE NEAREST'  # Much faster than LANCZOS3!
-        opts = opts + ' -COMBINE Y'
-        opts = opts + ' -COMBINE_TYPE WEIGHTED'
+            opts += ['-SUBTRACT_BACK', 'Y']
+        opts += ['-RESAMPLING_TYPE', 'NEAREST']  # Much faster than LANCZOS3!
+        opts += ['-COMBINE', 'Y']
+        opts += ['-COMBINE_TYPE', 'WEIGHTED']
         if keep:
-            opts = opts + ' -DELETE_TMPFILES N'
-            opts = opts + ' -RESAMPLE_DIR %s' % self.outdir
+            opts += ['-DELETE_TMPFILES', 'N']
+            opts += ['-RESAMPLE_DIR', self.outpath]
         else:
-            opts = opts + ' -DELETE_TMPFILES Y'
-        opts = opts + ' -WRITE_XML   N'
-        opts = opts + ' -HEADER_ONLY N'
-        opts = opts + ' -VERBOSE_TYPE FULL'
-        opts = opts + ' -PIXELSCALE_TYPE MANUAL'
-        opts = opts + ' -PIXEL_SCALE %s' % self.pixscale
-        opts = opts + ' -NTHREADS %d' % self.NTHREADS_swarp
-        opts = opts + ' -IMAGEOUT_NAME %s' % self.swarp_outname
+            opts += ['-DELETE_TMPFILES', 'Y']
+            opts += ['-RESAMPLE_DIR', self.scratchdir]
+        opts += ['-WRITE_XML', 'N']
+        opts += ['-HEADER_ONLY', 'N']
+        opts += ['-VERBOSE_TYPE', 'FULL']
+        opts += ['-PIXELSCALE_TYPE', 'MANUAL']
+        opts += ['-PIXEL_SCALE', f"{self.pixscale}"]
+        opts += ['-NTHREADS', f"{self.NTHREADS_swarp}"]
+        opts += ['-IMAGEOUT_NAME', self.swarp_outname]
+        opts += ['-WEIGHTOUT_NAME', self.swarp_wgtname]
 
         #######################################################################
         # Extra option in case we cross RA=0 and need to perform
@@ -221,16 +395,23 @@ class project_DECam_fromlist:
         if self.crossRA:
             print("# Manualy centering exposure...")
             self.get_exposure_imsize_center()
-            opts = opts + ' -CENTER_TYPE MANUAL'
-            opts = opts + ' -CENTER  \"%s, %s\"' % (self.RA0, self.DEC0)
-            opts = opts + ' -IMAGE_SIZE %s,%s' % (self.NX, self.NY)
+            opts += ['-CENTER_TYPE', 'MANUAL']
+            opts += ['-CENTER', f"{self.RA0}, {self.DEC0}"]
+            opts += ['-IMAGE_SIZE', f"{self.NX},{self.NY}"]
 
-        swarp_cmd = "%s %s %s" % (swarp_exe, self.scinames, opts)
+        swarp_cmd = [swarp_exe, self.scinames] + opts
 
         if noSWarp:
             print("noSWarp invoked -- Skipping SWArp")
         else:
-            os.system(swarp_cmd)
+            try:
+                self.run_command(swarp_cmd, tool='swarp', timeout=self.timeout_swarp)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as err:
+                self.manifest.invalidate('swarp')
+                self.clean_up_weight()
+                sys.exit(f"# ERROR: SWarp failed for {self.basename}: {err}")
+            self.compress_swarp_outputs(keep=keep)
+            self.stage_done('swarp', [self.swarp_outname])
         print(f"SWarp time {elapsed_time(t1)}")
 
         # Clean up
@@ -238,10 +419,80 @@ class project_DECam_fromlist:
 
         return
 
+    def compress_swarp_outputs(self, keep=False):
+
+        """
+        Store the SWarped image as asked by --compress/--proj_weight and
+        compress the resampled CCDs we --keepfiles
+        """
+
+        if self.compress == 'none' and not self.proj_weight:
+            return
+        t0 = time.time()
+        projectlib_projfile.compress_file(self.swarp_outname,
+                                          weightfile=self.swarp_wgtname if self.proj_weight else None,
+                                          compress=self.compress,
+                                          qlevel=self.qlevel,
+                                          qmethod=self.qmethod)
+        if keep and self.compress != 'none':
+            # SWarp names them after the inputs in the RESAMPLE_DIR
+            for fname in self.imgfiles:
+                root = os.path.join(self.outpath, os.path.basename(fname).replace('.fits', ''))
+                for resampled in (f"{root}.resamp.fits", f"{root}.resamp.weight.fits"):
+                    if os.path.exists(resampled):
+                        projectlib_projfile.compress_file(resampled, compress=self.compress,
+                                                          qlevel=self.qlevel, qmethod=self.qmethod)
+        print(f"# Compression time: {elapsed_time(t0)}")
+        return
+
+    def numpy_exposure(self, noSWarp, noBack=False):
+
+        """
+        Project the files that make an exposure using the native NumPy
+        engine instead of SWarp. Keeps the projected array and header
+        in memory (self.proj_array, self.proj_header) for the PNG stage
+        """
+
+        self.swarp_outname = os.path.join("%s_proj.fits" % self.basename)
+        if self.stage_is_current('swarp', [self.swarp_outname]):
+            print("# Projected file already exists and is up to date")
+            print("# Skipping NumPy projected image creation")
+            return
+
+        # The same sanity check of the CCD centers as for SWarp, it also
+        # gets the footprints (self.footprints) for the projection
+        self.cross_RA_zero_center()
+
+        if noSWarp:
+            print("noSWarp invoked -- Skipping NumPy projection")
+            return
+
+        from projectDECam import projectlib_numpy
+        t1 = time.time()
+        self.proj_array, weight, self.proj_header = projectlib_numpy.project_exposure(
+            self.imgfiles,
+            footprints=self.footprints,
+            pixscale=self.pixscale,
+            weight_thresh=self.weight_thresh,
+            noBack=noBack,
+            input_pixscale=self.INPUT_PIXEL_SCALE)
+        projectlib_projfile.write_image(self.swarp_outname, self.proj_array, self.proj_header,
+                                        weight=weight if self.proj_weight else None,
+                                        compress=self.compress,
+                                        qlevel=self.qlevel,
+                                        qmethod=self.qmethod)
+        self.stage_done('swarp', [self.swarp_outname])
+        print(f"NumPy projection time {elapsed_time(t1)}")
+        return
+
     def stiff_exposure(self):
 
         """ Stiff a DECam exposure and create a png of it """
 
+        # The in-process alternative to stiff+PIL
+        if self.stretch == 'numpy':
+            return self.numpy_stretch_exposure()
+
         stiff_exe = 'stiff'
         if not inpath(stiff_exe, verb='yes'):
             sys.exit("try:\nsetup stiff 2.1.3+0\n")
@@ -249,56 +500,165 @@ class project_DECam_fromlist:
         self.pngfile = f"{self.basename}.png"
         self.tiffile = f"{self.basename}.tif"
 
-        if os.path.exists(self.pngfile) and not self.force:
-            print(f"# PNG for file %s already exists {self.basename}")
-            print(f"# Skipping PNG creation")
+        if self.stage_is_current('png', [self.pngfile]):
+            print(f"# PNG for file {self.basename} already exists and is up to date")
+            print("# Skipping PNG creation")
             return
 
         # Very Explicit Call to stiff
-        opts = ''
-
         # NOTE: This only work if we use eups might want more general solution
         try:
             print("# Loading configuration via PROJECTDECAM_DIR evironment variable")
-            opts = opts + f" -c  {os.environ['PROJECTDECAM_DIR']}/etc/default.stiff"
+            opts = ['-c', f"{os.environ['PROJECTDECAM_DIR']}/etc/default.stiff"]
         except KeyError:
             sys.exit("# ERROR: could not define files via PROJECTDECAM_DIR evironment variable")
 
-        opts = opts + " -IMAGE_TYPE   TIFF"        # Output image format
-        opts = opts + " -COMPRESSION_TYPE JPEG"     # Compression type
-        opts = opts + " -BINNING      1"           # Binning factor for the data
-        opts = opts + " -GAMMA        2.2"         # Display gamma
-        opts = opts + " -GAMMA_FAC    1.0"         # Luminance gamma correction factor
-        opts = opts + " -COLOUR_SAT   1.0"         # Colour saturation (0.0 = B&W)
-        opts = opts + " -NEGATIVE     N"           # Make negative of the image
-        opts = opts + " -SKY_TYPE     AUTO"        # Sky-level: "AUTO" or "MANUAL"
-        opts = opts + " -SKY_LEVEL    0.0"         # Background level for each image
-        opts = opts + " -MIN_TYPE     GREYLEVEL"   # Min-level: "QUANTILE", "MANUAL" or "GREYLEVEL"
-        opts = opts + " -MIN_LEVEL    0.005"       # Minimum value or quantile
-        opts = opts + " -MAX_TYPE     QUANTILE"    # Max-level: "QUANTILE" or "MANUAL"
-        opts = opts + " -MAX_LEVEL    {}".format(self.grayscale)  # Maximum value or quantile
-        opts = opts + " -SATUR_LEVEL  40000.0"     # FITS data saturation level(s)
-        opts = opts + " -WRITE_XML    N"           # Write XML file (Y/N)?
-        opts = opts + " -COPYRIGHT    DES/NCSA"    # Copyright
-        opts = opts + " -COPY_HEADER  Y"           # Copy FITS header to description field?
-        opts = opts + ' -NTHREADS {}'.format(self.NTHREADS_stiff)  # Number of simultaneous threads
-        opts = opts + " -OUTFILE_NAME %s" % self.tiffile
-        stiff_cmd = "%s %s %s" % (stiff_exe, self.swarp_outname, opts)
+        opts += ["-IMAGE_TYPE", "TIFF"]        # Output image format
+        opts += ["-COMPRESSION_TYPE", "JPEG"]  # Compression type
+        opts += ["-BINNING", "1"]              # Binning factor for the data
+        opts += ["-GAMMA", "2.2"]              # Display gamma
+        opts += ["-GAMMA_FAC", "1.0"]          # Luminance gamma correction factor
+        opts += ["-COLOUR_SAT", "1.0"]         # Colour saturation (0.0 = B&W)
+        opts += ["-NEGATIVE", "N"]             # Make negative of the image
+        if self.stream_levels:
+            # Streaming quantiles, stiff does not need to hold the histogram
+            ext = projectlib_projfile.image_ext(self.swarp_outname)
+            sketch = projectlib_quantile.sketch_file(self.swarp_outname, ext=ext, satur_level=40000.0)
+            opts += ["-SKY_TYPE", "MANUAL"]
+            opts += ["-SKY_LEVEL", f"{sketch.median()}"]
+        else:
+            opts += ["-SKY_TYPE", "AUTO"]      # Sky-level: "AUTO" or "MANUAL"
+            opts += ["-SKY_LEVEL", "0.0"]      # Background level for each image
+        opts += ["-MIN_TYPE", "GREYLEVEL"]     # Min-level: "QUANTILE", "MANUAL" or "GREYLEVEL"
+        opts += ["-MIN_LEVEL", "0.005"]        # Minimum value or quantile
+        if self.stream_levels:
+            opts += ["-MAX_TYPE", "MANUAL"]
+            opts += ["-MAX_LEVEL", f"{sketch.quantile(self.grayscale)}"]
+        else:
+            opts += ["-MAX_TYPE", "QUANTILE"]  # Max-level: "QUANTILE" or "MANUAL"
+            opts += ["-MAX_LEVEL", f"{self.grayscale}"]  # Maximum value or quantile
+        opts += ["-SATUR_LEVEL", "40000.0"]    # FITS data saturation level(s)
+        opts += ["-WRITE_XML", "N"]            # Write XML file (Y/N)?
+        opts += ["-COPYRIGHT", "DES/NCSA"]     # Copyright
+        opts += ["-COPY_HEADER", "Y"]          # Copy FITS header to description field?
+        opts += ["-NTHREADS", f"{self.NTHREADS_stiff}"]  # Number of simultaneous threads
+        opts += ["-OUTFILE_NAME", self.tiffile]
+
+        # stiff only reads plain images, give it a decompressed copy
+        stiff_input = self.swarp_outname
+        if projectlib_projfile.is_compressed(self.swarp_outname):
+            stiff_input = os.path.join(self.scratchdir, f"{os.path.basename(self.basename)}_stiff.fits")
+            projectlib_projfile.uncompress_file(self.swarp_outname, stiff_input)
+        stiff_cmd = [stiff_exe, stiff_input] + opts
 
         t0 = time.time()
-        print(stiff_cmd)
-        os.system(stiff_cmd)
+        try:
+            self.run_command(stiff_cmd, tool='stiff', timeout=self.timeout_stiff)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as err:
+            self.manifest.invalidate('png')
+            sys.exit(f"# ERROR: stiff failed for {self.basename}: {err}")
+        finally:
+            if stiff_input != self.swarp_outname and os.path.exists(stiff_input):
+                os.remove(stiff_input)
         print(f"# stiff time: {elapsed_time(t0)}")
 
-        # Create PNG using PIL/Image
+        # Create PNG with the multi-threaded encoder
+        from PIL import Image
         t1 = time.time()
-        im = Image.open(self.tiffile)
-        im.save(self.pngfile, "png", options='optimize')
-        print(f"# PIL time: {elapsed_time(t1)}")
+        with Image.open(self.tiffile) as im:
+            self.write_png(self.pngfile, numpy.asarray(im))
+        print(f"# PNG time: {elapsed_time(t1)}")
+        self.add_png_wcs(self.pngfile)
 
         # Clean up the tiff file
         print(f"# Cleaning tiff: {self.tiffile}")
         os.remove(self.tiffile)
+        self.stage_done('png', [self.pngfile])
+        return
+
+    def quicklook_exposure(self):
+
+        """
+        Write the quicklook mosaic of the CCDs binned by --quicklook,
+        placed with the DECam focal-plane layout, and its thumbnail
+        """
+
+        self.pngfile_ql = f"{self.basename}_quicklook.png"
+        self.TN_ql = f"{self.basename}_quicklook_TN.png"
+        if self.stage_is_current('quicklook', [self.pngfile_ql, self.TN_ql]):
+            print(f"# Quicklook for {self.basename} already exists and is up to date -- Skipping")
+            return
+
+        t0 = time.time()
+        projectlib_quicklook.write_quicklook(self.imgfiles, self.pngfile_ql,
+                                             TN_png=self.TN_ql,
+                                             TNsize=self.TNsize,
+                                             nbin=self.quicklook,
+                                             max_level=self.grayscale,
+                                             nthreads=self.NTHREADS_quicklook,
+                                             compress_level=self.png_level,
+                                             png_filter=self.png_filter,
+                                             nthreads_png=self.NTHREADS_png or None)
+        print(f"# Quicklook time: {elapsed_time(t0)}")
+        self.stage_done('quicklook', [self.pngfile_ql, self.TN_ql])
+        return
+
+    def numpy_stretch_exposure(self):
+
+        """
+        Stretch the projected exposure in NumPy with the same settings
+        we use for stiff and write the PNG directly, no TIFF round-trip
+        """
+
+        self.pngfile = f"{self.basename}.png"
+        if self.stage_is_current('png', [self.pngfile]):
+            print(f"# PNG for file {self.basename} already exists and is up to date")
+            print("# Skipping PNG creation")
+            return
+
+        t0 = time.time()
+        # Use the projected array if we have in memory, otherwise
+        # stream the file in strips
+        if getattr(self, 'proj_array', None) is not None:
+            self.png_array8 = projectlib_stretch.stretch_image(self.proj_array, max_level=self.grayscale)
+        else:
+            print(f"# Streaming {self.swarp_outname}")
+            ext = projectlib_projfile.image_ext(self.swarp_outname)
+            self.png_array8 = projectlib_stretch.stretch_file(self.swarp_outname, ext=ext,
+                                                              max_level=self.grayscale)
+        print(f"# NumPy stretch time: {elapsed_time(t0)}")
+
+        t1 = time.time()
+        self.write_png(self.pngfile, self.png_array8)
+        print(f"# PNG write time: {elapsed_time(t1)}")
+        self.add_png_wcs(self.pngfile)
+        self.stage_done('png', [self.pngfile])
+        return
+
+    def write_png(self, filename, array8):
+
+        """ Write a PNG with the encoder options (--png_level/--png_filter/--NTHREADS_png) """
+
+        projectlib_stretch.write_png(filename, array8,
+                                     compress_level=self.png_level,
+                                     png_filter=self.png_filter,
+                                     nthreads=self.NTHREADS_png or None)
+        return
+
+    def add_png_wcs(self, pngfile):
+
+        """
+        Tag a PNG (on the grid of the projected image) with the WCS of
+        _proj.fits, writing only its text chunks
+        """
+
+        header = getattr(self, 'proj_header', None)
+        if header is None:
+            if not os.path.exists(self.swarp_outname):
+                print(f"# No {self.swarp_outname} -- Skipping WCS for {pngfile}")
+                return
+            header = projectlib_projfile.read_header(self.swarp_outname)
+        projectlib_pngmeta.add_wcs(pngfile, header)
         return
 
     def read_exposure_catalogs_files(self):
@@ -308,20 +668,78 @@ class project_DECam_fromlist:
         # Define the output name
         self.pngfile_ell = f"{self.basename}_ell.png"
 
-        if os.path.exists(self.pngfile_ell) and not self.force:
-            print("# PNG/Ell file already exists")
+        if self.stage_is_current('ell', [self.pngfile_ell]):
+            print("# PNG/Ell file already exists and is up to date")
             print("# Skipping PNG/Ell creation")
             return
 
+        # Read the catalogs first, the figure is not needed for that
         t0 = time.time()
-        print(f"# Reading {self.pngfile}")
-
-        image = Image.open(self.pngfile).convert("L")
-        self.png_array = numpy.asarray(image)
-        self.png_array = self.png_array[::-1, :]
-        print(f"# Shape (ny,nx): {self.png_array.shape}")
+        if self.cat_cache:
+            cachefile = f"{self.basename}_cat.npy"
+        else:
+            cachefile = None
+        cat = projectlib_catalogs.read_catalogs(self.catlist,
+                                                nthreads=self.NTHREADS_cat,
+                                                cachefile=cachefile,
+                                                force=self.force)
+        self.telemetry.add(nobjects=len(cat))
+
+        print(f"# Read {len(self.catlist)} SEx catalogs in time: {elapsed_time(t0)}")
+        # Now let's put the positions on the projected image, with the
+        # header in memory if we made it in this run
+        hdr = getattr(self, 'proj_header', None)
+        if hdr is None:
+            hdr = projectlib_projfile.read_header(self.swarp_outname)
+        shapes = projectlib_api.catalog_shapes(cat, hdr)
+        x, y, a_image, b_image, theta, imaflag_iso = shapes
+
+        # The 8-bit image, from memory if we made it in this run
+        t0 = time.time()
+        if getattr(self, 'png_array8', None) is not None:
+            gray = self.png_array8
+        else:
+            from PIL import Image
+            print(f"# Reading {self.pngfile}")
+            gray = numpy.asarray(Image.open(self.pngfile).convert("L"))
+        print(f"# Shape (ny,nx): {gray.shape}")
         print(f"# Done in {time.time()-t0} sec.")
 
+        t1 = time.time()
+        print(f"# Drawing ellipses for {len(x)} objects")
+        if self.ellipses == 'pylab':
+            self.draw_ellipses_pylab(gray, x, y, a_image, b_image, theta, imaflag_iso)
+        else:
+            # Drawing imaflags > 0 blue and the rest 'red', every ellipse
+            # or level-of-detail (--overlay)
+            self.ell_array = projectlib_api.render(gray, shapes,
+                                                   mode=self.overlay,
+                                                   pixscale=self.pixscale,
+                                                   min_ell_size=self.min_ell_size,
+                                                   max_density=self.max_density,
+                                                   density_bin=self.density_bin,
+                                                   nthreads=self.NTHREADS_ell)
+            print(f"# Ellipses draw time: {elapsed_time(t1)}")
+            print("# Saving PNG file with ellipses")
+            self.write_png(self.pngfile_ell, self.ell_array)
+            self.add_png_wcs(self.pngfile_ell)
+            print("# Done")
+        self.stage_done('ell', [self.pngfile_ell])
+        return
+
+    def draw_ellipses_pylab(self, gray, x, y, a_image, b_image, theta, imaflag_iso):
+
+        """ Draw the ellipses with matplotlib/drawDECam and save the PNG """
+
+        # trick to avoid X11 crash when no display
+        # Needs to be done before calling pylab
+        import matplotlib
+        matplotlib.use('Agg')
+        import pylab
+        from drawDECam import drawDECam as draw  # to use ellipses
+
+        self.png_array = gray[::-1, :]
+
         # Figure out the size
         dpi = 90.
         (self.ny, self.nx) = self.png_array.shape
@@ -335,40 +753,8 @@ class project_DECam_fromlist:
         ec_ima2 = 'blue'
         pylab.axis('off')
 
-        i = 0
-        t0 = time.time()
-
-        for catfile in self.catlist:
-            print(f"# Reading {catfile}")
-            tbdata = fitsio.read(catfile, ext=2)
-            # Store the Relevant information to draw ellipse
-            if i == 0:
-                ra = tbdata['ALPHA_J2000']
-                dec = tbdata['DELTA_J2000']
-                a_image = tbdata['A_IMAGE']*tbdata['KRON_RADIUS']
-                b_image = tbdata['B_IMAGE']*tbdata['KRON_RADIUS']
-                theta = tbdata['THETA_IMAGE']
-                imaflag_iso = tbdata['IMAFLAGS_ISO']
-
-            else:
-                ra = numpy.append(ra, tbdata['ALPHA_J2000'])
-                dec = numpy.append(dec, tbdata['DELTA_J2000'])
-                a_image = numpy.append(a_image, tbdata['A_IMAGE']*tbdata['KRON_RADIUS'])
-                b_image = numpy.append(b_image, tbdata['B_IMAGE']*tbdata['KRON_RADIUS'])
-                theta = numpy.append(theta, tbdata['THETA_IMAGE'])
-                imaflag_iso = numpy.append(imaflag_iso, tbdata['IMAFLAGS_ISO'])
-
-            i = i+1
-
-        print(f"# Read {i} SEx catalogs in time: {elapsed_time(t0)}")
-        # Now let's put the positions on the projected image
-        hdr = fitsio.read_header(self.swarp_outname)
-        wcs = wcsutil.WCS(hdr)
-        x, y = wcs.sky2image(ra, dec)
-
         # Draw all at once -- faster
         t1 = time.time()
-        print(f"# Drawing ellipses for {len(x)} objects")
 
         # Drawing imaflags > 0 blue and the rest 'red'
         idx1 = numpy.where(imaflag_iso == 0)
@@ -376,14 +762,14 @@ class project_DECam_fromlist:
         draw.PEllipse_multi((x[idx1], y[idx1]),
                             (a_image[idx1], b_image[idx1]),
                             resolution=60,
-                            angle=theta,
+                            angle=theta[idx1],
                             facecolor='none',
                             edgecolor=ec_ima1,
                             linewidth=0.5)
         draw.PEllipse_multi((x[idx2], y[idx2]),
                             (a_image[idx2], b_image[idx2]),
                             resolution=60,
-                            angle=theta,
+                            angle=theta[idx2],
                             facecolor='none',
                             edgecolor=ec_ima2,
                             linewidth=0.5)
@@ -399,15 +785,20 @@ class project_DECam_fromlist:
         """ Make the thumbnail of the PNG for the webpages"""
 
         self.TN_png = "%s_TN.png" % self.basename
-        if os.path.exists(self.TN_png) and not self.force:
-            print(f"# File exists -- Skipping creation of {self.TN_png}")
+        if self.stage_is_current('TN', [self.TN_png]):
+            print(f"# File exists and is up to date -- Skipping creation of {self.TN_png}")
         else:
             print(f"# Creating TN {self.TN_png}")
-            im = Image.open(self.pngfile)
-            (w, h) = im.size  # Get width (w) and height (h)
-            TNshape = self.TNsize, int(self.TNsize*h/w)
-            im.thumbnail(TNshape, Image.ANTIALIAS)
-            im.save(self.TN_png, "png", options='optimize')
+            # Use the 8-bit array in memory, or decode the PNG only once
+            if getattr(self, 'png_array8', None) is None:
+                from PIL import Image
+                self.png_array8 = numpy.asarray(Image.open(self.pngfile).convert("L"))
+            projectlib_pyramid.build_pyramid(self.png_array8, self.basename,
+                                             TNsize=self.TNsize,
+                                             TN_png=self.TN_png,
+                                             zoom=self.zoom,
+                                             tilesize=self.tilesize)
+            self.stage_done('TN', [self.TN_png])
         return
 
     def make_ell_thumbnail(self):
@@ -415,15 +806,17 @@ class project_DECam_fromlist:
         """ Make TN for the PNG with ellipses"""
 
         self.TN_ell = '%s_ell_TN.png' % self.basename
-        if os.path.exists(self.TN_ell) and not self.force:
-            print(f"# File exists -- Skipping creation of {self.TN_ell}")
+        if self.stage_is_current('ell_TN', [self.TN_ell]):
+            print(f"# File exists and is up to date -- Skipping creation of {self.TN_ell}")
         else:
             print(f"# Creating TN {self.TN_ell}")
-            im = Image.open(self.pngfile_ell)
-            (w, h) = im.size  # Get width (w) and height (h)
-            TNshape = self.TNsize, int(self.TNsize*h/w)
-            im.thumbnail(TNshape, Image.ANTIALIAS)
-            im.save(self.TN_ell, "png", options='optimize')
+            if getattr(self, 'ell_array', None) is not None:
+                ell_array = self.ell_array
+            else:
+                from PIL import Image
+                ell_array = numpy.asarray(Image.open(self.pngfile_ell).convert("RGB"))
+            projectlib_pyramid.write_thumbnail(ell_array, self.TN_ell, self.TNsize)
+            self.stage_done('ell_TN', [self.TN_ell])
         return
 
     def cross_RA_zero_center(self):
@@ -432,7 +825,8 @@ class project_DECam_fromlist:
         Check if crossing the RA=0.0 by the min and max
         values for the centers of all CCDs. We loop over all of the
         wcs of the images... slower (a few secs) but safer in case
-        some CCDs are missing.
+        some CCDs are missing. The centers are kept in the footprint
+        cache, so re-runs do not need to read the headers again.
         """
 
         d2r = math.pi/180.  # degrees to radians shorthand
@@ -441,20 +835,13 @@ class project_DECam_fromlist:
         # Collect the centers of all CCDS first and store to compare later
         # Slowers than asking for particular CCDs, but safer
         print("# Figuring out edges of CCDs")
+        from projectDECam import projectlib_footprint
         t0 = time.time()
-        ra0 = []
-        dec0 = []
-        for filename in self.imgfiles:
-            hdr = fitsio.read_header(filename)
-            wcs = wcsutil.WCS(hdr)
-            nx = hdr['NAXIS1']
-            ny = hdr['NAXIS2']
-            ra, dec = wcs.image2sky(nx/2.0, ny/2.0)
-            ra0.append(ra)
-            dec0.append(dec)
-
-        self.ra0 = numpy.array(ra0)
-        self.dec0 = numpy.array(dec0)
+        self.footprints = projectlib_footprint.get_footprints(self.imgfiles,
+                                                              cachefile=self.footprint_cache,
+                                                              use_cache=not self.nocache)
+        self.ra0 = self.footprints['ra'][:, 0].copy()
+        self.dec0 = self.footprints['dec'][:, 0].copy()
 
         # Get min and max values
         dec1 = self.dec0.min()
@@ -532,7 +919,7 @@ class project_DECam_fromlist:
     def clean_up_weight(self):
 
         """ Clean up the weight.fits image created by swarp"""
-        wgt = "coadd.weight.fits"
+        wgt = self.swarp_wgtname
         if os.path.exists(wgt):
             print(f"# Cleaning up: {wgt}")
             os.remove(wgt)
@@ -560,45 +947,59 @@ def elapsed_time(t1, verb=False):
     return stime
 
 
+def read_list(filename):
+    """
+    Read the first column of a list file (i.e. the imglist/catlist),
+    skipping empty lines and comments
+    """
+    names = []
+    with open(filename) as fobj:
+        for line in fobj:
+            vals = line.split()
+            if vals and not vals[0].startswith('#'):
+                names.append(vals[0])
+    return names
+
+
+# The programs found in $PATH, by (program, $PATH)
+_WHICH = {}
+
+
+def which(program, path):
+    """
+    The full path of program in the path (a $PATH string) or None. The
+    programs found are cached, so a long-running service only probes
+    $PATH once
+    """
+    if (program, path) in _WHICH:
+        return _WHICH[program, path]
+    for dirname in path.split(':'):
+        if os.path.exists(os.path.join(dirname, program)):
+            _WHICH[program, path] = os.path.join(dirname, program)
+            return _WHICH[program, path]
+    return None
+
+
 # Check if executable is in path of user
 def inpath(program, verb=None):
     """ Checks if program is in the user's path """
-    import os.path
-    for path in os.environ['PATH'].split(':'):
-        if os.path.exists(os.path.join(path, program)):
-            if verb:
-                print(f"# program: {program} found in: {os.path.join(path, program)}")
-            return 1
+    fullpath = which(program, os.environ['PATH'])
+    if fullpath:
+        if verb:
+            print(f"# program: {program} found in: {fullpath}")
+        return 1
     if verb:
         print(f"# program: {program} NOT found in user's path")
     return 0
 
 
-def cmdline():
-
-    """ Parse the command line arguments and options using argparse"""
+def add_options(parser):
 
-    import argparse
-
-    USAGE = "\n"
-    USAGE = USAGE + "  %(prog)s <imglist> <basename> [options] \n"
-    USAGE = USAGE + "  i.e.: \n"
-    USAGE = USAGE + "  %(prog)s file-with-list-of-images /someplace/anotherplace/somename\n"
+    """
+    Add the per-exposure options shared by projectDECamPNG and the
+    batch mode to an argparse parser
+    """
 
-    epilog = "Author: Felipe Menanteau, NCSA/University of Illinois (felipe@illinois.edu)"
-    description = "Projects a DECam exposure using SWarp and creates grayscale PNGs" \
-                  "using Python's native PIL/Image module"
-    parser = argparse.ArgumentParser(usage=USAGE,
-                                     epilog=epilog,
-                                     description=description,
-                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    # The positional arguments
-    parser.add_argument("imglist", default=None,
-                        help="Image list to project")
-    parser.add_argument("basename", action="store",
-                        help="Output Directory w/BASENAME")
-    parser.add_argument("--catlist", dest='cataloglist',
-                        help="List of catalogs")
     parser.add_argument("--noPNG", action="store_true", default=False,
                         help="Skip creation of PNG files")
     parser.add_argument("--noEll", action="store_true", default=False,
@@ -614,7 +1015,7 @@ def cmdline():
     parser.add_argument("--weight_thresh", action="store", default=None,
                         help="SWarps WEIGHT_THRESH value")
     parser.add_argument("--force", action="store_true", default=False,
-                        help="Forces the re-creation of existing files")
+                        help="Forces the re-creation of existing files, even if up to date")
     parser.add_argument("--dryrun", action="store_true", default=False,
                         help="Dry Run -- only build the lists")
     parser.add_argument("--keepfiles", action="store_true", default=False,
@@ -625,8 +1026,86 @@ def cmdline():
                         help="NTHREADS for SWarp [0=auto]")
     parser.add_argument("--NTHREADS_stiff", type=int, default=0,
                         help="NTHREADS for stiff [0=auto]")
+    parser.add_argument("--engine", action="store", default='swarp',
+                        choices=['swarp', 'numpy'],
+                        help="Projection engine: SWarp or the in-process NumPy (for previews)")
+    parser.add_argument("--stretch", action="store", default='stiff',
+                        choices=['stiff', 'numpy'],
+                        help="PNG stretch: stiff+PIL or the in-process NumPy")
+    parser.add_argument("--stream_levels", action="store_true", default=False,
+                        help="Compute the stiff sky/max levels with the streaming quantile estimator")
+    parser.add_argument("--png_level", type=int, default=6, choices=range(10),
+                        help="zlib compression level of the PNGs [0-9]")
+    parser.add_argument("--png_filter", action="store", default=projectlib_pngenc.DEFAULT_FILTER,
+                        choices=list(projectlib_pngenc.FILTERS) + ['adaptive'],
+                        help="PNG row filter")
+    parser.add_argument("--NTHREADS_png", type=int, default=0,
+                        help="Number of threads for the PNG encoder [0=auto]")
+    parser.add_argument("--NTHREADS_cat", type=int, default=8,
+                        help="Number of threads to read the SEx catalogs")
+    parser.add_argument("--cat_cache", action="store_true", default=False,
+                        help="Cache the exposure catalogs as BASENAME_cat.npy")
+    parser.add_argument("--ellipses", action="store", default='raster',
+                        choices=['raster', 'pylab'],
+                        help="Ellipse renderer: direct raster or matplotlib/drawDECam")
+    parser.add_argument("--NTHREADS_ell", type=int, default=1,
+                        help="Number of threads (row bands) for the raster ellipses")
+    parser.add_argument("--overlay", action="store", default='full',
+                        choices=['full', 'lod'],
+                        help="Overlay mode: every ellipse or level-of-detail (ellipses for "
+                        "resolved sources, density/flag-fraction layer for the rest)")
+    parser.add_argument("--min_ell_size", type=float, default=1.5,
+                        help="LOD overlay: min projected A_IMAGE*KRON_RADIUS [pixels] to draw an ellipse")
+    parser.add_argument("--max_density", type=float, default=0.25,
+                        help="LOD overlay: objects per output pixel above which a region is drawn as density")
+    parser.add_argument("--density_bin", type=int, default=4,
+                        help="LOD overlay: size of the density cells [pixels]")
+    parser.add_argument("--zoom", action="store_true", default=False,
+                        help="Also write Deep Zoom (DZI) tiles of the PNG for the web viewer")
+    parser.add_argument("--tilesize", type=int, default=256,
+                        help="Size of the Deep Zoom tiles [pixels]")
+    parser.add_argument("--compress", action="store", default='none',
+                        choices=projectlib_projfile.COMPRESS,
+                        help="Tile compression of BASENAME_proj.fits (and of the resampled CCDs "
+                        "with --keepfiles)")
+    parser.add_argument("--qlevel", type=float, default=projectlib_projfile.DEFAULT_QLEVEL,
+                        help="Quantization level of the compressed floats [noise/step, 0=lossless, gzip/gzip_2 only]")
+    parser.add_argument("--qmethod", action="store", default='dither2',
+                        choices=list(projectlib_projfile.QMETHODS),
+                        help="Dithering of the quantization")
+    parser.add_argument("--proj_weight", action="store_true", default=False,
+                        help="Keep the weight of the projection as the WGT HDU of BASENAME_proj.fits")
+    parser.add_argument("--quicklook", type=int, default=0, metavar='N',
+                        help="Quicklook mosaic: bin the CCDs by N and place them with the DECam "
+                        "focal-plane layout, no projection [0=off]")
+    parser.add_argument("--NTHREADS_quicklook", type=int, default=8,
+                        help="Number of threads to read the CCDs for the quicklook")
+    parser.add_argument("--footprint_cache", action="store", default=None,
+                        help="SQLite cache of CCD footprints [default=$PROJECTDECAM_CACHE or ~/.cache/projectDECam]")
+    parser.add_argument("--nocache", action="store_true", default=False,
+                        help="Do not use the CCD footprint cache")
+    parser.add_argument("--scratchdir", action="store", default=None,
+                        help="Directory for SWarp weight/temporary files [default=cwd]")
+    parser.add_argument("--telemetry", dest='telemetry_file', action="store", default=None,
+                        help="Append per-stage timing/CPU/memory/IO records to this JSON-lines file")
+    parser.add_argument("--prometheus", dest='prometheus_file', action="store", default=None,
+                        help="Write the per-stage metrics as a Prometheus textfile")
+    parser.add_argument("--timeout_swarp", type=float, default=None,
+                        help="Kill SWarp after this many seconds")
+    parser.add_argument("--timeout_stiff", type=float, default=None,
+                        help="Kill stiff after this many seconds")
+    return parser
+
+
+def check_options(args):
 
-    args = parser.parse_args()
+    """
+    Resolve the options that switch off others. Raises ValueError for
+    options that cannot go together
+    """
+
+    # Check the storage before we spend the time projecting
+    projectlib_projfile.check_compression(args.compress, args.qlevel)
 
     # noPNG turns off noEll
     if args.noPNG:
@@ -637,6 +1116,49 @@ def cmdline():
         args.noPNG = True
         args.noEll = True
         args.noSWarp = True
+        args.quicklook = 0
+    return args
+
+
+def build_parser():
+
+    """ The argparse parser of projectDECamPNG """
+
+    import argparse
+
+    USAGE = "\n"
+    USAGE = USAGE + "  %(prog)s <imglist> <basename> [options] \n"
+    USAGE = USAGE + "  i.e.: \n"
+    USAGE = USAGE + "  %(prog)s file-with-list-of-images /someplace/anotherplace/somename\n"
+
+    epilog = "Author: Felipe Menanteau, NCSA/University of Illinois (felipe@illinois.edu)"
+    description = "Projects a DECam exposure using SWarp and creates grayscale PNGs" \
+                  "using Python's native PIL/Image module"
+    parser = argparse.ArgumentParser(usage=USAGE,
+                                     epilog=epilog,
+                                     description=description,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # The positional arguments
+    parser.add_argument("imglist", default=None,
+                        help="Image list to project")
+    parser.add_argument("basename", action="store",
+                        help="Output Directory w/BASENAME")
+    parser.add_argument("--catlist", dest='cataloglist',
+                        help="List of catalogs")
+    add_options(parser)
+    return parser
+
+
+def cmdline():
+
+    """ Parse the command line arguments and options using argparse"""
+
+    parser = build_parser()
+    args = parser.parse_args()
+    try:
+        args = check_options(args)
+    except ValueError as err:
+        parser.error(str(err))
 
     print("# Will run:")
     print(f"# {parser.prog}")
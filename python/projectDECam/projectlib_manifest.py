@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+
+ Content-hash incremental rebuild for the stages of
+ project_DECam_fromlist.
+
+ The stages form a small graph:
+
+   swarp -> png -> TN
+            png + catalogs -> ell -> ell_TN
+
+ and every stage gets a key: a hash of the identities (path, size,
+ mtime) of its input files, its own parameters and the keys of the
+ stages it depends on. The keys of the stages that have been run are
+ kept in a sidecar JSON manifest ($BASENAME_manifest.json) next to the
+ outputs, and a stage is only re-run when its key changed or one of
+ its outputs is missing. Changing i.e. --grayscale re-runs png, TN,
+ ell and ell_TN but never the projection.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import json
+import hashlib
+
+# Bump to invalidate all the manifests if the stages change
+MANIFEST_VERSION = 1
+
+
+def files_hash(filenames):
+
+    """ A hash of the identities (real path, size, mtime) of a list of files """
+
+    sha = hashlib.sha1()
+    for filename in sorted(filenames):
+        path = os.path.realpath(filename)
+        try:
+            st = os.stat(path)
+            ident = f"{path}:{st.st_size}:{st.st_mtime_ns}"
+        except FileNotFoundError:
+            ident = f"{path}:missing"
+        sha.update(ident.encode())
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+
+def stage_key(stage, params=None, inputs=None, upstream=None):
+
+    """
+    The key of a stage from its parameters (a dictionary), the hash of
+    its input files and the keys of the upstream stages
+    """
+
+    record = {'version': MANIFEST_VERSION,
+              'stage': stage,
+              'params': params or {},
+              'inputs': inputs,
+              'upstream': upstream or []}
+    text = json.dumps(record, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class StageManifest:
+
+    """
+    The sidecar manifest with the keys and outputs of the stages that
+    have been run for a BASENAME
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.stages = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as fobj:
+                    data = json.load(fobj)
+                if data.get('version') == MANIFEST_VERSION:
+                    self.stages = data.get('stages', {})
+            except (ValueError, OSError):
+                print(f"# WARNING: cannot read manifest {filename}, will rebuild")
+                self.stages = {}
+
+    def is_current(self, stage, key, outputs):
+
+        """ True if the stage ran with the same key and its outputs exist """
+
+        entry = self.stages.get(stage)
+        if entry is None or entry.get('key') != key:
+            return False
+        return all(os.path.exists(output) for output in outputs)
+
+    def record(self, stage, key, outputs, **extra):
+
+        """ Record a stage as done and write the manifest """
+
+        entry = {'key': key, 'outputs': list(outputs)}
+        entry.update(extra)
+        self.stages[stage] = entry
+        self.write()
+
+    def invalidate(self, stage):
+
+        """ Forget a stage """
+
+        if self.stages.pop(stage, None) is not None:
+            self.write()
+
+    def write(self):
+
+        """ Write the manifest atomically """
+
+        tmpfile = f"{self.filename}.tmp"
+        with open(tmpfile, 'w') as fobj:
+            json.dump({'version': MANIFEST_VERSION, 'stages': self.stages},
+                      fobj, indent=2, sort_keys=True)
+        os.replace(tmpfile, self.filename)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+"""
+
+ Native NumPy focal-plane projection engine, an in-process alternative
+ to the SWarp call in project_DECam_fromlist.swarp_exposure, aimed at
+ preview mosaics.
+
+ It reproduces the options we pass to SWarp:
+   -RESAMPLING_TYPE NEAREST
+   -COMBINE_TYPE    WEIGHTED
+   -WEIGHT_TYPE     MAP_WEIGHT (the [2] HDU) with an optional WEIGHT_THRESH
+   -SUBTRACT_BACK   Y/N (BACK_SIZE 128, BACK_FILTERSIZE 7)
+   -BLANK_BADPIXELS Y
+ onto a TAN projection with a manual pixel scale, centered on the
+ exposure.
+
+ The output->input nearest-neighbour pixel maps are computed with
+ vectorized wcsutil.WCS transforms, and the weighted combine is
+ accumulated one CCD at a time, so the peak memory is that of one CCD
+ plus the output buffers.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import sys
+import math
+import time
+import warnings
+
+import fitsio
+import numpy
+from despyastro import wcsutil
+
+# Default DECam input pixel-scale in arcsec/pixel
+INPUT_PIXEL_SCALE = 0.263
+# The size of a projected exposure at the native pixscale
+DECAM_NX = 31123
+DECAM_NY = 28149
+
+
+def ccd_footprint(hdr):
+
+    """
+    Return the (ra, dec) arrays of the center and the four corners of
+    a CCD from its header, center first
+    """
+
+    wcs = wcsutil.WCS(hdr)
+    nx = hdr['NAXIS1']
+    ny = hdr['NAXIS2']
+    x = numpy.array([nx/2.0, 0.5, nx+0.5, nx+0.5, 0.5])
+    y = numpy.array([ny/2.0, 0.5, 0.5, ny+0.5, ny+0.5])
+    ra, dec = wcs.image2sky(x, y)
+    return numpy.asarray(ra, dtype='f8'), numpy.asarray(dec, dtype='f8')
+
+
+def mean_radec(ra, dec):
+
+    """ RA=0 safe mean position of a set of ra,dec in degrees """
+
+    d2r = math.pi/180.
+    ra = numpy.asarray(ra)*d2r
+    dec = numpy.asarray(dec)*d2r
+    x = (numpy.cos(dec)*numpy.cos(ra)).mean()
+    y = (numpy.cos(dec)*numpy.sin(ra)).mean()
+    z = numpy.sin(dec).mean()
+    ra0 = math.atan2(y, x)/d2r % 360.0
+    dec0 = math.atan2(z, math.hypot(x, y))/d2r
+    return ra0, dec0
+
+
+def tan_header(ra0, dec0, pixscale, nx=1, ny=1, crpix1=0.0, crpix2=0.0):
+
+    """ A TAN header (as a dictionary) for the output projection """
+
+    header = {'NAXIS': 2,
+              'NAXIS1': nx,
+              'NAXIS2': ny,
+              'CTYPE1': 'RA---TAN',
+              'CTYPE2': 'DEC--TAN',
+              'CUNIT1': 'deg',
+              'CUNIT2': 'deg',
+              'CRVAL1': ra0,
+              'CRVAL2': dec0,
+              'CRPIX1': crpix1,
+              'CRPIX2': crpix2,
+              'CD1_1': -pixscale/3600.,
+              'CD1_2': 0.0,
+              'CD2_1': 0.0,
+              'CD2_2': pixscale/3600.,
+              'EQUINOX': 2000.0,
+              'RADESYS': 'ICRS'}
+    return header
+
+
+def output_header(corners_ra, corners_dec, pixscale, center=None):
+
+    """
+    Build the output TAN header that contains all of the CCD corners
+    ----------
+    corners_ra, corners_dec: arrays
+        The ra,dec positions of the corners of all CCDs
+    pixscale: float
+        The output pixel-scale in arcsec/pixel
+    center: tuple, optional
+        The (ra,dec) center of the projection, otherwise the mean of
+        the corners
+    """
+
+    if center is None:
+        center = mean_radec(corners_ra, corners_dec)
+    ra0, dec0 = center
+
+    # The corners in a tangent plane with CRPIX at 0,0
+    wcs = wcsutil.WCS(tan_header(ra0, dec0, pixscale))
+    x, y = wcs.sky2image(corners_ra, corners_dec)
+    x0 = int(math.floor(numpy.min(x)))
+    y0 = int(math.floor(numpy.min(y)))
+    nx = int(math.ceil(numpy.max(x))) - x0 + 1
+    ny = int(math.ceil(numpy.max(y))) - y0 + 1
+    return tan_header(ra0, dec0, pixscale, nx=nx, ny=ny, crpix1=1.0-x0, crpix2=1.0-y0)
+
+
+def _mesh_interp_index(n, nmesh, size):
+
+    """ Indices and weights to linearly interpolate mesh centers to pixels """
+
+    t = (numpy.arange(n) + 0.5)/size - 0.5
+    i0 = numpy.clip(numpy.floor(t), 0, nmesh-1).astype(int)
+    i1 = numpy.minimum(i0 + 1, nmesh - 1)
+    f = numpy.clip(t - i0, 0, 1).astype('f4')
+    f[i0 == i1] = 0.0
+    return i0, i1, f
+
+
+def background_map(data, weight=None, back_size=128, filter_size=7):
+
+    """
+    A SWarp/SExtractor-like background map: the median on meshes of
+    back_size pixels, median filtered over filter_size meshes and
+    bilinearly interpolated back to the full image
+    """
+
+    ny, nx = data.shape
+    nmy = int(math.ceil(ny/float(back_size)))
+    nmx = int(math.ceil(nx/float(back_size)))
+
+    # Pad with NaNs to full meshes, masking zero-weight pixels
+    padded = numpy.full((nmy*back_size, nmx*back_size), numpy.nan, dtype='f4')
+    padded[:ny, :nx] = data
+    if weight is not None:
+        padded[:ny, :nx][weight <= 0] = numpy.nan
+    blocks = padded.reshape(nmy, back_size, nmx, back_size).swapaxes(1, 2)
+    blocks = blocks.reshape(nmy, nmx, back_size*back_size)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mesh = numpy.nanmedian(blocks, axis=-1)
+        # Empty meshes get the global value
+        if numpy.isnan(mesh).all():
+            return numpy.zeros_like(data, dtype='f4')
+        mesh[numpy.isnan(mesh)] = numpy.nanmedian(mesh)
+
+        # Median filter the meshes
+        if filter_size > 1:
+            h = filter_size//2
+            pad = numpy.pad(mesh, h, mode='edge')
+            windows = numpy.lib.stride_tricks.sliding_window_view(pad, (filter_size, filter_size))
+            mesh = numpy.median(windows.reshape(nmy, nmx, -1), axis=-1)
+    del padded, blocks
+
+    # Bilinear interpolation, one axis at a time
+    i0x, i1x, fx = _mesh_interp_index(nx, nmx, back_size)
+    i0y, i1y, fy = _mesh_interp_index(ny, nmy, back_size)
+    mesh = mesh.astype('f4')
+    rows = mesh[:, i0x]*(1-fx) + mesh[:, i1x]*fx
+    back = rows[i0y]*(1-fy)[:, None] + rows[i1y]*fy[:, None]
+    return back
+
+
+def project_ccd(out_wcs, out_sum, out_wsum, sci, wgt, hdr,
+                fscale=1.0, weight_thresh=None, chunk=512):
+
+    """
+    Resample (nearest neighbour) a single CCD onto the output buffers,
+    accumulating the weighted sum and the sum of weights in place
+    ----------
+    out_wcs: wcsutil.WCS
+        The WCS of the output projection
+    out_sum, out_wsum: 2D arrays
+        The output weighted-sum and weight buffers
+    sci, wgt: 2D arrays
+        The science and weight pixels of the CCD
+    hdr: header
+        The header of the CCD with its WCS
+    fscale: float
+        Flux scale from input to output pixels (area ratio)
+    weight_thresh: float, optional
+        Output weights below this value are ignored
+    chunk: int
+        Number of output rows to transform at once
+    """
+
+    wcs = wcsutil.WCS(hdr)
+    ny_in, nx_in = sci.shape
+    NY, NX = out_sum.shape
+
+    # The bounding box of the CCD in the output image
+    ra, dec = ccd_footprint(hdr)
+    x, y = out_wcs.sky2image(ra, dec)
+    i0 = max(int(math.floor(numpy.min(x))) - 2, 1)
+    i1 = min(int(math.ceil(numpy.max(x))) + 2, NX)
+    j0 = max(int(math.floor(numpy.min(y))) - 2, 1)
+    j1 = min(int(math.ceil(numpy.max(y))) + 2, NY)
+    if i1 < i0 or j1 < j0:
+        return 0
+
+    npix = 0
+    xout = numpy.arange(i0, i1 + 1, dtype='f8')
+    for jstart in range(j0, j1 + 1, chunk):
+        jend = min(jstart + chunk - 1, j1)
+        X, Y = numpy.meshgrid(xout, numpy.arange(jstart, jend + 1, dtype='f8'))
+        ra, dec = out_wcs.image2sky(X.ravel(), Y.ravel())
+        xin, yin = wcs.sky2image(ra, dec)
+        # FITS pixel x covers [x-0.5, x+0.5) -> 0-based nearest index
+        ii = numpy.floor(numpy.asarray(xin) - 0.5).astype(numpy.int64)
+        jj = numpy.floor(numpy.asarray(yin) - 0.5).astype(numpy.int64)
+        inside = (ii >= 0) & (ii < nx_in) & (jj >= 0) & (jj < ny_in)
+        if not inside.any():
+            continue
+        ii = ii[inside]
+        jj = jj[inside]
+        w = wgt[jj, ii].astype('f4')/fscale
+        if weight_thresh:
+            w[w < weight_thresh] = 0.0
+        good = w > 0
+        if not good.any():
+            continue
+        # Positions in the output buffers (0-based)
+        idx = numpy.flatnonzero(inside)[good]
+        oy = idx//len(xout) + jstart - 1
+        ox = idx % len(xout) + i0 - 1
+        w = w[good]
+        out_sum[oy, ox] += w*sci[jj[good], ii[good]]*fscale
+        out_wsum[oy, ox] += w
+        npix += len(w)
+    return npix
+
+
+def project_exposure(imgfiles, pixscale=1.0, weight_thresh=None, noBack=False,
+                     input_pixscale=INPUT_PIXEL_SCALE, back_size=128, back_filtersize=7,
+                     footprints=None):
+
+    """
+    Project the CCDs of an exposure with nearest-neighbour resampling
+    and a weighted combine. Returns the (image, weight, header) of the
+    projected exposure
+    ----------
+    imgfiles: list
+        The multi-extension CCD files, with SCI in [0] and WGT in [2]
+    pixscale: float
+        The output pixel-scale in arcsec/pixel
+    weight_thresh: float, optional
+        The weight threshold, already scaled to the output pixscale
+    noBack: bool
+        Do not subtract the background
+    footprints: dict, optional
+        The ra/dec of the centers and corners of the CCDs, as returned by
+        projectlib_footprint.get_footprints
+    """
+
+    t0 = time.time()
+    # First pass -- the footprint of all CCDs from their headers, unless
+    # we were given them (i.e. from the footprint cache)
+    if footprints is not None:
+        corners_ra = numpy.ravel(footprints['ra'])
+        corners_dec = numpy.ravel(footprints['dec'])
+    else:
+        corners_ra = []
+        corners_dec = []
+        for filename in imgfiles:
+            ra, dec = ccd_footprint(fitsio.read_header(filename))
+            corners_ra.append(ra)
+            corners_dec.append(dec)
+        corners_ra = numpy.concatenate(corners_ra)
+        corners_dec = numpy.concatenate(corners_dec)
+    header = output_header(corners_ra, corners_dec, pixscale)
+    NX = header['NAXIS1']
+    NY = header['NAXIS2']
+    print(f"# Output image size: {NX}x{NY} at {pixscale} arcsec/pix")
+
+    # Same sanity check as cross_RA_zero_center, the CCDs should be
+    # within a DECam FOV
+    max_nx = 2.5*DECAM_NX*input_pixscale/pixscale
+    max_ny = 2.5*DECAM_NY*input_pixscale/pixscale
+    if NX > max_nx or NY > max_ny:
+        print("# ***************************************************************")
+        print("# **  WARNING: Distance between CCDs greated that DECam FOV    **")
+        print("# **  WARNING: Projection will not be performed -- bye         **")
+        print("# ***************************************************************")
+        sys.exit()
+
+    out_wcs = wcsutil.WCS(header)
+    out_sum = numpy.zeros((NY, NX), dtype='f4')
+    out_wsum = numpy.zeros((NY, NX), dtype='f4')
+
+    # Flux scaling for the change of pixel area
+    fscale = (pixscale/input_pixscale)**2
+
+    # Second pass -- one CCD at a time
+    for filename in imgfiles:
+        t1 = time.time()
+        with fitsio.FITS(filename) as fits:
+            hdr = fits[0].read_header()
+            sci = fits[0].read().astype('f4')
+            wgt = fits[2].read().astype('f4')
+        if not noBack:
+            sci -= background_map(sci, wgt, back_size=back_size, filter_size=back_filtersize)
+        npix = project_ccd(out_wcs, out_sum, out_wsum, sci, wgt, hdr,
+                           fscale=fscale, weight_thresh=weight_thresh)
+        print(f"# Projected {filename}: {npix} pixels in {time.time()-t1:.2f}s")
+        del sci, wgt
+
+    # The weighted combine, bad pixels are blanked to zero
+    good = out_wsum > 0
+    numpy.divide(out_sum, out_wsum, out=out_sum, where=good)
+    out_sum[~good] = 0.0
+    print(f"# NumPy projection of {len(imgfiles)} CCDs in {time.time()-t0:.2f}s")
+    return out_sum, out_wsum, header
+
+
+def write_projection(filename, image, header, weight=None, weightname=None):
+
+    """ Write the projected image (and optionally its weight) to FITS """
+
+    records = [{'name': key, 'value': value} for key, value in header.items()
+               if key not in ('NAXIS', 'NAXIS1', 'NAXIS2')]
+    fitsio.write(filename, image, header=records, clobber=True)
+    if weight is not None and weightname:
+        fitsio.write(weightname, weight, header=records, clobber=True)
+    return
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+
+ A multi-threaded PNG encoder for the large 8-bit images (full focal
+ plane exposures and coadd tiles).
+
+ PIL filters and deflates a PNG in a single thread. Here the image is
+ cut in horizontal stripes that are filtered (NumPy) and deflated
+ (zlib releases the GIL) in parallel threads:
+   - every stripe is an independent raw deflate stream that ends with
+     a full flush (byte aligned, no references to the previous data),
+     so the stripes can be concatenated into one valid zlib stream
+   - the adler32 of the stream is combined from the adler32 of the
+     stripes, without going over the data again
+   - the PNG filters (none, sub, up, average, paeth or the per-row
+     adaptive choice of libpng) only need the row above, which we have
+ The stripes are written as IDAT chunks in order as they complete, the
+ output is a standard PNG that any decoder reads.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import time
+import zlib
+import struct
+import concurrent.futures
+
+import numpy
+
+from projectDECam import projectlib_pngmeta
+
+# The PNG filter types
+FILTERS = {'none': 0, 'sub': 1, 'up': 2, 'average': 3, 'paeth': 4}
+
+# Default filter and rows per stripe
+DEFAULT_FILTER = 'none'
+STRIPE_ROWS = 256
+
+# The PNG color types for the number of channels
+COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# The zlib header (CMF, FLG) for the compression levels
+ZLIB_HEADERS = {0: b'\x78\x01', 1: b'\x78\x01', 2: b'\x78\x5e', 3: b'\x78\x5e', 4: b'\x78\x5e',
+                5: b'\x78\x5e', 6: b'\x78\x9c', 7: b'\x78\xda', 8: b'\x78\xda', 9: b'\x78\xda'}
+
+ADLER_BASE = 65521
+
+
+def adler32_combine(adler1, adler2, len2):
+
+    """
+    The adler32 of the concatenation of two blocks, from their adler32
+    and the length of the second one (zlib's adler32_combine)
+    """
+
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xffff) + ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + ADLER_BASE - rem
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum2 >= (ADLER_BASE << 1):
+        sum2 -= (ADLER_BASE << 1)
+    if sum2 >= ADLER_BASE:
+        sum2 -= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+def filter_rows(raw, up, bpp, ftype):
+
+    """
+    Apply a PNG filter to a block of rows
+    ----------
+    raw: (nrows, rowbytes) uint8 array
+        The rows
+    up: (rowbytes,) uint8 array
+        The row above the first one (zeros for the first row of the image)
+    bpp: int
+        Bytes per pixel
+    ftype: int
+        The filter type (see FILTERS)
+    """
+
+    if ftype == 0:
+        return raw
+    prior = numpy.empty_like(raw)
+    prior[0] = up
+    prior[1:] = raw[:-1]
+    if ftype == 2:
+        return raw - prior
+    left = numpy.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+    if ftype == 1:
+        return raw - left
+    if ftype == 3:
+        return raw - ((left.astype(numpy.uint16) + prior) >> 1).astype(numpy.uint8)
+
+    # Paeth
+    upleft = numpy.zeros_like(raw)
+    upleft[:, bpp:] = prior[:, :-bpp]
+    a = left.astype(numpy.int16)
+    b = prior.astype(numpy.int16)
+    c = upleft.astype(numpy.int16)
+    pa = numpy.abs(b - c)
+    pb = numpy.abs(a - c)
+    pc = numpy.abs(a + b - 2*c)
+    pred = numpy.where((pa <= pb) & (pa <= pc), left, numpy.where(pb <= pc, prior, upleft))
+    return raw - pred
+
+
+def filter_stripe(raw, up, bpp, png_filter=DEFAULT_FILTER):
+
+    """
+    Filter a stripe of rows, returns the (nrows, 1+rowbytes) bytes with
+    the filter type of every row first. With png_filter='adaptive' the
+    filter of every row is the one with the minimum sum of absolute
+    (signed) values, like libpng does
+    """
+
+    nrows, rowbytes = raw.shape
+    out = numpy.empty((nrows, rowbytes + 1), dtype=numpy.uint8)
+    if png_filter != 'adaptive':
+        ftype = FILTERS[png_filter]
+        out[:, 0] = ftype
+        out[:, 1:] = filter_rows(raw, up, bpp, ftype)
+        return out
+
+    best = None
+    for ftype in FILTERS.values():
+        filtered = filter_rows(raw, up, bpp, ftype)
+        cost = numpy.abs(filtered.view(numpy.int8).astype(numpy.int32)).sum(axis=1)
+        if best is None:
+            best = cost
+            out[:, 0] = ftype
+            out[:, 1:] = filtered
+        else:
+            better = cost < best
+            best = numpy.where(better, cost, best)
+            out[better, 0] = ftype
+            out[better, 1:] = filtered[better]
+    return out
+
+
+def encode_stripe(raw, up, bpp, level=6, png_filter=DEFAULT_FILTER, strategy=zlib.Z_DEFAULT_STRATEGY,
+                  last=False):
+
+    """
+    Filter and deflate a stripe as a raw deflate block ending with a
+    full flush (or the end of the stream). Returns (compressed bytes,
+    adler32 of the filtered bytes, number of filtered bytes)
+    """
+
+    data = filter_stripe(raw, up, bpp, png_filter).tobytes()
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15, 9, strategy)
+    out = comp.compress(data) + comp.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+    return out, zlib.adler32(data), len(data)
+
+
+def write_png(filename, array8, level=6, png_filter=DEFAULT_FILTER, nthreads=None,
+              stripe_rows=STRIPE_ROWS, strategy=zlib.Z_DEFAULT_STRATEGY, text=None, verb=True):
+
+    """
+    Write an 8-bit array (gray, gray+alpha, RGB or RGBA) as a PNG,
+    filtering and deflating stripes of rows in parallel threads.
+    Returns a dictionary with the timing and sizes
+    ----------
+    filename: str
+        The PNG file
+    array8: (ny,nx) or (ny,nx,nchannels) uint8 array
+        The image, first row at the top
+    level: int
+        The zlib compression level (0-9)
+    png_filter: str
+        none, sub, up, average, paeth or adaptive
+    nthreads: int, optional
+        Number of threads [default=number of cores]
+    stripe_rows: int
+        Rows per stripe
+    strategy: int
+        The zlib strategy, i.e. zlib.Z_FILTERED or zlib.Z_RLE
+    text: dict, optional
+        The key:value text chunks (i.e. the WCS)
+    """
+
+    t0 = time.time()
+    array8 = numpy.ascontiguousarray(array8, dtype=numpy.uint8)
+    if png_filter != 'adaptive' and png_filter not in FILTERS:
+        raise ValueError(f"Unknown PNG filter: {png_filter}")
+    ny, nx = array8.shape[:2]
+    nchannels = 1 if array8.ndim == 2 else array8.shape[2]
+    raw = array8.reshape(ny, nx*nchannels)
+    nthreads = nthreads or os.cpu_count()
+
+    ihdr = struct.pack('>IIBBBBB', nx, ny, 8, COLOR_TYPES[nchannels], 0, 0, 0)
+    stripes = [(r0, min(r0 + stripe_rows, ny)) for r0 in range(0, ny, stripe_rows)]
+    zero = numpy.zeros(nx*nchannels, dtype=numpy.uint8)
+
+    # Small images (i.e. pyramid tiles) do not need the threads
+    nthreads = min(nthreads, len(stripes))
+    if nthreads > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=nthreads)
+    else:
+        executor = None
+
+    tmpfile = f"{filename}.tmp{os.getpid()}"
+    adler = 1
+    nbytes = 0
+    with open(tmpfile, 'wb') as fobj:
+        fobj.write(projectlib_pngmeta.PNG_SIGNATURE)
+        fobj.write(projectlib_pngmeta.make_chunk(b'IHDR', ihdr))
+        for key, value in (text or {}).items():
+            fobj.write(projectlib_pngmeta.text_chunk(str(key), str(value)))
+        args = [(raw[r0:r1], raw[r0-1] if r0 > 0 else zero, nchannels, level, png_filter, strategy,
+                 k == len(stripes)-1) for k, (r0, r1) in enumerate(stripes)]
+        if executor is not None:
+            results = (future.result() for future in [executor.submit(encode_stripe, *a) for a in args])
+        else:
+            results = (encode_stripe(*a) for a in args)
+        header = ZLIB_HEADERS[level if level >= 0 else 6]
+        for data, stripe_adler, length in results:
+            adler = adler32_combine(adler, stripe_adler, length)
+            fobj.write(projectlib_pngmeta.make_chunk(b'IDAT', header + data))
+            nbytes += len(header) + len(data)
+            header = b''
+        fobj.write(projectlib_pngmeta.make_chunk(b'IDAT', struct.pack('>I', adler)))
+        fobj.write(projectlib_pngmeta.make_chunk(b'IEND', b''))
+    if executor is not None:
+        executor.shutdown()
+    os.replace(tmpfile, filename)
+
+    stats = {'time': time.time() - t0,
+             'raw_bytes': raw.nbytes,
+             'compressed_bytes': nbytes + 4,
+             'nstripes': len(stripes),
+             'nthreads': nthreads}
+    if verb:
+        print(f"# PNG encode {filename} ({nx}x{ny}x{nchannels}, level={level}, filter={png_filter}, "
+              f"{nthreads} threads): {stats['time']:.2f}s, ratio: {raw.nbytes/stats['compressed_bytes']:.2f}")
+    return stats
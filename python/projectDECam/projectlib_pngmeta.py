@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+
+ Read and write the text chunks (tEXt/iTXt) of PNG files without
+ decoding the image, i.e. to tag the PNGs with the WCS of the FITS
+ file they were made from.
+
+ A PNG file is a signature followed by chunks:
+
+   length (4 bytes) | type (4 bytes) | data (length bytes) | CRC (4 bytes)
+
+ so we can walk the chunks reading only their 8-byte headers and seek
+ over the image data (IDAT). New text chunks are either:
+   - appended in place before the IEND chunk, when none of the keys is
+     already in the file: an O(header) operation
+   - or, to replace existing keys, written into a copy of the file made
+     by streaming the other chunks untouched (no inflate/deflate), only
+     the CRCs of the new chunks are computed
+ Decoding and re-encoding a 10k x 10k image just to add a few keywords
+ is not needed anymore.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import zlib
+import struct
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNKS = (b'tEXt', b'iTXt', b'zTXt')
+
+# The WCS keywords that we carry into the PNGs
+WCSKEYS = ['CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']
+
+# Block size to stream the chunks we copy
+BLOCKSIZE = 1 << 20
+
+
+def make_chunk(ctype, data):
+
+    """ A complete chunk (length, type, data and CRC) """
+
+    return struct.pack('>I', len(data)) + ctype + data + struct.pack('>I', zlib.crc32(ctype + data))
+
+
+def text_chunk(key, value):
+
+    """
+    A text chunk for key:value, tEXt if the value is latin-1 and iTXt
+    (UTF-8) otherwise
+    """
+
+    key = key.encode('latin-1')
+    if not 0 < len(key) < 80:
+        raise ValueError(f"Invalid PNG text keyword: {key}")
+    try:
+        return make_chunk(b'tEXt', key + b'\0' + value.encode('latin-1'))
+    except UnicodeEncodeError:
+        return make_chunk(b'iTXt', key + b'\0\0\0\0\0' + value.encode('utf-8'))
+
+
+def parse_text(ctype, data):
+
+    """ The (key, value) of a tEXt, iTXt or zTXt chunk """
+
+    key, rest = data.split(b'\0', 1)
+    if ctype == b'tEXt':
+        value = rest.decode('latin-1')
+    elif ctype == b'zTXt':
+        value = zlib.decompress(rest[1:]).decode('latin-1')
+    else:
+        compressed = rest[0]
+        # skip the compression method, the language and translated keyword
+        _, _, text = rest[2:].split(b'\0', 2)
+        value = (zlib.decompress(text) if compressed else text).decode('utf-8')
+    return key.decode('latin-1'), value
+
+
+def iter_chunks(fobj):
+
+    """
+    Walk the chunks of an open PNG file, yielding (offset, type,
+    length) with the file positioned at the start of the data. The
+    data is skipped if the caller does not read it
+    """
+
+    if fobj.read(8) != PNG_SIGNATURE:
+        raise ValueError(f"{getattr(fobj, 'name', fobj)} is not a PNG file")
+    while True:
+        offset = fobj.tell()
+        header = fobj.read(8)
+        if len(header) < 8:
+            raise ValueError(f"{getattr(fobj, 'name', fobj)}: truncated PNG, no IEND")
+        length, ctype = struct.unpack('>I4s', header)
+        yield offset, ctype, length
+        fobj.seek(offset + 12 + length)
+        if ctype == b'IEND':
+            return
+
+
+def read_text(filename):
+
+    """ The text chunks of a PNG file as a dictionary """
+
+    text = {}
+    with open(filename, 'rb') as fobj:
+        for _, ctype, length in iter_chunks(fobj):
+            if ctype in TEXT_CHUNKS:
+                key, value = parse_text(ctype, fobj.read(length))
+                text[key] = value
+    return text
+
+
+def set_text(filename, items, outfile=None):
+
+    """
+    Insert or replace text chunks in a PNG file
+    ----------
+    filename: str
+        The PNG file
+    items: dict
+        The key:value pairs to set
+    outfile: str, optional
+        Write to outfile instead of modifying filename
+    """
+
+    items = {str(key): str(value) for key, value in items.items()}
+    chunks = b''.join([text_chunk(key, value) for key, value in items.items()])
+
+    # Find the IEND and the keys we already have
+    replace = False
+    with open(filename, 'rb') as fobj:
+        for offset, ctype, length in iter_chunks(fobj):
+            if ctype in TEXT_CHUNKS:
+                key = fobj.read(min(length, 80)).split(b'\0', 1)[0].decode('latin-1')
+                replace = replace or key in items
+            elif ctype == b'IEND':
+                iend = offset
+
+    # In place, just append before IEND
+    if not replace and outfile is None:
+        with open(filename, 'r+b') as fobj:
+            fobj.seek(iend)
+            fobj.write(chunks + make_chunk(b'IEND', b''))
+            fobj.truncate()
+        return
+
+    # Stream a copy, dropping the old chunks of our keys and adding
+    # the new ones before the first IDAT
+    target = outfile or filename
+    tmpfile = f"{target}.tmp{os.getpid()}"
+    with open(filename, 'rb') as fin, open(tmpfile, 'wb') as fout:
+        fout.write(PNG_SIGNATURE)
+        for offset, ctype, length in iter_chunks(fin):
+            if ctype in TEXT_CHUNKS:
+                data = fin.read(length)
+                if parse_text(ctype, data)[0] in items:
+                    continue
+                fin.seek(offset)
+            if ctype in (b'IDAT', b'IEND') and chunks:
+                fout.write(chunks)
+                chunks = b''
+            fin.seek(offset)
+            nbytes = length + 12
+            while nbytes > 0:
+                block = fin.read(min(BLOCKSIZE, nbytes))
+                fout.write(block)
+                nbytes -= len(block)
+    os.replace(tmpfile, target)
+    return
+
+
+def wcs_text(header, copyright="DES Collaboration"):
+
+    """ The WCS keywords of a FITS header (and the copyright) as PNG text """
+
+    text = {key: str(header[key]) for key in WCSKEYS}
+    if copyright:
+        text['Copyright'] = copyright
+    return text
+
+
+def add_wcs(pngfile, header, copyright="DES Collaboration"):
+
+    """ Tag a PNG file with the WCS of a FITS header """
+
+    print(f"# Adding WCS information to {pngfile}")
+    set_text(pngfile, wcs_text(header, copyright=copyright))
+    return
+
+
+def add_wcs_from_fits(pngfile, fitsfile, ext=0, copyright="DES Collaboration"):
+
+    """ Tag a PNG file with the WCS of an HDU of a FITS file """
+
+    import fitsio
+    add_wcs(pngfile, fitsio.read_header(fitsfile, ext=ext), copyright=copyright)
+    return
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+"""
+
+ Storage of the projected exposures (_proj.fits). By default the image
+ is a plain float32 primary HDU, as SWarp writes it. With --compress
+ it is a tile-compressed image HDU (SCI, after an empty primary) with
+ quantized floats:
+
+   --compress  rice (default of fpack), gzip, gzip_2 or hcompress
+   --qlevel    the quantization step is the noise of the tile/qlevel,
+               0 for lossless (gzip or gzip_2 only)
+   --qmethod   dither2 (subtractive dithering that keeps the zeros of
+               the blanked pixels), dither1 or none
+
+ and optionally (--proj_weight) the weight map in a WGT HDU. The
+ dithering is seeded from the checksum of the tiles, so the same image
+ is always written the same way.
+
+ The tiles are squares of TILE_DIMS pixels and the readers (the strips
+ of the stretch and quantiles, the WCS of the ellipses and the PNGs,
+ the sections of a region) go through image_ext()/read_header() and
+ only decompress the tiles of the region they read. Square tiles keep
+ the section reads cheap, with tiles of whole rows a section has to
+ decompress the full width of the image.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import re
+import time
+
+import fitsio
+import numpy
+
+COMPRESS = ['none', 'rice', 'gzip', 'gzip_2', 'hcompress']
+# The compressions that cfitsio can do losslessly (qlevel 0) on floats
+LOSSLESS = ['gzip', 'gzip_2']
+QMETHODS = {'dither1': 'SUBTRACTIVE_DITHER_1',
+            'dither2': 'SUBTRACTIVE_DITHER_2',
+            'none': 'NO_DITHER'}
+# The default quantization level, as fpack -q 16 for the DES images
+DEFAULT_QLEVEL = 16.0
+# The size (rows, columns) of the compressed tiles
+TILE_DIMS = (256, 256)
+# The structural keys of the image and binary-table (compressed) HDUs,
+# that are not copied between HDUs
+STRUCTURAL = re.compile(r'^(SIMPLE|BITPIX|NAXIS\d*|EXTEND|XTENSION|PCOUNT|GCOUNT|EXTNAME|'
+                        r'TFIELDS|TTYPE\d+|TFORM\d+|THEAP|CHECKSUM|DATASUM|COMMENT|HISTORY|'
+                        r'Z(IMAGE|CMPTYPE|BITPIX|NAXIS\d*|TILE\d+|NAME\d+|VAL\d+|MASKCMP|SIMPLE|'
+                        r'TENSION|EXTEND|BLOCKED|PCOUNT|GCOUNT|HECKSUM|DATASUM|QUANTIZ|DITHER0)|)$')
+
+
+def header_records(header):
+
+    """ A header (dictionary or FITSHDR) as fitsio records, without the structural keys """
+
+    return [{'name': key, 'value': header[key]} for key in header.keys() if not STRUCTURAL.match(key)]
+
+
+def check_compression(compress='none', qlevel=DEFAULT_QLEVEL):
+
+    """
+    Check a compression setting before we project anything: lossless
+    (qlevel 0) floats can only be gzipped. Raises ValueError
+    """
+
+    if compress and compress != 'none' and not qlevel and compress not in LOSSLESS:
+        raise ValueError(f"Lossless compression (qlevel 0) of the floats needs one of "
+                         f"{', '.join(LOSSLESS)}, not {compress}")
+    return
+
+
+def compression_kwargs(compress='none', qlevel=DEFAULT_QLEVEL, qmethod='dither2', tile_dims=TILE_DIMS):
+
+    """ The fitsio write arguments of a compression setting, None if uncompressed """
+
+    if not compress or compress == 'none':
+        return None
+    check_compression(compress, qlevel)
+    # Hcompress does not take the dithering that keeps the zeros
+    if compress == 'hcompress' and qmethod == 'dither2':
+        qmethod = 'dither1'
+    return {'compress': compress,
+            'qlevel': qlevel if qlevel else None,
+            'qmethod': QMETHODS[qmethod] if qlevel else QMETHODS['none'],
+            'dither_seed': 'checksum',
+            'tile_dims': list(tile_dims)}
+
+
+def write_image(filename, image, header, weight=None, compress='none', qlevel=DEFAULT_QLEVEL,
+                qmethod='dither2', tile_dims=TILE_DIMS):
+
+    """
+    Write a projected image (and optionally its weight) with or without
+    tile compression, replacing filename at the end
+    ----------
+    filename: str
+        The output file
+    image, weight: 2D arrays
+        The image and its weight map [optional]
+    header: dict or FITSHDR
+        The WCS header of the image
+    compress: str
+        One of COMPRESS
+    qlevel: float
+        The quantization level of the floats, 0 for lossless (gzip only)
+    qmethod: str
+        The dithering of the quantization, one of QMETHODS
+    """
+
+    t0 = time.time()
+    records = header_records(header)
+    kwargs = compression_kwargs(compress, qlevel, qmethod, tile_dims)
+    tmpfile = f"{filename}.tmp"
+    try:
+        with fitsio.FITS(tmpfile, 'rw', clobber=True) as fits:
+            if kwargs is None:
+                fits.write(image, header=records)
+            else:
+                fits.write(None)
+                fits.write(image, header=records, extname='SCI', **kwargs)
+            if weight is not None:
+                fits.write(weight, header=records, extname='WGT', **(kwargs or {}))
+    except BaseException:
+        # Do not leave a partial file behind
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    os.replace(tmpfile, filename)
+    nbytes = image.nbytes + (weight.nbytes if weight is not None else 0)
+    print(f"# Wrote {filename} (compress: {compress}) in {time.time()-t0:.2f}s, "
+          f"ratio: {os.path.getsize(filename)/nbytes:.3f}")
+    return
+
+
+def image_ext(filename):
+
+    """ The HDU of the projected image: the first one with data """
+
+    with fitsio.FITS(filename) as fits:
+        for k, hdu in enumerate(fits):
+            if hdu.has_data():
+                return k
+    return 0
+
+
+def is_compressed(filename):
+
+    """ Is the projected image tile-compressed? """
+
+    with fitsio.FITS(filename) as fits:
+        return fits[image_ext(filename)].is_compressed()
+
+
+def read_header(filename):
+
+    """
+    The header of the projected image. For a compressed image, a
+    dictionary with the keys of the image (NAXIS1/2 of the image, not
+    of the table of tiles)
+    """
+
+    header = fitsio.read_header(filename, ext=image_ext(filename))
+    if 'ZIMAGE' not in header:
+        return header
+    image = {'NAXIS': header['ZNAXIS'],
+             'NAXIS1': header['ZNAXIS1'],
+             'NAXIS2': header['ZNAXIS2']}
+    image.update((record['name'], record['value']) for record in header_records(header))
+    return image
+
+
+def read_image(filename, header=False):
+
+    """ Read the projected image (and its header) """
+
+    return fitsio.read(filename, ext=image_ext(filename), header=header)
+
+
+def read_weight(filename):
+
+    """ Read the weight of the projected image, None if it was not kept """
+
+    with fitsio.FITS(filename) as fits:
+        if 'WGT' not in fits:
+            return None
+        return fits['WGT'].read()
+
+
+def compress_file(filename, weightfile=None, compress='rice', qlevel=DEFAULT_QLEVEL, qmethod='dither2',
+                  tile_dims=TILE_DIMS):
+
+    """
+    Compress a plain FITS image (i.e. from SWarp) in place, adding the
+    weight map of weightfile if given. The image is read whole, as the
+    compressed tiles are written in one go
+    """
+
+    image, header = fitsio.read(filename, header=True)
+    weight = fitsio.read(weightfile) if weightfile else None
+    write_image(filename, image, header, weight=weight, compress=compress, qlevel=qlevel,
+                qmethod=qmethod, tile_dims=tile_dims)
+    return
+
+
+def uncompress_file(filename, outfile, nrows=1024):
+
+    """
+    Write the projected image of filename as a plain FITS image (for
+    the tools that cannot read the compressed HDUs, i.e. stiff),
+    decompressing it in strips of rows
+    """
+
+    t0 = time.time()
+    with fitsio.FITS(filename) as fits:
+        hdu = fits[image_ext(filename)]
+        header = hdu.read_header()
+        ny, nx = hdu.get_dims()
+        with fitsio.FITS(outfile, 'rw', clobber=True) as out:
+            out.create_image_hdu(dims=[ny, nx], dtype='f4')
+            out[0].write_keys(header_records(header))
+            for r0 in range(0, ny, nrows):
+                r1 = min(r0 + nrows, ny)
+                out[0].write(numpy.asarray(hdu[r0:r1, :], dtype='f4'), start=[r0, 0])
+    print(f"# Uncompressed {filename} -> {outfile} in {time.time()-t0:.2f}s")
+    return outfile
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+
+ Single-pass multi-resolution image pyramid for the PNGs.
+
+ From the 8-bit array already in memory (grayscale or RGB) we build
+ the _TN thumbnail, and optionally a set of Deep Zoom (DZI) tiles for
+ the web viewer, through one chain of 2x box-filter reductions instead
+ of re-opening and resampling the full-size PNG for every output.
+
+ The Deep Zoom layout is:
+
+   $BASENAME.dzi
+   $BASENAME_files/<level>/<col>_<row>.png
+
+ where the highest level is the full-size image and each level below
+ is half the size of the one above, down to 1x1.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import math
+import time
+
+import numpy
+
+from projectDECam import projectlib_stretch
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+       Format="png" Overlap="{overlap}" TileSize="{tilesize}">
+  <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+
+def reduce2x(array):
+
+    """
+    Reduce a 2D (ny,nx) or 3D (ny,nx,3) uint8 array by 2x with a box
+    filter. Odd sizes are handled by repeating the last row/column
+    """
+
+    ny, nx = array.shape[:2]
+    if ny % 2 or nx % 2:
+        pad = [(0, ny % 2), (0, nx % 2)] + [(0, 0)]*(array.ndim - 2)
+        array = numpy.pad(array, pad, mode='edge')
+    a = array.astype(numpy.uint16)
+    total = a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]
+    return ((total + 2)//4).astype(numpy.uint8)
+
+
+def thumbnail_shape(shape, TNsize, box=False):
+
+    """
+    The (width, height) of a thumbnail: TNsize wide keeping the aspect
+    ratio, or fitting inside a TNsize x TNsize box when box=True
+    """
+
+    h, w = shape[:2]
+    if box and h > w:
+        return max(1, int(TNsize*w/h)), TNsize
+    return TNsize, max(1, int(TNsize*h/w))
+
+
+def thumbnail(array, TNsize, box=False):
+
+    """
+    Make a thumbnail from an 8-bit array: 2x box reductions while the
+    image is at least twice the target size, and a final Lanczos
+    resample to the exact size
+    """
+
+    from PIL import Image
+    width, height = thumbnail_shape(array.shape, TNsize, box=box)
+    while array.shape[1] >= 2*width and array.shape[0] >= 2*height:
+        array = reduce2x(array)
+    im = Image.fromarray(array)
+    if im.size != (width, height):
+        im = im.resize((width, height), Image.LANCZOS)
+    return numpy.asarray(im)
+
+
+def write_thumbnail(array, outfile, TNsize, box=False):
+
+    """ Make and write the thumbnail of an 8-bit array """
+
+    projectlib_stretch.write_png(outfile, thumbnail(array, TNsize, box=box))
+    return
+
+
+def thumbnail_file(pngfile, outfile, TNsize, box=False):
+
+    """
+    Make the thumbnail of a PNG file, decoding it only once. Used by
+    color_tile in place of ImageMagick's convert -scale
+    """
+
+    from PIL import Image
+    array = numpy.asarray(Image.open(pngfile))
+    write_thumbnail(array, outfile, TNsize, box=box)
+    return outfile
+
+
+def write_dzi(array, basename, tilesize=256, overlap=0, on_level=None):
+
+    """
+    Write the Deep Zoom pyramid (.dzi and tiles) of an 8-bit array
+    with one chain of 2x reductions. Returns the number of tiles
+    ----------
+    on_level: callable, optional
+        Called with the array of every level, from the full size down,
+        i.e. to take the thumbnail from the same chain
+    """
+
+    t0 = time.time()
+    height, width = array.shape[:2]
+    maxlevel = int(math.ceil(math.log2(max(width, height)))) if max(width, height) > 1 else 0
+    tiledir = f"{basename}_files"
+    ntiles = 0
+    level = maxlevel
+    while True:
+        leveldir = os.path.join(tiledir, str(level))
+        os.makedirs(leveldir, exist_ok=True)
+        if on_level is not None:
+            on_level(array)
+        ny, nx = array.shape[:2]
+        for row in range(int(math.ceil(ny/float(tilesize)))):
+            for col in range(int(math.ceil(nx/float(tilesize)))):
+                y0 = max(row*tilesize - overlap, 0)
+                x0 = max(col*tilesize - overlap, 0)
+                y1 = min((row+1)*tilesize + overlap, ny)
+                x1 = min((col+1)*tilesize + overlap, nx)
+                projectlib_stretch.write_png(os.path.join(leveldir, f"{col}_{row}.png"),
+                                             numpy.ascontiguousarray(array[y0:y1, x0:x1]),
+                                             compress_level=1, verb=False)
+                ntiles += 1
+        if level == 0:
+            break
+        array = reduce2x(array)
+        level -= 1
+
+    with open(f"{basename}.dzi", 'w') as fobj:
+        fobj.write(DZI_TEMPLATE.format(overlap=overlap, tilesize=tilesize,
+                                       width=width, height=height))
+    print(f"# Wrote {ntiles} DZI tiles for {basename} in {time.time()-t0:.2f}s")
+    return ntiles
+
+
+def build_pyramid(array, basename, TNsize=800, TN_png=None, zoom=False, tilesize=256):
+
+    """
+    Build the pyramid of an 8-bit array: the thumbnail and, if
+    requested, the Deep Zoom tiles. With the tiles, the thumbnail is
+    resampled from the DZI level just above TNsize, so the full-size
+    array is only reduced once
+    """
+
+    if TN_png is None:
+        TN_png = f"{basename}_TN.png"
+    if not zoom:
+        write_thumbnail(array, TN_png, TNsize)
+        return TN_png
+
+    width, height = thumbnail_shape(array.shape, TNsize)
+    source = [array]
+
+    def keep_level(level_array):
+        # The smallest level still larger than the thumbnail
+        if level_array.shape[1] >= width and level_array.shape[0] >= height:
+            source[0] = level_array
+
+    write_dzi(array, basename, tilesize=tilesize, on_level=keep_level)
+    write_thumbnail(source[0], TN_png, TNsize)
+    return TN_png
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""
+
+ Streaming, bounded-memory quantile estimation for the grayscale and
+ colour scaling of large images (full-exposure _proj.fits mosaics and
+ coadd tiles).
+
+ The images are read in strips of rows with fitsio, and the values are
+ accumulated in a mergeable log-bucket sketch (DDSketch-like): every
+ quantile is returned with a relative error smaller than `rel_err`,
+ and the memory only depends on the dynamic range of the data and
+ rel_err, not on the size of the image. Pixels can optionally be
+ subsampled.
+
+ Typical use:
+
+   sketch = sketch_file('DECam_00229650_proj.fits', rel_err=0.005)
+   vmax = sketch.quantile(0.98)
+
+ and for the bands of a tile, in one pass per band:
+
+   levels = band_quantiles({'g': gfile, 'r': rfile}, [0.5, 0.95, 0.995])
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import math
+
+import fitsio
+import numpy
+
+# Default strip size in rows
+NROWS = 256
+
+
+class QuantileSketch:
+
+    """
+    A mergeable log-bucket quantile sketch. Positive and negative
+    values are counted in logarithmic buckets of relative width
+    rel_err, values with |x| < min_value are counted as zeros
+    """
+
+    def __init__(self, rel_err=0.005, min_value=1e-6):
+
+        self.rel_err = rel_err
+        self.min_value = min_value
+        self.gamma = (1.0 + rel_err)/(1.0 - rel_err)
+        self.log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.zeros = 0
+        # The stores for positive and negative values: counts and offset
+        self.pos = numpy.zeros(0, dtype=numpy.int64)
+        self.neg = numpy.zeros(0, dtype=numpy.int64)
+        self.pos_offset = 0
+        self.neg_offset = 0
+        self.vmin = numpy.inf
+        self.vmax = -numpy.inf
+
+    def _key(self, absval):
+        return numpy.ceil(numpy.log(absval)/self.log_gamma).astype(numpy.int64)
+
+    def _value(self, key):
+        return 2.0*self.gamma**key/(self.gamma + 1.0)
+
+    @staticmethod
+    def _add_counts(store, offset, keys, counts=None):
+
+        """ Add counts per key to a store, growing it when needed """
+
+        if keys.size == 0:
+            return store, offset
+        kmin = int(keys.min())
+        kmax = int(keys.max())
+        if store.size == 0:
+            offset = kmin
+            store = numpy.zeros(kmax - kmin + 1, dtype=numpy.int64)
+        elif kmin < offset or kmax >= offset + store.size:
+            new_offset = min(offset, kmin)
+            new_size = max(offset + store.size, kmax + 1) - new_offset
+            new = numpy.zeros(new_size, dtype=numpy.int64)
+            new[offset - new_offset:offset - new_offset + store.size] = store
+            store = new
+            offset = new_offset
+        store += numpy.bincount(keys - offset, weights=counts,
+                                minlength=store.size).astype(numpy.int64)
+        return store, offset
+
+    def update(self, values):
+
+        """ Add an array of values (non-finite values are ignored) """
+
+        values = numpy.ravel(values)
+        values = values[numpy.isfinite(values)]
+        if values.size == 0:
+            return self
+        self.count += values.size
+        self.vmin = min(self.vmin, float(values.min()))
+        self.vmax = max(self.vmax, float(values.max()))
+        absval = numpy.abs(values)
+        small = absval < self.min_value
+        self.zeros += int(small.sum())
+        pos = values > 0
+        neg = values < 0
+        pos &= ~small
+        neg &= ~small
+        self.pos, self.pos_offset = self._add_counts(self.pos, self.pos_offset,
+                                                     self._key(absval[pos]))
+        self.neg, self.neg_offset = self._add_counts(self.neg, self.neg_offset,
+                                                     self._key(absval[neg]))
+        return self
+
+    def merge(self, other):
+
+        """ Merge another sketch with the same rel_err into this one """
+
+        if other.rel_err != self.rel_err:
+            raise ValueError("Cannot merge sketches with different rel_err")
+        if other.count == 0:
+            return self
+        self.count += other.count
+        self.zeros += other.zeros
+        self.vmin = min(self.vmin, other.vmin)
+        self.vmax = max(self.vmax, other.vmax)
+        for name in ('pos', 'neg'):
+            store = getattr(other, name)
+            if store.size == 0:
+                continue
+            keys = numpy.arange(store.size, dtype=numpy.int64) + getattr(other, name + '_offset')
+            new, offset = self._add_counts(getattr(self, name), getattr(self, name + '_offset'),
+                                           keys, counts=store)
+            setattr(self, name, new)
+            setattr(self, name + '_offset', offset)
+        return self
+
+    def quantile(self, q):
+
+        """ The value at quantile q (0-1), or a list for a sequence of q """
+
+        if numpy.ndim(q) > 0:
+            return [self.quantile(qq) for qq in q]
+        if self.count == 0:
+            return numpy.nan
+        if q <= 0:
+            return self.vmin
+        if q >= 1:
+            return self.vmax
+
+        rank = q*(self.count - 1)
+        # Negative values, from the most negative up
+        nneg = int(self.neg.sum())
+        if rank < nneg:
+            cum = numpy.cumsum(self.neg[::-1])
+            i = int(numpy.searchsorted(cum, rank, side='right'))
+            key = self.neg_offset + self.neg.size - 1 - i
+            value = -self._value(key)
+        elif rank < nneg + self.zeros:
+            value = 0.0
+        else:
+            cum = numpy.cumsum(self.pos)
+            i = int(numpy.searchsorted(cum, rank - nneg - self.zeros, side='right'))
+            i = min(i, self.pos.size - 1)
+            value = self._value(self.pos_offset + i)
+        return float(min(max(value, self.vmin), self.vmax))
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+def iter_strips(filename, ext=0, nrows=NROWS, subsample=1):
+
+    """
+    Iterate over the rows of a FITS image in strips, yielding
+    (row0, strip). With subsample=k only every k-th row and column are
+    read, so for a tile-compressed HDU (tiles of rows) only the rows we
+    keep are decompressed. Works for plain and tile-compressed HDUs
+    """
+
+    with fitsio.FITS(filename) as fits:
+        hdu = fits[ext]
+        ny, nx = hdu.get_dims()
+        for r0 in range(0, ny, nrows):
+            r1 = min(r0 + nrows, ny)
+            if subsample > 1:
+                first = r0 + (-r0) % subsample
+                if first >= r1:
+                    continue
+                strip = hdu[first:r1:subsample, ::subsample]
+            else:
+                strip = hdu[r0:r1, :]
+            yield r0, strip
+    return
+
+
+def iter_array_strips(data, nrows=NROWS, subsample=1):
+
+    """ Same as iter_strips for an array already in memory """
+
+    ny = data.shape[0]
+    for r0 in range(0, ny, nrows):
+        strip = data[r0:min(r0 + nrows, ny)]
+        if subsample > 1:
+            strip = strip[(-r0) % subsample::subsample, ::subsample]
+        yield r0, strip
+    return
+
+
+def sketch_strips(strips, rel_err=0.005, ignore_zeros=True, satur_level=None):
+
+    """
+    Build a sketch from an iterator of (row0, strip). Exact zeros are
+    the blank pixels of SWarp/coadds and are ignored by default
+    """
+
+    sketch = QuantileSketch(rel_err=rel_err)
+    for _, strip in strips:
+        values = numpy.ravel(strip)
+        if ignore_zeros:
+            values = values[values != 0]
+        if satur_level is not None:
+            values = values[values < satur_level]
+        sketch.update(values)
+    return sketch
+
+
+def sketch_file(filename, ext=0, rel_err=0.005, subsample=1, nrows=NROWS,
+                ignore_zeros=True, satur_level=None):
+
+    """ Build the quantile sketch of a FITS image reading it in strips """
+
+    return sketch_strips(iter_strips(filename, ext=ext, nrows=nrows, subsample=subsample),
+                         rel_err=rel_err, ignore_zeros=ignore_zeros, satur_level=satur_level)
+
+
+def sketch_array(data, rel_err=0.005, subsample=1, nrows=NROWS,
+                 ignore_zeros=True, satur_level=None):
+
+    """ Build the quantile sketch of an image in memory """
+
+    return sketch_strips(iter_array_strips(data, nrows=nrows, subsample=subsample),
+                         rel_err=rel_err, ignore_zeros=ignore_zeros, satur_level=satur_level)
+
+
+def band_quantiles(files, quantiles, ext=0, rel_err=0.005, subsample=1,
+                   satur_level=40000.0):
+
+    """
+    Compute a set of quantiles for each band of a tile, reading each
+    band file once
+    ----------
+    files: dict
+        The band:filename dictionary
+    quantiles: list
+        The quantiles to compute (i.e. [0.5, max_grayscale, max_colorscale])
+    Returns a dictionary band:{q:value}
+    """
+
+    levels = {}
+    for band, filename in files.items():
+        sketch = sketch_file(filename, ext=ext, rel_err=rel_err, subsample=subsample,
+                             satur_level=satur_level)
+        levels[band] = dict(zip(quantiles, sketch.quantile(list(quantiles))))
+    return levels
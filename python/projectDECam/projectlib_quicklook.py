@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+"""
+
+ Quicklook mosaics of DECam exposures for the QA at observing time: a
+ rough picture of the focal plane without the WCS resampling of SWarp
+ (or projectlib_numpy), the RA=0 check or any external executable.
+
+ Every CCD is read (in parallel threads), block-binned by N in NumPy
+ and stretched with its own stiff-like levels (so the differences in
+ sky and gain between CCDs do not show), and placed in the mosaic using
+ the built-in table of the DECam focal plane (decam_layout), keyed by
+ the CCDNUM (or DETPOS) of its header. The mosaic has north up and
+ east left at the nominal orientation of the camera, the CCDs are
+ transposed as their x axis runs along Dec.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import time
+import concurrent.futures
+
+import fitsio
+import numpy
+
+from projectDECam import projectlib_stretch
+from projectDECam import projectlib_pyramid
+
+# The DECam CCDs
+CCD_NX = 2048
+CCD_NY = 4096
+# Gaps between CCDs in native pixels, along and across the rows
+CCD_GAP_X = 153
+CCD_GAP_Y = 201
+# Number of CCDs on each row of the focal plane, south to north
+DECAM_ROWS = [3, 4, 5, 6, 6, 7, 7, 6, 6, 5, 4, 3]
+
+
+def decam_layout():
+
+    """
+    The DECam focal plane: a list of (ccdnum, detpos, x, y) with the
+    offsets of the CCD centers from the optical axis in native pixels.
+    The long side of the CCDs runs along the rows
+    """
+
+    layout = []
+    ccdnum = 1
+    nrows = len(DECAM_ROWS)
+    half = nrows//2
+    for row, nccd in enumerate(DECAM_ROWS):
+        y = (row - (nrows-1)/2.0)*(CCD_NX + CCD_GAP_Y)
+        if row < half:
+            side = 'S'
+            first = sum(DECAM_ROWS[row+1:half]) + 1
+        else:
+            side = 'N'
+            first = sum(DECAM_ROWS[half:row]) + 1
+        for col in range(nccd):
+            x = (col - (nccd-1)/2.0)*(CCD_NY + CCD_GAP_X)
+            layout.append((ccdnum, f"{side}{first+col}", x, y))
+            ccdnum += 1
+    return layout
+
+
+# The (x, y) center of the CCDs by CCDNUM and DETPOS
+CCD_CENTERS = {key: (x, y) for ccdnum, detpos, x, y in decam_layout() for key in (ccdnum, detpos)}
+
+
+def ccd_center(header):
+
+    """
+    The center of a CCD in the focal plane (native pixels) from the
+    CCDNUM or DETPOS of its header, None if unknown
+    """
+
+    try:
+        center = CCD_CENTERS.get(int(header.get('CCDNUM')))
+    except (TypeError, ValueError):
+        center = None
+    if center is None:
+        center = CCD_CENTERS.get(str(header.get('DETPOS', '')).strip())
+    return center
+
+
+def block_bin(data, nbin):
+
+    """ The mean of the nbin x nbin blocks of a 2D array (trimmed to a multiple of nbin) """
+
+    if nbin <= 1:
+        return numpy.asarray(data, dtype='f4')
+    ny = data.shape[0]//nbin
+    nx = data.shape[1]//nbin
+    blocks = data[:ny*nbin, :nx*nbin].reshape(ny, nbin, nx, nbin)
+    return blocks.mean(axis=(1, 3), dtype='f4')
+
+
+def read_binned(filename, nbin, ext=0, nrows=1024):
+
+    """
+    Read and block-bin the image of a CCD in strips of rows, so only
+    one strip of the full resolution image is in memory. Returns the
+    binned array and the header
+    """
+
+    with fitsio.FITS(filename) as fits:
+        hdu = fits[ext]
+        header = hdu.read_header()
+        ny, nx = hdu.get_dims()
+        step = max(nbin, (nrows//nbin)*nbin)
+        binned = numpy.empty((ny//nbin, nx//nbin), dtype='f4')
+        for j0 in range(0, (ny//nbin)*nbin, step):
+            j1 = min(j0 + step, (ny//nbin)*nbin)
+            binned[j0//nbin:j1//nbin] = block_bin(hdu[j0:j1, :], nbin)
+    return binned, header
+
+
+def mosaic_geometry(nbin, ccd_shape):
+
+    """
+    The shape of the mosaic and the size of its pixels in native
+    pixels, for CCDs of ccd_shape (ny, nx) binned by nbin. Shrunk CCDs
+    (i.e. the synthetic ones) are placed at their native positions
+    """
+
+    # Native pixels per pixel of the CCD files
+    shrink = CCD_NY/max(ccd_shape)
+    pixsize = nbin*shrink
+    layout = decam_layout()
+    xs = [x for _, _, x, _ in layout]
+    ys = [y for _, _, _, y in layout]
+    width = max(xs) - min(xs) + CCD_NY
+    height = max(ys) - min(ys) + CCD_NX
+    shape = (int(numpy.ceil(height/pixsize)), int(numpy.ceil(width/pixsize)))
+    # The east (left) and south (bottom) edges of the focal plane
+    edges = (max(xs) + CCD_NY/2.0, min(ys) - CCD_NX/2.0)
+    return shape, pixsize, edges
+
+
+def quicklook_mosaic(imgfiles, nbin=8, ext=0, max_level=0.98, nthreads=8):
+
+    """
+    Make the 8-bit quicklook mosaic of an exposure, north up (in PNG
+    orientation). Returns the mosaic and the number of CCDs placed
+    ----------
+    imgfiles: list
+        The CCD files of the exposure
+    nbin: int
+        The binning factor of the CCDs
+    ext: int
+        The HDU of the science images
+    max_level: float
+        The quantile of the max level of every CCD (--grayscale)
+    nthreads: int
+        Number of threads to read the CCDs
+    """
+
+    t0 = time.time()
+    with fitsio.FITS(imgfiles[0]) as fits:
+        ccd_shape = fits[ext].get_dims()
+    shape, pixsize, (east, south) = mosaic_geometry(nbin, ccd_shape)
+    mosaic = numpy.zeros(shape, dtype=numpy.uint8)
+
+    def place(filename):
+        binned, header = read_binned(filename, nbin, ext=ext)
+        center = ccd_center(header)
+        if center is None:
+            print(f"# WARNING: no CCDNUM/DETPOS for {filename} -- skipping")
+            return 0
+        # x runs along Dec and y along -RA, so the transpose is north up
+        # and east left, as the mosaic
+        block = binned.T
+        sky, vmin, vmax = projectlib_stretch.stiff_levels(block, max_level=max_level)
+        x, y = center
+        h, w = block.shape
+        col0 = int(round((east - x - CCD_NY/2.0)/pixsize))
+        row0 = int(round((y - CCD_NX/2.0 - south)/pixsize))
+        col0 = min(max(col0, 0), shape[1] - w)
+        row0 = min(max(row0, 0), shape[0] - h)
+        # Flip so the first row is at the bottom
+        rows = slice(shape[0] - row0 - h, shape[0] - row0)
+        projectlib_stretch.stretch(block, vmin, vmax, flip=True, out=mosaic[rows, col0:col0+w])
+        return 1
+
+    nthreads = max(1, min(nthreads, len(imgfiles)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+        nplaced = sum(pool.map(place, imgfiles))
+    print(f"# Quicklook mosaic {shape[1]}x{shape[0]} of {nplaced}/{len(imgfiles)} CCDs "
+          f"binned {nbin}x{nbin} in {time.time()-t0:.2f}s")
+    return mosaic, nplaced
+
+
+def write_quicklook(imgfiles, pngfile, TN_png=None, TNsize=800, nbin=8, ext=0, max_level=0.98,
+                    nthreads=8, compress_level=6, png_filter=None, nthreads_png=None):
+
+    """
+    Write the quicklook mosaic of an exposure as pngfile and its
+    thumbnail as TN_png (if given). Returns the mosaic
+    """
+
+    mosaic, _ = quicklook_mosaic(imgfiles, nbin=nbin, ext=ext, max_level=max_level, nthreads=nthreads)
+    projectlib_stretch.write_png(pngfile, mosaic, compress_level=compress_level,
+                                 png_filter=png_filter, nthreads=nthreads_png)
+    print(f"# Wrote {pngfile}")
+    if TN_png:
+        projectlib_pyramid.write_thumbnail(mosaic, TN_png, TNsize)
+        print(f"# Wrote {TN_png}")
+    return mosaic
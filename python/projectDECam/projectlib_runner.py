@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+
+ Asynchronous runner for the external tools (SWarp, stiff, funpack).
+
+ Commands are given as argv lists (no shell, no string concatenation)
+ and run as subprocesses driven by an asyncio event loop:
+   - per-tool concurrency limits, i.e. one SWarp at a time (it is
+     already multi-threaded) but several stiff or funpack
+   - optional timeouts, the process is killed when exceeded
+   - the return code is always checked, a failure raises
+     subprocess.CalledProcessError (or subprocess.TimeoutExpired)
+     instead of being silently ignored
+   - stdout/stderr are streamed line by line with a [prefix], so the
+     logs of concurrent commands can be told apart
+   - every command is reaped with os.wait4, and its own resource usage
+     (CPU, peak RSS) goes to the running stage of a
+     projectlib_telemetry.Telemetry, if one is given
+
+ The same Runner can be used from synchronous code (run_sync), also
+ from worker threads while the event loop runs in the main thread.
+ This is how the batch pipeline overlaps the SWarp of one exposure
+ with the Python stages (stretch, ellipses, thumbnails) of another.
+
+ For the Python stages, slot(tool) gives a threading semaphore with
+ the same limits.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import sys
+import time
+import shlex
+import asyncio
+import threading
+import subprocess
+
+# Default number of concurrent commands per tool
+DEFAULT_LIMITS = {'swarp': 1,
+                  'stiff': 2,
+                  'funpack': 4,
+                  'python': 1}
+
+
+class Runner:
+
+    """
+    Run external commands (argv lists) with per-tool concurrency
+    limits, timeouts, return-code checks and prefixed streamed logs
+    """
+
+    def __init__(self, limits=None, default_limit=1, stream=None):
+
+        self.limits = dict(DEFAULT_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.default_limit = default_limit
+        self.stream = stream or sys.stdout
+        self.loop = None
+        self._sems = {}
+        self._sems_loop = None
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def limit(self, tool):
+        return max(1, int(self.limits.get(tool, self.default_limit)))
+
+    def semaphore(self, tool):
+
+        """ The asyncio semaphore of a tool, for the running loop """
+
+        loop = asyncio.get_running_loop()
+        if self._sems_loop is not loop:
+            self._sems = {}
+            self._sems_loop = loop
+        if tool not in self._sems:
+            self._sems[tool] = asyncio.Semaphore(self.limit(tool))
+        return self._sems[tool]
+
+    def slot(self, tool):
+
+        """ A threading semaphore to limit in-process (Python) stages """
+
+        with self._lock:
+            if tool not in self._slots:
+                self._slots[tool] = threading.BoundedSemaphore(self.limit(tool))
+            return self._slots[tool]
+
+    def write(self, prefix, line):
+        with self._write_lock:
+            self.stream.write(f"[{prefix}] {line}\n")
+            self.stream.flush()
+
+    def _wait(self, proc, prefix):
+
+        """
+        Stream the output of a command line by line and reap it with
+        os.wait4 (on a thread). Returns its resource usage
+        """
+
+        for line in proc.stdout:
+            self.write(prefix, line.decode(errors='replace').rstrip())
+        proc.stdout.close()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        return rusage
+
+    async def run(self, argv, tool=None, prefix=None, timeout=None, check=True, cwd=None, env=None,
+                  telemetry=None):
+
+        """
+        Run a command (argv list) and return its exit code
+        ----------
+        argv: list
+            The command and its arguments
+        tool: str, optional
+            The tool, for the concurrency limit [default=argv[0]]
+        prefix: str, optional
+            The prefix of the streamed log lines [default=tool]
+        timeout: float, optional
+            Kill the command after timeout seconds
+        check: bool
+            Raise subprocess.CalledProcessError if the exit code is not 0
+        telemetry: projectlib_telemetry.Telemetry, optional
+            Add the resource usage of the command to its running stage
+        """
+
+        argv = [str(arg) for arg in argv]
+        tool = tool or argv[0]
+        prefix = prefix or tool
+        async with self.semaphore(tool):
+            t0 = time.time()
+            self.write(prefix, f"# Running: {shlex.join(argv)}")
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    cwd=cwd, env=env)
+            waiter = asyncio.get_running_loop().run_in_executor(None, self._wait, proc, prefix)
+            try:
+                rusage = await asyncio.wait_for(asyncio.shield(waiter), timeout=timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                rusage = await waiter
+                if telemetry is not None:
+                    telemetry.add_command(rusage)
+                self.write(prefix, f"# ERROR: killed after {timeout}s")
+                raise subprocess.TimeoutExpired(tool, timeout)
+            if telemetry is not None:
+                telemetry.add_command(rusage)
+            self.write(prefix, f"# Done in {time.time()-t0:.2f}s, exit code: {proc.returncode}, "
+                       f"maxrss: {rusage.ru_maxrss/1024.:.0f}MB")
+        # The full command is in the log, keep the message short
+        if check and proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, tool)
+        return proc.returncode
+
+    async def run_all(self, commands, check=True, telemetry=None):
+
+        """
+        Run a list of commands concurrently (within the limits of their
+        tools). Each command is a dictionary with the arguments of run.
+        Returns the list of exit codes, raises after all are done if one
+        of them failed and check is True
+        """
+
+        results = await asyncio.gather(*[self.run(**{'telemetry': telemetry, **cmd, 'check': False})
+                                         for cmd in commands],
+                                       return_exceptions=True)
+        if check:
+            for cmd, result in zip(commands, results):
+                if isinstance(result, BaseException):
+                    raise result
+                if result != 0:
+                    raise subprocess.CalledProcessError(result, cmd.get('tool') or cmd['argv'][0])
+        return results
+
+    def submit(self, coro):
+
+        """
+        Run a coroutine to completion from synchronous code: on our
+        event loop if it is running in another thread, otherwise on a
+        new one
+        """
+
+        loop = self.loop
+        if loop is not None and loop.is_running():
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is not loop:
+                return asyncio.run_coroutine_threadsafe(coro, loop).result()
+        return asyncio.run(coro)
+
+    def run_sync(self, argv, **kwargs):
+        """ Synchronous version of run """
+        return self.submit(self.run(argv, **kwargs))
+
+    def run_all_sync(self, commands, check=True, telemetry=None):
+        """ Synchronous version of run_all """
+        return self.submit(self.run_all(commands, check=check, telemetry=telemetry))
+
+    async def run_threads(self, funcs, nthreads):
+
+        """
+        Run a list of blocking callables on a pool of nthreads threads,
+        with this event loop available to them for the commands they
+        run through run_sync. Returns their results (or exceptions)
+        """
+
+        import concurrent.futures
+        self.loop = asyncio.get_running_loop()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+                futures = [self.loop.run_in_executor(executor, func) for func in funcs]
+                return await asyncio.gather(*futures, return_exceptions=True)
+        finally:
+            self.loop = None
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+
+ A pipelined scheduler for many small dependency graphs, i.e. the
+ per-tile graph of color_tile:
+
+   funpack[band] -> stiff[band] -> png[band] -> TN[band] \
+   funpack[g,r,i] -> stiff[RGB] -> png[RGB] -> TN[RGB]    -> clean
+
+ Every task runs as soon as its dependencies are done, so the stages of
+ different tiles interleave and there is no barrier between stages:
+   - external commands (argv) go through a projectlib_runner.Runner,
+     with per-tool concurrency limits
+   - Python functions run on one long-lived process pool
+   - small inline functions run on a thread of the main process
+ A bounded number of groups (tiles) is in flight at once, so the
+ funpacked files do not pile up on the scratch disk.
+
+ With a projectlib_telemetry.Telemetry every task that runs is a
+ stage of the records, with the group as job, and the resource usage
+ of its command (if any). The tasks run concurrently, so the CPU and
+ I/O of the python process in a record are not only those of its task.
+
+ The progress is kept in a SQLite file: on a re-run the tasks (and
+ whole tiles) that are done are skipped, so a crashed run of thousands
+ of tiles continues where it stopped. Only tasks with outputs are
+ skipped, the ones without outputs run again.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import time
+import asyncio
+import contextlib
+import sqlite3
+import traceback
+import subprocess
+import concurrent.futures
+
+from projectDECam import projectlib_runner
+
+
+class Task:
+
+    """
+    A node of the graph: an external command (argv, or a callable that
+    returns it when the task starts), a function to run on the process
+    pool, or an inline function to run on a thread of the main process
+    """
+
+    def __init__(self, name, deps=(), argv=None, func=None, args=(), inline=False,
+                 tool=None, outputs=()):
+
+        self.name = name
+        self.deps = list(deps)
+        self.argv = argv
+        self.func = func
+        self.args = tuple(args)
+        self.inline = inline
+        self.tool = tool or ('python' if argv is None else None)
+        self.outputs = list(outputs)
+
+    def outputs_exist(self):
+        return bool(self.outputs) and all(os.path.exists(f) for f in self.outputs)
+
+
+class Progress:
+
+    """ The SQLite record of the tasks and groups that are done """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tasks (
+        name    TEXT PRIMARY KEY,
+        status  TEXT,
+        start   REAL,
+        wall    REAL
+    );
+    CREATE TABLE IF NOT EXISTS groups (
+        name    TEXT PRIMARY KEY,
+        status  TEXT,
+        done    REAL
+    );
+    """
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.con = sqlite3.connect(filename, timeout=60)
+        self.con.executescript(self.SCHEMA)
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def task_done(self, name):
+        row = self.con.execute("SELECT status FROM tasks WHERE name=?", (name,)).fetchone()
+        return row is not None and row[0] == 'ok'
+
+    def group_done(self, name):
+        row = self.con.execute("SELECT status FROM groups WHERE name=?", (name,)).fetchone()
+        return row is not None and row[0] == 'ok'
+
+    def record_task(self, name, status, start, wall):
+        with self.con:
+            self.con.execute("INSERT OR REPLACE INTO tasks VALUES (?,?,?,?)", (name, status, start, wall))
+
+    def record_group(self, name, status):
+        with self.con:
+            self.con.execute("INSERT OR REPLACE INTO groups VALUES (?,?,?)", (name, status, time.time()))
+
+    def reset_group(self, name, tasks):
+
+        """ Forget a group and its tasks (i.e. to --force them) """
+
+        with self.con:
+            self.con.execute("DELETE FROM groups WHERE name=?", (name,))
+            self.con.executemany("DELETE FROM tasks WHERE name=?", [(t.name,) for t in tasks])
+
+
+def remove_files(filenames):
+
+    """ Remove a list of files, if they exist """
+
+    for filename in filenames:
+        if os.path.exists(filename):
+            print(f"# Removing: {filename}")
+            os.remove(filename)
+    return
+
+
+class Scheduler:
+
+    """
+    Run groups (i.e. tiles) of dependent tasks, interleaving the groups
+    on a persistent process pool and the runner's tool limits
+    """
+
+    def __init__(self, runner=None, nworkers=None, max_groups=None, progress=None,
+                 skip_existing=True, telemetry=None):
+
+        self.runner = runner or projectlib_runner.Runner()
+        self.nworkers = nworkers or os.cpu_count()
+        self.max_groups = max_groups or self.nworkers
+        self.progress = progress
+        self.skip_existing = skip_existing
+        self.telemetry = telemetry
+        self.pool = None
+
+    async def run_task(self, task, group=None):
+
+        """ Run a single task (of a group), returns 'ok' or 'failed' """
+
+        # A task without outputs only sets state in memory (i.e. the
+        # levels of color_tile), so it always runs again
+        if self.progress is not None and self.progress.task_done(task.name) and task.outputs_exist():
+            return 'ok'
+        if self.skip_existing and task.outputs_exist():
+            print(f"# {task.name}: outputs exist -- skipping")
+            return 'ok'
+
+        # One record per task, i.e. job=DES0000-3000 stage=stiff:g
+        telemetry = None
+        stage = contextlib.nullcontext({})
+        if self.telemetry is not None:
+            telemetry = self.telemetry.for_job(group or task.name)
+            prefix = f"{group}:"
+            stage = telemetry.stage(task.name[len(prefix):] if group and task.name.startswith(prefix)
+                                    else task.name)
+
+        loop = asyncio.get_running_loop()
+        t0 = time.time()
+        status = 'ok'
+        with stage as record:
+            try:
+                if task.argv is not None:
+                    argv = task.argv() if callable(task.argv) else task.argv
+                    await self.runner.run(argv, tool=task.tool, prefix=task.name, telemetry=telemetry)
+                elif task.inline:
+                    await loop.run_in_executor(None, task.func, *task.args)
+                else:
+                    async with self.runner.semaphore(task.tool):
+                        await loop.run_in_executor(self.pool, task.func, *task.args)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as err:
+                status = 'failed'
+                print(f"# ERROR: {task.name} failed: {err}")
+            except Exception:
+                status = 'failed'
+                print(f"# ERROR: {task.name} failed")
+                traceback.print_exc()
+            if status != 'ok':
+                record['status'] = status
+        if self.progress is not None:
+            self.progress.record_task(task.name, status, t0, time.time() - t0)
+        return status
+
+    async def run_group(self, name, tasks, slots):
+
+        """ Run the tasks of a group as soon as their dependencies are done """
+
+        if self.progress is not None and self.progress.group_done(name):
+            print(f"# {name}: done in a previous run -- skipping")
+            return 'ok'
+
+        async with slots:
+            t0 = time.time()
+            print(f"# {name}: starting {len(tasks)} tasks")
+            futures = {}
+
+            async def node(task):
+                for dep in task.deps:
+                    if await futures[dep] != 'ok':
+                        print(f"# {task.name}: skipped, {dep} did not succeed")
+                        return 'skipped'
+                return await self.run_task(task, group=name)
+
+            for task in tasks:
+                futures[task.name] = asyncio.ensure_future(node(task))
+            results = await asyncio.gather(*futures.values())
+            status = 'ok' if all(r == 'ok' for r in results) else 'failed'
+            if self.progress is not None:
+                self.progress.record_group(name, status)
+            print(f"# {name}: {status} in {time.time()-t0:.2f}s")
+            return status
+
+    async def run(self, groups):
+
+        """
+        Run a list of (name, tasks) groups. Returns the names of the
+        groups that failed
+        """
+
+        t0 = time.time()
+        slots = asyncio.Semaphore(self.max_groups)
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.nworkers)
+        try:
+            results = await asyncio.gather(*[self.run_group(name, tasks, slots)
+                                             for name, tasks in groups])
+        finally:
+            self.pool.shutdown()
+            self.pool = None
+        failed = [name for (name, _), status in zip(groups, results) if status != 'ok']
+        print(f"# Scheduled {len(groups)} groups ({len(failed)} failed) in {time.time()-t0:.2f}s")
+        return failed
+
+    def run_sync(self, groups):
+        """ Synchronous version of run """
+        return asyncio.run(self.run(groups))
@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+
+"""
+
+ A resident projection service: a long-running process that takes
+ exposures one at a time (as they arrive on the ingest nodes) and runs
+ them through project_DECam_fromlist on a pool of warm workers.
+
+ A projectDECamPNG call pays every time for importing matplotlib/pylab,
+ fitsio, despyastro and drawDECam, and for probing $PATH and
+ $PROJECTDECAM_DIR. Here this is done once:
+   - the workers are forked from a forkserver that has the heavy
+     modules already imported, also when they are recycled after
+     --max_tasks_per_child jobs
+   - the tools and configuration files are checked once at start-up
+   - the job options are parsed with the projectDECamPNG parser, with
+     the options of the service as defaults
+
+ Jobs come in through a Unix socket, a spool directory or both:
+
+   socket: one JSON request per line, one JSON reply per line
+     {"op": "submit", "imglist": ..., "basename": ..., "catlist": ...,
+      "args": ["--engine", "numpy"], "options": {"grayscale": 0.95}}
+     {"op": "status", "id": ...}   {"op": "wait", "id": ...}
+     {"op": "list"}   {"op": "stats"}   {"op": "shutdown"}
+
+   spool: SPOOL/incoming/*.json files with the same keys as submit,
+     moved to SPOOL/running/ while they run and written to
+     SPOOL/done/ or SPOOL/failed/ with their status and timings
+
+ At most --max_queue jobs wait for a worker: a submit over the socket
+ gets a 'busy' reply when the queue is full (the client retries), and
+ spool files are only picked up when there is room, so they wait on
+ disk. Every job records its queue wait, run time and the wall time of
+ its stages.
+
+ When a worker dies (i.e. killed by the OOM killer) every job in
+ flight on its pool fails with BrokenProcessPool. The pool is replaced
+ once, and the jobs are retried up to MAX_RETRIES times, as we cannot
+ tell which of them killed it.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import socket
+import asyncio
+import importlib
+import collections
+import multiprocessing
+import concurrent.futures
+
+# The modules that the workers should have imported, projectlib_fromlist
+# only imports the heavy ones in the stages that use them
+PRELOAD = ['projectDECam.projectlib_fromlist', 'projectDECam.projectlib_batch',
+           'projectDECam.projectlib_numpy', 'projectDECam.projectlib_footprint',
+           'PIL.Image', 'despyastro.wcsutil']
+
+# The sub-directories of the spool
+SPOOL_DIRS = ['incoming', 'running', 'done', 'failed']
+
+# Number of finished jobs we keep in memory for status requests
+HISTORY = 1000
+
+# Times a job is retried after its worker died
+MAX_RETRIES = 1
+
+
+def warm():
+
+    """
+    Import the heavy modules and check the tools and configuration
+    once. Returns the projectlib_fromlist and projectlib_batch modules
+    """
+
+    t0 = time.time()
+    for module in PRELOAD:
+        importlib.import_module(module)
+    from projectDECam import projectlib_fromlist as proj
+    from projectDECam import projectlib_batch as batch
+    print(f"# Imported the projection modules in {time.time()-t0:.2f}s")
+    for program in ('swarp', 'stiff'):
+        proj.inpath(program, verb='yes')
+    projectdecam_dir = os.environ.get('PROJECTDECAM_DIR')
+    if projectdecam_dir is None:
+        print("# WARNING: PROJECTDECAM_DIR is not defined, only --engine numpy --stretch numpy will work")
+    else:
+        for config in ('default.swarp', 'default.stiff'):
+            filename = os.path.join(projectdecam_dir, 'etc', config)
+            if not os.path.exists(filename):
+                print(f"# WARNING: {filename} not found")
+    return proj, batch
+
+
+class Job:
+
+    """ A projection request and its status and timings """
+
+    def __init__(self, kwargs, source='socket', spoolfile=None):
+
+        self.id = uuid.uuid4().hex[:12]
+        self.kwargs = kwargs
+        self.source = source
+        self.spoolfile = spoolfile
+        self.state = 'queued'
+        self.status = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.stages = {}
+        self.error = None
+        self.retries = 0
+        self.done = asyncio.Event()
+
+    @property
+    def basename(self):
+        return self.kwargs['basename']
+
+    def record(self):
+
+        """ The status and timings as a dictionary """
+
+        now = time.time()
+        wait = (self.started or now) - self.submitted
+        run = (self.finished or now) - self.started if self.started else 0.0
+        return {'id': self.id,
+                'basename': self.basename,
+                'source': self.source,
+                'state': self.state,
+                'status': self.status,
+                'error': self.error,
+                'retries': self.retries,
+                'submitted': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.submitted)),
+                'wait': round(wait, 3),
+                'run': round(run, 3),
+                'stages': {stage: round(wall, 3) for stage, wall in self.stages.items()}}
+
+
+class Service:
+
+    """
+    Run projection jobs from a Unix socket and/or a spool directory on
+    a pool of warm worker processes, with a bounded queue
+    """
+
+    def __init__(self, socket_path=None, spooldir=None, nworkers=1, ncores=0, max_queue=8,
+                 max_tasks_per_child=0, poll=2.0, scratchdir=None, defaults=None):
+
+        if not socket_path and not spooldir:
+            raise ValueError("Need a socket and/or a spool directory")
+
+        self.socket_path = socket_path
+        self.spooldir = spooldir
+        self.nworkers = max(1, nworkers)
+        self.ncores = ncores
+        self.max_queue = max(1, max_queue)
+        self.max_tasks_per_child = max_tasks_per_child
+        self.poll = poll
+        self.scratchdir = scratchdir
+        self.defaults = dict(defaults or {})
+
+        self.proj, self.batch = warm()
+        self.parser = self.proj.build_parser()
+        self.parser.set_defaults(**self.defaults)
+
+        # Split the cores between the workers, like the batch mode
+        _, nthreads = self.batch.split_cores(self.nworkers, nproc=self.nworkers, ncores=ncores)
+        for key in ('NTHREADS_swarp', 'NTHREADS_stiff', 'NTHREADS_png'):
+            if not self.defaults.get(key):
+                self.parser.set_defaults(**{key: nthreads})
+
+        self.jobs = collections.OrderedDict()
+        self.claimed = set()
+        self.counts = collections.Counter()
+        self.queue = None
+        self.pool = None
+        self.stopping = None
+
+    def new_pool(self):
+
+        """ The worker pool, forked from a forkserver with the modules imported """
+
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(PRELOAD)
+        kwargs = {'max_workers': self.nworkers, 'mp_context': context}
+        if self.max_tasks_per_child:
+            kwargs['max_tasks_per_child'] = self.max_tasks_per_child
+        return concurrent.futures.ProcessPoolExecutor(**kwargs)
+
+    def make_job(self, request, source='socket', spoolfile=None):
+
+        """
+        Build a Job from a request: the args are parsed with the
+        projectDECamPNG parser and the options override them. Raises
+        ValueError for a bad request
+        """
+
+        for key in ('imglist', 'basename'):
+            if not request.get(key):
+                raise ValueError(f"Missing {key} in request")
+        argv = [request['imglist'], request['basename']]
+        if request.get('catlist'):
+            argv += ['--catlist', request['catlist']]
+        argv += [str(arg) for arg in request.get('args') or []]
+        try:
+            args = self.parser.parse_args(argv)
+        except SystemExit:
+            raise ValueError(f"Cannot parse the options: {' '.join(argv[2:])}")
+        kwargs = vars(args)
+        for key, value in (request.get('options') or {}).items():
+            if key not in kwargs:
+                raise ValueError(f"Unknown option: {key}")
+            kwargs[key] = value
+        self.proj.check_options(args)
+        if not kwargs['cataloglist']:
+            kwargs['noEll'] = True
+        return Job(kwargs, source=source, spoolfile=spoolfile)
+
+    def submit(self, job):
+
+        """ Queue a job, returns False if the queue is full """
+
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return False
+        self.jobs[job.id] = job
+        self.counts['submitted'] += 1
+        print(f"# Queued {job.id}: {job.basename} ({self.queue.qsize()}/{self.max_queue} in queue)")
+        # Forget the oldest finished jobs
+        finished = [jid for jid, j in self.jobs.items() if j.finished]
+        for jid in finished[:max(0, len(finished) - HISTORY)]:
+            del self.jobs[jid]
+        return True
+
+    async def run_job(self, job):
+
+        """
+        Run a job on the pool, retrying it on a new pool (up to
+        MAX_RETRIES times) if a worker died
+        """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            pool = self.pool
+            try:
+                _, job.status, _, job.stages = await loop.run_in_executor(
+                    pool, self.batch.run_job, {'kwargs': job.kwargs, 'scratchdir': self.scratchdir})
+                return
+            except concurrent.futures.process.BrokenProcessPool as err:
+                # All the jobs of the pool get here, only the first one
+                # replaces it
+                if self.pool is pool:
+                    print(f"# WARNING: a worker died running {job.id}, starting a new pool")
+                    pool.shutdown(wait=False)
+                    self.pool = self.new_pool()
+                if job.retries >= MAX_RETRIES:
+                    job.status = 1
+                    job.error = f"worker died: {err}"
+                    return
+                job.retries += 1
+                self.counts['retried'] += 1
+                print(f"# Retrying {job.id}: {job.basename} ({job.retries}/{MAX_RETRIES})")
+
+    async def worker(self):
+
+        """ Take jobs from the queue and run them on the pool """
+
+        while True:
+            job = await self.queue.get()
+            job.state = 'running'
+            job.started = time.time()
+            print(f"# Starting {job.id}: {job.basename} (waited {job.started-job.submitted:.2f}s)")
+            try:
+                if job.spoolfile:
+                    job.spoolfile = self.spool_move(job.spoolfile, 'running')
+                await self.run_job(job)
+            except Exception as err:
+                job.status = 1
+                job.error = f"{type(err).__name__}: {err}"
+            job.finished = time.time()
+            job.state = 'done' if job.status == 0 else 'failed'
+            self.counts[job.state] += 1
+            record = job.record()
+            if job.spoolfile:
+                self.spool_result(job, record)
+            print(f"# {job.state.upper()} {job.id}: {job.basename} in {record['run']:.2f}s "
+                  f"(waited {record['wait']:.2f}s) stages: {record['stages']}")
+            sys.stdout.flush()
+            job.done.set()
+            self.queue.task_done()
+
+    def stats(self):
+
+        """ The counts of the service """
+
+        running = sum(1 for job in self.jobs.values() if job.state == 'running')
+        return {'queued': self.queue.qsize(), 'running': running, 'max_queue': self.max_queue,
+                'nworkers': self.nworkers, **self.counts}
+
+    async def handle_request(self, request):
+
+        """ The reply to a socket request """
+
+        op = request.get('op', 'submit')
+        if op == 'submit':
+            if self.stopping.is_set():
+                return {'ok': False, 'error': 'shutting down'}
+            try:
+                job = self.make_job(request)
+            except ValueError as err:
+                return {'ok': False, 'error': str(err)}
+            if not self.submit(job):
+                return {'ok': False, 'error': 'busy', **self.stats()}
+            return {'ok': True, 'id': job.id, **self.stats()}
+        if op in ('status', 'wait'):
+            job = self.jobs.get(request.get('id'))
+            if job is None:
+                return {'ok': False, 'error': f"Unknown job: {request.get('id')}"}
+            if op == 'wait':
+                await job.done.wait()
+            return {'ok': True, **job.record()}
+        if op == 'list':
+            return {'ok': True, 'jobs': [job.record() for job in self.jobs.values()]}
+        if op == 'stats':
+            return {'ok': True, **self.stats()}
+        if op == 'shutdown':
+            self.stopping.set()
+            return {'ok': True, **self.stats()}
+        return {'ok': False, 'error': f"Unknown op: {op}"}
+
+    async def handle_client(self, reader, writer):
+
+        """ Serve the JSON-lines requests of a socket client """
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    reply = {'ok': False, 'error': 'Cannot decode the request'}
+                else:
+                    reply = await self.handle_request(request)
+                writer.write((json.dumps(reply, default=str) + "\n").encode())
+                await writer.drain()
+        # The client went away, or the service is stopping
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def spool_path(self, subdir, filename=None):
+        path = os.path.join(self.spooldir, subdir)
+        return os.path.join(path, os.path.basename(filename)) if filename else path
+
+    def spool_move(self, filename, subdir):
+        target = self.spool_path(subdir, filename)
+        os.replace(filename, target)
+        return target
+
+    def spool_result(self, job, record):
+
+        """ Write the record of a spool job next to its request """
+
+        target = self.spool_path(job.state, job.spoolfile)
+        tmpfile = f"{target}.tmp"
+        with open(job.spoolfile) as fobj:
+            request = json.load(fobj)
+        with open(tmpfile, 'w') as fobj:
+            json.dump({'request': request, 'result': record}, fobj, indent=2, default=str)
+        os.replace(tmpfile, target)
+        os.remove(job.spoolfile)
+        self.claimed.discard(os.path.basename(target))
+        return
+
+    async def watch_spool(self):
+
+        """ Pick up the spool requests, oldest first, while there is room in the queue """
+
+        for subdir in SPOOL_DIRS:
+            os.makedirs(self.spool_path(subdir), exist_ok=True)
+        # Requests left running by a previous service go back in line
+        for filename in os.listdir(self.spool_path('running')):
+            if filename.endswith('.json'):
+                print(f"# Re-queueing {filename} from a previous run")
+                os.replace(self.spool_path('running', filename), self.spool_path('incoming', filename))
+
+        while not self.stopping.is_set():
+            incoming = self.spool_path('incoming')
+            names = [name for name in os.listdir(incoming)
+                     if name.endswith('.json') and name not in self.claimed]
+            names.sort(key=lambda name: os.path.getmtime(os.path.join(incoming, name)))
+            for name in names:
+                if self.queue.full():
+                    break
+                filename = os.path.join(incoming, name)
+                try:
+                    with open(filename) as fobj:
+                        request = json.load(fobj)
+                    job = self.make_job(request, source='spool', spoolfile=filename)
+                except (OSError, ValueError) as err:
+                    print(f"# ERROR: bad spool request {name}: {err}")
+                    with open(self.spool_path('failed', name) + '.error', 'w') as fobj:
+                        fobj.write(f"{err}\n")
+                    self.spool_move(filename, 'failed')
+                    continue
+                self.claimed.add(name)
+                self.submit(job)
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=self.poll)
+            except asyncio.TimeoutError:
+                pass
+
+    async def serve(self):
+
+        """ Run the service until it is told to shut down """
+
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        t0 = time.time()
+        self.pool = self.new_pool()
+        # Start the workers now, not on the first job
+        await asyncio.gather(*[loop.run_in_executor(self.pool, time.sleep, 0)
+                               for _ in range(self.nworkers)])
+        print(f"# Started {self.nworkers} workers in {time.time()-t0:.2f}s")
+
+        workers = [asyncio.ensure_future(self.worker()) for _ in range(self.nworkers)]
+        tasks = []
+        server = None
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+            print(f"# Listening on {self.socket_path}")
+        if self.spooldir:
+            tasks.append(asyncio.ensure_future(self.watch_spool()))
+            print(f"# Watching {self.spooldir}/incoming")
+        sys.stdout.flush()
+
+        await self.stopping.wait()
+        print(f"# Shutting down, waiting for {self.queue.qsize()} queued jobs")
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+            os.remove(self.socket_path)
+        await asyncio.gather(*tasks)
+        await self.queue.join()
+        for worker in workers:
+            worker.cancel()
+        self.pool.shutdown()
+        print(f"# Service done: {dict(self.counts)}")
+        return
+
+    def run(self):
+        asyncio.run(self.serve())
+
+
+def request(socket_path, message, timeout=None):
+
+    """
+    Send a request (dictionary) to the service over its Unix socket and
+    return the reply
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(message) + "\n").encode())
+        data = b''
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+def submit(socket_path, imglist, basename, catlist=None, args=(), options=None,
+           wait=False, retry=5.0):
+
+    """
+    Submit a job to the service, retrying while it is busy. With wait,
+    return the record of the job when it is done
+    """
+
+    message = {'op': 'submit', 'imglist': os.path.abspath(imglist), 'basename': os.path.abspath(basename),
+               'catlist': os.path.abspath(catlist) if catlist else None,
+               'args': list(args), 'options': options or {}}
+    while True:
+        reply = request(socket_path, message)
+        if reply.get('error') != 'busy':
+            break
+        print(f"# Service busy ({reply['queued']} queued) -- retrying in {retry}s")
+        time.sleep(retry)
+    if wait and reply.get('ok'):
+        reply = request(socket_path, {'op': 'wait', 'id': reply['id']})
+    return reply
+
+
+def spool_submit(spooldir, imglist, basename, catlist=None, args=(), options=None):
+
+    """ Drop a job in the spool directory, returns the request file """
+
+    message = {'imglist': os.path.abspath(imglist), 'basename': os.path.abspath(basename),
+               'catlist': os.path.abspath(catlist) if catlist else None,
+               'args': list(args), 'options': options or {}}
+    incoming = os.path.join(spooldir, 'incoming')
+    os.makedirs(incoming, exist_ok=True)
+    filename = os.path.join(incoming, f"{os.path.basename(basename)}_{uuid.uuid4().hex[:8]}.json")
+    # Written aside and renamed, so the service never reads a partial file
+    tmpfile = os.path.join(spooldir, f".{os.path.basename(filename)}")
+    with open(tmpfile, 'w') as fobj:
+        json.dump(message, fobj, indent=2)
+    os.replace(tmpfile, filename)
+    return filename
+
+
+def cmdline():
+
+    """ Parse the command line arguments and options of the service """
+
+    import argparse
+    from projectDECam import projectlib_fromlist as proj
+
+    USAGE = "\n"
+    USAGE = USAGE + "  %(prog)s --socket <path> [--spool <dir>] [options] \n"
+    USAGE = USAGE + "  i.e.: \n"
+    USAGE = USAGE + "  %(prog)s --socket /tmp/projectDECam.sock --nworkers 2 --engine numpy\n"
+
+    epilog = "Author: Felipe Menanteau, NCSA/University of Illinois (felipe@illinois.edu)"
+    description = "Resident service that projects DECam exposures submitted over a Unix socket " \
+                  "or a spool directory on a pool of warm workers. The per-exposure options " \
+                  "are the defaults of the jobs"
+    parser = argparse.ArgumentParser(usage=USAGE,
+                                     epilog=epilog,
+                                     description=description,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--socket", dest='socket_path', action="store", default=None,
+                        help="Unix socket to listen on")
+    parser.add_argument("--spool", dest='spooldir', action="store", default=None,
+                        help="Spool directory to watch (incoming/running/done/failed)")
+    parser.add_argument("--nworkers", type=int, default=1,
+                        help="Number of exposures to process concurrently")
+    parser.add_argument("--ncores", type=int, default=0,
+                        help="Total number of cores to split between the workers [0=all]")
+    parser.add_argument("--max_queue", type=int, default=8,
+                        help="Max number of jobs waiting for a worker")
+    parser.add_argument("--max_tasks_per_child", type=int, default=0,
+                        help="Recycle a worker after this many jobs [0=never]")
+    parser.add_argument("--poll", type=float, default=2.0,
+                        help="Seconds between scans of the spool directory")
+    proj.add_options(parser)
+
+    args = parser.parse_args()
+    if not args.socket_path and not args.spooldir:
+        parser.error("Need --socket and/or --spool")
+    args = proj.check_options(args)
+
+    print("# Will run:")
+    print(f"# {parser.prog}")
+    for key, val in sorted(vars(args).items()):
+        print("# \t--%-10s\t%s" % (key, val))
+    return args
+
+
+def service_kwargs(args):
+
+    """ Split the parsed options into the Service arguments and the job defaults """
+
+    kwargs = vars(args)
+    service = {key: kwargs.pop(key) for key in ('socket_path', 'spooldir', 'nworkers', 'ncores',
+                                                 'max_queue', 'max_tasks_per_child', 'poll')}
+    service['scratchdir'] = kwargs.pop('scratchdir')
+    service['defaults'] = kwargs
+    return service
+
+
+def submit_cmdline():
+
+    """ Parse the command line arguments and options of the client """
+
+    import argparse
+
+    USAGE = "\n"
+    USAGE = USAGE + "  %(prog)s (--socket <path> | --spool <dir>) <imglist> <basename> [projectDECamPNG options]\n"
+    USAGE = USAGE + "  %(prog)s --socket <path> (--status <id> | --list | --stats | --shutdown)\n"
+    USAGE = USAGE + "  i.e.: \n"
+    USAGE = USAGE + "  %(prog)s --socket /tmp/projectDECam.sock imglist /someplace/somename --wait --grayscale 0.95\n"
+
+    description = "Submit DECam exposures to the projectDECamService, the options that are not " \
+                  "listed here are passed to the job as projectDECamPNG options"
+    parser = argparse.ArgumentParser(usage=USAGE, description=description)
+    parser.add_argument("imglist", nargs='?', default=None,
+                        help="Image list to project")
+    parser.add_argument("basename", nargs='?', default=None,
+                        help="Output Directory w/BASENAME")
+    parser.add_argument("--catlist", dest='cataloglist', default=None,
+                        help="List of catalogs")
+    parser.add_argument("--socket", dest='socket_path', default=None,
+                        help="Unix socket of the service")
+    parser.add_argument("--spool", dest='spooldir', default=None,
+                        help="Spool directory of the service")
+    parser.add_argument("--wait", action="store_true", default=False,
+                        help="Wait for the job and print its status and timings")
+    parser.add_argument("--retry", type=float, default=5.0,
+                        help="Seconds to wait before re-submitting when the service is busy")
+    parser.add_argument("--status", dest='jobid', default=None,
+                        help="Print the status of a job")
+    parser.add_argument("--list", action="store_true", default=False,
+                        help="List the jobs of the service")
+    parser.add_argument("--stats", action="store_true", default=False,
+                        help="Print the counts of the service")
+    parser.add_argument("--shutdown", action="store_true", default=False,
+                        help="Stop the service once the queued jobs are done")
+    args, job_args = parser.parse_known_args()
+    if not args.socket_path and not args.spooldir:
+        parser.error("Need --socket or --spool")
+    query = args.jobid or args.list or args.stats or args.shutdown
+    if query and not args.socket_path:
+        parser.error("--status/--list/--stats/--shutdown need --socket")
+    if not query and not (args.imglist and args.basename):
+        parser.error("Need <imglist> and <basename>")
+    args.job_args = job_args
+    return args
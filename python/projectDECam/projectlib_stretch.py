@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+"""
+
+ In-process intensity stretch and PNG writer, a NumPy replacement for
+ the stiff -> JPEG/TIFF -> PIL -> PNG round-trip in
+ project_DECam_fromlist.stiff_exposure.
+
+ It reproduces the stiff settings that we use:
+   -SKY_TYPE     AUTO
+   -MIN_TYPE     GREYLEVEL  -MIN_LEVEL 0.005
+   -MAX_TYPE     QUANTILE   -MAX_LEVEL --grayscale
+   -GAMMA_TYPE   POWER-LAW  -GAMMA     2.2
+   -SATUR_LEVEL  40000.0
+ and writes the 8-bit array directly as a PNG, with the same
+ orientation as stiff (north up, first FITS row at the bottom).
+
+ The module can also be run as a script to compare its output with a
+ stiff-made PNG (regression check):
+
+   python -m projectDECam.projectlib_stretch file_proj.fits stiff.png --grayscale 0.98
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import time
+
+import fitsio
+import numpy
+
+from projectDECam import projectlib_quantile
+from projectDECam import projectlib_pngmeta
+from projectDECam import projectlib_pngenc
+
+# Relative error of the quantiles used for the levels
+REL_ERR = 0.001
+
+
+def stiff_levels(data=None, max_level=0.98, min_level=0.005, gamma=2.2,
+                 satur_level=40000.0, sketch=None, rel_err=REL_ERR):
+
+    """
+    Compute the (sky, min, max) display levels like stiff does with
+    SKY_TYPE AUTO, MIN_TYPE GREYLEVEL and MAX_TYPE QUANTILE
+    ----------
+    data: 2D array
+        The image
+    max_level: float
+        The quantile of the max level (--grayscale)
+    min_level: float
+        The grey level (0-1) at which the sky is displayed
+    gamma: float
+        The display gamma
+    satur_level: float
+        Pixels above it are considered saturated
+    sketch: projectlib_quantile.QuantileSketch, optional
+        A pre-computed quantile sketch of the image, otherwise
+        computed from data
+    """
+
+    if sketch is None:
+        sketch = projectlib_quantile.sketch_array(data, rel_err=rel_err, satur_level=satur_level)
+    if sketch.count == 0:
+        return 0.0, 0.0, 1.0
+
+    sky = sketch.median()
+    vmax = sketch.quantile(max_level)
+    vmin = min_from_greylevel(sky, vmax, min_level, gamma)
+    return sky, vmin, vmax
+
+
+def min_from_greylevel(sky, vmax, min_level=0.005, gamma=2.2):
+
+    """
+    The min level for which the sky is displayed at a given grey level
+    (MIN_TYPE GREYLEVEL), i.e. ((sky-min)/(max-min))**(1/gamma) = min_level
+    """
+
+    g = min_level**gamma
+    return (sky - g*vmax)/(1.0 - g)
+
+
+def stretch(data, vmin, vmax, gamma=2.2, satur_level=40000.0, flip=True, out=None, nrows=1024):
+
+    """
+    Stretch an image into an 8-bit array with a power-law gamma,
+    working on strips of rows to keep the temporaries small
+    ----------
+    data: 2D array
+        The image
+    vmin, vmax: float
+        The display levels
+    gamma: float
+        The display gamma
+    satur_level: float
+        Pixels above it are displayed white
+    flip: bool
+        Flip the rows so the first FITS row is at the bottom (as stiff)
+    out: 2D uint8 array, optional
+        Pre-allocated output
+    nrows: int
+        Number of rows per strip
+    """
+
+    ny, nx = data.shape
+    if out is None:
+        out = numpy.empty((ny, nx), dtype=numpy.uint8)
+    scale = 1.0/(vmax - vmin) if vmax > vmin else 1.0
+    for j0 in range(0, ny, nrows):
+        j1 = min(j0 + nrows, ny)
+        strip = numpy.asarray(data[j0:j1], dtype='f4')
+        satur = strip >= satur_level
+        x = (strip - vmin)*scale
+        numpy.clip(x, 0.0, 1.0, out=x)
+        x[satur] = 1.0
+        x[~numpy.isfinite(strip)] = 0.0
+        numpy.power(x, 1.0/gamma, out=x)
+        x *= 255.0
+        x += 0.5
+        if flip:
+            out[ny-j1:ny-j0] = x[::-1].astype(numpy.uint8)
+        else:
+            out[j0:j1] = x.astype(numpy.uint8)
+    return out
+
+
+def stretch_image(data, max_level=0.98, min_level=0.005, gamma=2.2, satur_level=40000.0, flip=True):
+
+    """ Compute the stiff-like levels and stretch an image into 8-bit """
+
+    sky, vmin, vmax = stiff_levels(data, max_level=max_level, min_level=min_level,
+                                   gamma=gamma, satur_level=satur_level)
+    print(f"# Stretch levels -- sky: {sky:.4f} min: {vmin:.4f} max: {vmax:.4f}")
+    return stretch(data, vmin, vmax, gamma=gamma, satur_level=satur_level, flip=flip)
+
+
+def stretch_file(filename, ext=0, max_level=0.98, min_level=0.005, gamma=2.2,
+                 satur_level=40000.0, flip=True, subsample=1):
+
+    """
+    Stretch a FITS image into 8-bit reading it in strips of rows, so
+    only the 8-bit output is ever fully in memory. The levels come from
+    a first streaming pass, optionally subsampled
+    """
+
+    sketch = projectlib_quantile.sketch_file(filename, ext=ext, rel_err=REL_ERR,
+                                             subsample=subsample, satur_level=satur_level)
+    sky, vmin, vmax = stiff_levels(max_level=max_level, min_level=min_level, gamma=gamma,
+                                   sketch=sketch)
+    print(f"# Stretch levels -- sky: {sky:.4f} min: {vmin:.4f} max: {vmax:.4f}")
+
+    with fitsio.FITS(filename) as fits:
+        ny, nx = fits[ext].get_dims()
+    out = numpy.empty((ny, nx), dtype=numpy.uint8)
+    for r0, strip in projectlib_quantile.iter_strips(filename, ext=ext):
+        r1 = r0 + strip.shape[0]
+        if flip:
+            stretch(strip, vmin, vmax, gamma=gamma, satur_level=satur_level,
+                    flip=True, out=out[ny-r1:ny-r0])
+        else:
+            stretch(strip, vmin, vmax, gamma=gamma, satur_level=satur_level,
+                    flip=False, out=out[r0:r1])
+    return out
+
+
+def write_png(filename, array8, compress_level=6, pnginfo=None, text=None, png_filter=None,
+              nthreads=None, verb=True):
+
+    """
+    Write an 8-bit (grayscale or RGB) array as a PNG with the
+    multi-threaded encoder (projectlib_pngenc), or with PIL when a PIL
+    pnginfo is given
+    ----------
+    compress_level: int
+        The zlib compression level (0-9)
+    text: dict, optional
+        The key:value text chunks (i.e. the WCS)
+    png_filter: str, optional
+        The PNG filter [default=projectlib_pngenc.DEFAULT_FILTER]
+    nthreads: int, optional
+        Number of encoding threads [default=number of cores]
+    """
+
+    if pnginfo is not None:
+        from PIL import Image
+        Image.fromarray(array8).save(filename, "png", compress_level=compress_level, pnginfo=pnginfo)
+        return
+    projectlib_pngenc.write_png(filename, array8, level=compress_level,
+                                png_filter=png_filter or projectlib_pngenc.DEFAULT_FILTER,
+                                nthreads=nthreads, text=text, verb=verb)
+    return
+
+
+def tif2png(tiffile, pngfile, fitsfile, copyright="DES Collaboration", **kwargs):
+
+    """
+    Transform a stiff tif into a png, with the WCS of the FITS file
+    it was made from as text chunks
+    ----------
+    tiffile: str
+        The tif file from stiff
+    pngfile: str
+        The png to write
+    fitsfile: str
+        The FITS file with the WCS (i.e. the funpacked band)
+    kwargs:
+        The options of write_png
+    """
+
+    from PIL import Image
+    text = projectlib_pngmeta.wcs_text(fitsio.read_header(fitsfile), copyright=copyright)
+    print(f"# Adding WCS information to {pngfile}")
+    with Image.open(tiffile) as im:
+        write_png(pngfile, numpy.asarray(im), text=text, **kwargs)
+    return
+
+
+def stretch_png(filename, pngfile, ext=0, max_level=0.98, min_level=0.005, gamma=2.2,
+                satur_level=40000.0, subsample=1, compress_level=6, copyright="DES Collaboration"):
+
+    """
+    Stretch a FITS image straight into a png with its WCS, reading it in
+    strips of rows. This works on tile-compressed (fpacked) HDUs too, so
+    the image is never decompressed to disk
+    ----------
+    filename: str
+        The FITS (or .fz) file
+    pngfile: str
+        The png to write
+    ext: int
+        The HDU of the image (1 for fpacked files)
+    """
+
+    t0 = time.time()
+    array8 = stretch_file(filename, ext=ext, max_level=max_level, min_level=min_level,
+                          gamma=gamma, satur_level=satur_level, subsample=subsample)
+    text = projectlib_pngmeta.wcs_text(fitsio.read_header(filename, ext=ext), copyright=copyright)
+    write_png(pngfile, array8, compress_level=compress_level, text=text)
+    print(f"# Wrote {pngfile} from {filename}[{ext}] in {time.time()-t0:.2f}s")
+    return
+
+
+def regression_check(fitsfile, stiff_png, max_level=0.98, tol=2.0, outpng=None):
+
+    """
+    Stretch a projected FITS file and compare with the PNG made by
+    stiff from the same file. Returns (passed, stats) where passed
+    means a mean absolute difference below tol grey levels
+    """
+
+    data = fitsio.read(fitsfile)
+    array8 = stretch_image(data, max_level=max_level)
+    if outpng:
+        write_png(outpng, array8)
+    from PIL import Image
+    a2 = numpy.asarray(Image.open(stiff_png).convert("L"), dtype='i2')
+    if a2.shape != array8.shape:
+        raise ValueError(f"Shapes differ: {array8.shape} vs {a2.shape}")
+    diff = numpy.abs(array8.astype('i2') - a2)
+    stats = {'mean_abs': float(diff.mean()),
+             'p99_abs': float(numpy.percentile(diff, 99)),
+             'max_abs': int(diff.max())}
+    return stats['mean_abs'] <= tol, stats
+
+
+def cmdline():
+
+    """ Parse the command line arguments for the regression check """
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare the NumPy stretch of a "
+                                     "_proj.fits file with the PNG made by stiff",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("fitsfile", help="The projected FITS file")
+    parser.add_argument("stiffpng", help="The PNG made with stiff from fitsfile")
+    parser.add_argument("--grayscale", type=float, default=0.98,
+                        help="grayscale used for the stiff png")
+    parser.add_argument("--tol", type=float, default=2.0,
+                        help="Max mean absolute difference in grey levels")
+    parser.add_argument("--outpng", default=None,
+                        help="Write the NumPy PNG to this file")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    import sys
+    args = cmdline()
+    t0 = time.time()
+    passed, stats = regression_check(args.fitsfile, args.stiffpng,
+                                     max_level=args.grayscale, tol=args.tol,
+                                     outpng=args.outpng)
+    for key, val in stats.items():
+        print(f"# {key:10s}: {val}")
+    print(f"# Regression check {'PASSED' if passed else 'FAILED'} in {time.time()-t0:.2f}s")
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+"""
+
+ Synthetic DECam data for the benchmarks, so they can run on a plain
+ Linux box without the archive, SWarp or stiff:
+
+   - 62-CCD exposures, one multi-extension FITS file per CCD with
+     SCI[0], MSK[1] and WGT[2] HDUs and a TAN WCS placing the CCD in
+     the DECam focal plane (optionally centered on RA=0 to exercise
+     the crossing)
+   - matching SExtractor LDAC catalogs (LDAC_IMHEAD + LDAC_OBJECTS)
+     with a configurable number of objects
+   - coadd tiles (one FITS or fpacked .fits.fz file per band) for
+     color_tile
+   - fast stand-in swarp, stiff and funpack executables, that take the
+     same command lines we build and produce the same kind of outputs
+     using projectlib_numpy, projectlib_stretch and fitsio
+
+ The CCDs can be shrunk by an integer factor (with a larger pixel
+ scale, so the geometry on the sky is the same) to keep the size of
+ the benchmark data reasonable.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import sys
+import stat
+import time
+
+import fitsio
+import numpy
+from despyastro import wcsutil
+
+from projectDECam import projectlib_numpy
+from projectDECam import projectlib_stretch
+from projectDECam.projectlib_quicklook import CCD_NX, CCD_NY, decam_layout
+
+# The columns of the synthetic LDAC catalogs
+CATALOG_DTYPE = [('NUMBER', 'i4'),
+                 ('X_IMAGE', 'f4'),
+                 ('Y_IMAGE', 'f4'),
+                 ('ALPHA_J2000', 'f8'),
+                 ('DELTA_J2000', 'f8'),
+                 ('FLUX_AUTO', 'f4'),
+                 ('A_IMAGE', 'f4'),
+                 ('B_IMAGE', 'f4'),
+                 ('KRON_RADIUS', 'f4'),
+                 ('THETA_IMAGE', 'f4'),
+                 ('IMAFLAGS_ISO', 'i4')]
+
+
+def ccd_header(ra0, dec0, x_fp, y_fp, shrink=1, band='r', expnum=1, ccdnum=1, detpos='N1'):
+
+    """
+    The header of a CCD centered at (x_fp, y_fp) native pixels from the
+    exposure center (ra0, dec0). The image x axis runs along Dec and the
+    y axis along RA, as in the DECam reduced images
+    """
+
+    nx = CCD_NX//shrink
+    ny = CCD_NY//shrink
+    scale = projectlib_numpy.INPUT_PIXEL_SCALE*shrink/3600.
+    header = {'NAXIS': 2,
+              'NAXIS1': nx,
+              'NAXIS2': ny,
+              'CTYPE1': 'RA---TAN',
+              'CTYPE2': 'DEC--TAN',
+              'CRVAL1': ra0 % 360.0,
+              'CRVAL2': dec0,
+              'CRPIX1': (nx+1)/2.0 - y_fp/shrink,
+              'CRPIX2': (ny+1)/2.0 + x_fp/shrink,
+              'CD1_1': 0.0,
+              'CD1_2': -scale,
+              'CD2_1': scale,
+              'CD2_2': 0.0,
+              'EQUINOX': 2000.0,
+              'RADESYS': 'ICRS',
+              'BAND': band,
+              'FILTER': f"{band} DECam SDSS c0001 0000.0 0000.0",
+              'EXPNUM': expnum,
+              'EXPTIME': 90.0,
+              'CCDNUM': ccdnum,
+              'DETPOS': detpos,
+              'SATURATE': 40000.0}
+    return header
+
+
+def fits_records(header):
+    """ A header dictionary as fitsio records, without the NAXIS keys """
+    return [{'name': key, 'value': value} for key, value in header.items()
+            if key not in ('NAXIS', 'NAXIS1', 'NAXIS2')]
+
+
+def fake_sources(nobjects, nx, ny, psf=1.0, rng=None):
+
+    """
+    Random point/extended sources on a (ny,nx) image: returns a
+    structured array with the CATALOG_DTYPE columns (no sky positions)
+    """
+
+    if rng is None:
+        rng = numpy.random.default_rng(1)
+    cat = numpy.zeros(nobjects, dtype=CATALOG_DTYPE)
+    cat['NUMBER'] = numpy.arange(1, nobjects+1)
+    cat['X_IMAGE'] = rng.uniform(1, nx, nobjects)
+    cat['Y_IMAGE'] = rng.uniform(1, ny, nobjects)
+    # Power-law number counts
+    cat['FLUX_AUTO'] = 200.0*(1.0 - rng.uniform(0, 0.999, nobjects))**(-1.5)
+    cat['A_IMAGE'] = psf*(1.0 + rng.exponential(0.5, nobjects))
+    cat['B_IMAGE'] = cat['A_IMAGE']*rng.uniform(0.3, 1.0, nobjects)
+    cat['KRON_RADIUS'] = 3.5
+    cat['THETA_IMAGE'] = rng.uniform(-90, 90, nobjects)
+    cat['IMAFLAGS_ISO'] = (rng.uniform(0, 1, nobjects) < 0.05).astype('i4')
+    return cat
+
+
+def render_sources(image, cat, stamp=7):
+
+    """ Add the sources of a catalog as elliptical gaussians on an image """
+
+    ny, nx = image.shape
+    half = stamp//2
+    dy, dx = numpy.mgrid[-half:half+1, -half:half+1]
+    x0 = numpy.round(cat['X_IMAGE']).astype(int) - 1
+    y0 = numpy.round(cat['Y_IMAGE']).astype(int) - 1
+    # Vectorized over objects in batches, to bound the memory
+    batch = 100000
+    for k in range(0, len(cat), batch):
+        c = cat[k:k+batch]
+        xs = x0[k:k+batch, None, None] + dx[None]
+        ys = y0[k:k+batch, None, None] + dy[None]
+        ddx = xs + 1 - c['X_IMAGE'][:, None, None]
+        ddy = ys + 1 - c['Y_IMAGE'][:, None, None]
+        theta = numpy.radians(c['THETA_IMAGE'])[:, None, None]
+        u = ddx*numpy.cos(theta) + ddy*numpy.sin(theta)
+        v = -ddx*numpy.sin(theta) + ddy*numpy.cos(theta)
+        a = c['A_IMAGE'][:, None, None]
+        b = c['B_IMAGE'][:, None, None]
+        prof = numpy.exp(-0.5*((u/a)**2 + (v/b)**2))
+        prof *= (c['FLUX_AUTO']/(2*numpy.pi*c['A_IMAGE']*c['B_IMAGE']))[:, None, None]
+        good = (xs >= 0) & (xs < nx) & (ys >= 0) & (ys < ny)
+        numpy.add.at(image, (ys[good], xs[good]), prof[good].astype(image.dtype))
+    return image
+
+
+def write_ldac(catfile, cat, header):
+
+    """ Write a catalog in the SExtractor FITS_LDAC format """
+
+    cards = "".join([f"{key:8s}= {value!r:>20}"[:80].ljust(80) for key, value in header.items()])
+    imhead = numpy.zeros(1, dtype=[('Field Header Card', f"S{len(cards)}")])
+    imhead['Field Header Card'][0] = cards.encode()
+    with fitsio.FITS(catfile, 'rw', clobber=True) as fits:
+        fits.write(imhead, extname='LDAC_IMHEAD')
+        fits.write(cat, extname='LDAC_OBJECTS')
+    return
+
+
+def make_exposure(outdir, nobjects=50000, ra=30.0, dec=-30.0, cross_ra0=False, shrink=8,
+                  band='r', expnum=1, sky=1000.0, nccds=62, seed=1, catalogs=True):
+
+    """
+    Write a synthetic DECam exposure (one MEF file per CCD) and its
+    LDAC catalogs. Returns the lists of image and catalog files
+    ----------
+    outdir: str
+        The directory for the files
+    nobjects: int
+        Number of objects in the exposure
+    ra, dec: float
+        The center of the exposure, ignored in RA if cross_ra0
+    cross_ra0: bool
+        Center the exposure on RA=0, so the CCDs cross it
+    shrink: int
+        Shrink the CCDs by this factor (and increase the pixel scale)
+    nccds: int
+        Number of CCDs to write (the first nccds of the focal plane)
+    """
+
+    t0 = time.time()
+    os.makedirs(outdir, exist_ok=True)
+    if cross_ra0:
+        ra = 0.0
+    rng = numpy.random.default_rng(seed)
+    psf = 1.0/(projectlib_numpy.INPUT_PIXEL_SCALE*shrink)
+    layout = decam_layout()[:nccds]
+    nper = numpy.bincount(rng.integers(0, len(layout), nobjects), minlength=len(layout))
+
+    imgfiles = []
+    catfiles = []
+    for (ccdnum, detpos, x_fp, y_fp), nobj in zip(layout, nper):
+        header = ccd_header(ra, dec, x_fp, y_fp, shrink=shrink, band=band,
+                            expnum=expnum, ccdnum=ccdnum, detpos=detpos)
+        nx = header['NAXIS1']
+        ny = header['NAXIS2']
+        sci = rng.normal(sky, numpy.sqrt(sky), (ny, nx)).astype('f4')
+        cat = fake_sources(nobj, nx, ny, psf=max(psf, 0.5), rng=rng)
+        render_sources(sci, cat)
+        msk = numpy.zeros((ny, nx), dtype='i2')
+        # A bad column on every CCD
+        msk[:, nx//3] = 1
+        wgt = numpy.full((ny, nx), 1.0/sky, dtype='f4')
+        wgt[msk > 0] = 0.0
+
+        name = f"D{expnum:08d}_{band}_c{ccdnum:02d}"
+        imgfile = os.path.join(outdir, f"{name}_immasked.fits")
+        with fitsio.FITS(imgfile, 'rw', clobber=True) as fits:
+            fits.write(sci, header=fits_records(header), extname='SCI')
+            fits.write(msk, extname='MSK')
+            fits.write(wgt, extname='WGT')
+        imgfiles.append(imgfile)
+
+        if catalogs:
+            wcs = wcsutil.WCS(header)
+            cat['ALPHA_J2000'], cat['DELTA_J2000'] = wcs.image2sky(cat['X_IMAGE'], cat['Y_IMAGE'])
+            catfile = os.path.join(outdir, f"{name}_cat.fits")
+            write_ldac(catfile, cat, header)
+            catfiles.append(catfile)
+
+    print(f"# Wrote synthetic exposure {expnum} ({len(imgfiles)} CCDs, {nobjects} objects) "
+          f"in {time.time()-t0:.2f}s")
+    return imgfiles, catfiles
+
+
+def write_list(filename, files):
+    """ Write a list of files, one per line """
+    with open(filename, 'w') as fobj:
+        for fname in files:
+            fobj.write(f"{fname}\n")
+    return filename
+
+
+def make_tile(outdir, tilename='DES0000-3000', bands=('g', 'r', 'i', 'z', 'Y'), size=2500,
+              nobjects=20000, ra=0.5, dec=-30.0, pixscale=0.263, sky=0.0, seed=1, fpack=False):
+
+    """
+    Write a synthetic coadd tile, one (funpacked) FITS file per band
+    with the same sources and band-dependent fluxes, or with fpack=True
+    a .fits.fz per band with the image tile-compressed in HDU 1, as in
+    the archive. Returns a dictionary of filenames per band
+    """
+
+    t0 = time.time()
+    os.makedirs(outdir, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    header = projectlib_numpy.tan_header(ra, dec, pixscale, nx=size, ny=size,
+                                         crpix1=(size+1)/2.0, crpix2=(size+1)/2.0)
+    cat = fake_sources(nobjects, size, size, psf=1.0/pixscale, rng=rng)
+    colors = rng.normal(0.0, 0.5, nobjects)
+    files = {}
+    for k, band in enumerate(bands):
+        image = rng.normal(sky, 5.0, (size, size)).astype('f4')
+        bcat = cat.copy()
+        bcat['FLUX_AUTO'] = cat['FLUX_AUTO']*10**(-0.4*colors*(k - len(bands)/2.0))
+        render_sources(image, bcat)
+        filename = os.path.join(outdir, f"{tilename}_{band}.fits")
+        if fpack:
+            filename += ".fz"
+            with fitsio.FITS(filename, 'rw', clobber=True) as fits:
+                fits.write(None)
+                fits.write(image, header=fits_records(header), compress='rice')
+        else:
+            fitsio.write(filename, image, header=fits_records(header), clobber=True)
+        files[band] = filename
+    print(f"# Wrote synthetic tile {tilename} ({len(bands)} bands, {size}x{size}) "
+          f"in {time.time()-t0:.2f}s")
+    return files
+
+
+def parse_args(argv):
+
+    """
+    Split a SWarp/stiff command line into the input files and a
+    dictionary of -KEY value options
+    """
+
+    files = []
+    opts = {}
+    k = 0
+    while k < len(argv):
+        arg = argv[k]
+        if arg.startswith('-') and len(arg) > 1 and not arg[1].isdigit():
+            value = argv[k+1] if k+1 < len(argv) else ''
+            opts[arg[1:].upper()] = value
+            k += 2
+        else:
+            files.extend([f for f in arg.split(',') if f])
+            k += 1
+    return files, opts
+
+
+def stub_swarp(argv):
+
+    """
+    A fast stand-in for SWarp: a nearest-neighbour weighted projection
+    of the inputs with projectlib_numpy. Honors -IMAGEOUT_NAME,
+    -WEIGHTOUT_NAME, -PIXEL_SCALE, -WEIGHT_THRESH and -SUBTRACT_BACK
+    """
+
+    files, opts = parse_args(argv)
+    imgfiles = [f.split('[')[0] for f in files]
+    if not imgfiles:
+        print("stub swarp: no input files", file=sys.stderr)
+        return 1
+    pixscale = float(opts.get('PIXEL_SCALE', 1.0))
+    weight_thresh = opts.get('WEIGHT_THRESH')
+    image, wsum, header = projectlib_numpy.project_exposure(
+        imgfiles,
+        pixscale=pixscale,
+        weight_thresh=float(weight_thresh) if weight_thresh else None,
+        noBack=opts.get('SUBTRACT_BACK', 'Y').upper().startswith('N'))
+    projectlib_numpy.write_projection(opts.get('IMAGEOUT_NAME', 'coadd.fits'), image, header,
+                                      weight=wsum,
+                                      weightname=opts.get('WEIGHTOUT_NAME', 'coadd.weight.fits'))
+    return 0
+
+
+def stub_stiff(argv):
+
+    """
+    A fast stand-in for stiff: stretch one (grayscale) or three (RGB)
+    FITS files with projectlib_stretch and write -OUTFILE_NAME as a
+    TIFF. MANUAL max levels are honored, quantiles otherwise
+    """
+
+    from PIL import Image
+
+    files, opts = parse_args(argv)
+    if not files:
+        print("stub stiff: no input files", file=sys.stderr)
+        return 1
+    outfile = opts.get('OUTFILE_NAME', 'stiff.tif')
+    max_levels = opts.get('MAX_LEVEL', '0.98').split(',')
+    sky_levels = opts.get('SKY_LEVEL', '0.0').split(',')
+    manual = opts.get('MAX_TYPE', 'QUANTILE').upper() == 'MANUAL'
+    manual_sky = opts.get('SKY_TYPE', 'AUTO').upper() == 'MANUAL'
+
+    channels = []
+    for k, filename in enumerate(files):
+        level = float(max_levels[min(k, len(max_levels)-1)])
+        data = fitsio.read(filename.split('[')[0]).astype('f4')
+        if manual:
+            if manual_sky:
+                sky = float(sky_levels[min(k, len(sky_levels)-1)])
+            else:
+                sky = projectlib_stretch.stiff_levels(data)[0]
+            vmin = projectlib_stretch.min_from_greylevel(sky, level)
+            channels.append(projectlib_stretch.stretch(data, vmin, level))
+        else:
+            channels.append(projectlib_stretch.stretch_image(data, max_level=level))
+    if len(channels) == 1:
+        array8 = channels[0]
+    else:
+        array8 = numpy.dstack(channels[:3])
+    Image.fromarray(array8).save(outfile, "tiff")
+    return 0
+
+
+def stub_funpack(argv):
+
+    """
+    A stand-in for funpack: write the (tile-compressed) HDU -E of the
+    input as a plain FITS file -O
+    """
+
+    files, opts = parse_args(argv)
+    if not files or 'O' not in opts:
+        print("stub funpack: need -O and an input file", file=sys.stderr)
+        return 1
+    data, header = fitsio.read(files[0], ext=int(opts.get('E', 1)), header=True)
+    header.clean()
+    fitsio.write(opts['O'], data, header=header, clobber=True)
+    return 0
+
+
+def write_stubs(bindir):
+
+    """
+    Write the stand-in swarp, stiff and funpack executables to bindir,
+    to be put first in the PATH. Returns bindir
+    """
+
+    os.makedirs(bindir, exist_ok=True)
+    for tool in ('swarp', 'stiff', 'funpack'):
+        exe = os.path.join(bindir, tool)
+        with open(exe, 'w') as fobj:
+            fobj.write(f"#!{sys.executable}\n"
+                       "import sys\n"
+                       "from projectDECam import projectlib_synthetic\n"
+                       f"sys.exit(projectlib_synthetic.stub_{tool}(sys.argv[1:]))\n")
+        os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bindir
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+
+ Structured per-stage performance telemetry for projectDECamPNG and
+ color_tile.
+
+ For every stage we record:
+   - wall time
+   - user/sys CPU of the python process and of its children (SWarp,
+     stiff, funpack...) from resource.getrusage(RUSAGE_CHILDREN)
+   - the number, CPU and peak RSS of the commands of the stage, from
+     the os.wait4 of projectlib_runner (add_command)
+   - peak RSS of the process and of the children of the stage
+   - bytes read and written by the process (/proc/self/io) and the
+     block I/O of the children
+   - any counts we add (CCDs, objects, bands...)
+
+ The records are appended as JSON lines to a file, and can also be
+ exported as a Prometheus textfile (for the node_exporter textfile
+ collector).
+
+ Typical use:
+
+   telemetry = Telemetry(jsonfile='run.jsonl', job='DECam_00229650')
+   with telemetry.stage('swarp', nccds=62):
+       runner.run_sync(swarp_argv, tool='swarp', telemetry=telemetry)
+   telemetry.write_prometheus('projectDECam.prom')
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import json
+import time
+import socket
+import resource
+import threading
+import contextlib
+
+# Block size of ru_inblock/ru_oublock
+BLOCK_SIZE = 512
+
+
+def proc_io():
+
+    """ The bytes read/written by this process from /proc/self/io (Linux) """
+
+    io = {'read_bytes': 0, 'write_bytes': 0, 'rchar': 0, 'wchar': 0}
+    try:
+        with open('/proc/self/io') as fobj:
+            for line in fobj:
+                key, value = line.split(':')
+                if key in io:
+                    io[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return io
+
+
+def snapshot():
+
+    """ A snapshot of the resource usage of the process and its children """
+
+    now = time.time()
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = proc_io()
+    return {'time': now,
+            'user': me.ru_utime,
+            'sys': me.ru_stime,
+            'maxrss_kb': me.ru_maxrss,
+            'child_user': children.ru_utime,
+            'child_sys': children.ru_stime,
+            'child_maxrss_kb': children.ru_maxrss,
+            'child_inblock': children.ru_inblock,
+            'child_oublock': children.ru_oublock,
+            'rchar': io['rchar'],
+            'wchar': io['wchar'],
+            'read_bytes': io['read_bytes'],
+            'write_bytes': io['write_bytes']}
+
+
+class Telemetry:
+
+    """
+    Collect per-stage resource usage records and write them as JSON
+    lines and/or a Prometheus textfile
+    """
+
+    def __init__(self, jsonfile=None, promfile=None, job=None, prefix='projectdecam', verb=True):
+
+        self.jsonfile = jsonfile
+        self.promfile = promfile
+        self.job = job
+        self.prefix = prefix
+        self.verb = verb
+        self.records = []
+        self.current = None
+        self.parent = None
+        self._lock = threading.Lock()
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+
+    @property
+    def enabled(self):
+        if self.parent is not None:
+            return self.parent.enabled
+        return bool(self.jsonfile or self.promfile)
+
+    def for_job(self, job):
+
+        """
+        A Telemetry for one job (i.e. a tile or a task of a scheduled
+        run) with its own running stage, that adds its records to ours
+        and to our JSON lines file. Stages that run concurrently need
+        one each, as add_command goes to the running stage
+        """
+
+        child = Telemetry(jsonfile=self.jsonfile, job=job, prefix=self.prefix, verb=self.verb)
+        child.records = self.records
+        child.parent = self
+        return child
+
+    def add(self, **counts):
+
+        """ Add counts (i.e. nccds, nobjects) to the running stage """
+
+        if self.current is not None:
+            self.current.update(counts)
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+
+        """ Context manager that records the resource usage of a stage """
+
+        parent = self.current
+        record = {'job': self.job, 'stage': name, 'host': self.host, 'pid': self.pid,
+                  'commands': 0, 'cmd_user': 0.0, 'cmd_sys': 0.0, 'cmd_maxrss_kb': 0, 'status': 'ok'}
+        record.update(counts)
+        self.current = record
+        t0 = snapshot()
+        try:
+            yield record
+        except BaseException as err:
+            record['status'] = f"error: {type(err).__name__}"
+            raise
+        finally:
+            t1 = snapshot()
+            self.current = parent
+            # The peak RSS of the children is over the life of the
+            # process, it only tells about this stage if it went up
+            child_maxrss = t1['child_maxrss_kb'] if t1['child_maxrss_kb'] > t0['child_maxrss_kb'] else 0
+            record.update({'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(t0['time'])),
+                           'wall': t1['time'] - t0['time'],
+                           'cpu_user': t1['user'] - t0['user'],
+                           'cpu_sys': t1['sys'] - t0['sys'],
+                           'child_user': t1['child_user'] - t0['child_user'],
+                           'child_sys': t1['child_sys'] - t0['child_sys'],
+                           'maxrss_kb': t1['maxrss_kb'],
+                           'child_maxrss_kb': max(child_maxrss, record['cmd_maxrss_kb']),
+                           'read_bytes': t1['read_bytes'] - t0['read_bytes'],
+                           'write_bytes': t1['write_bytes'] - t0['write_bytes'],
+                           'rchar': t1['rchar'] - t0['rchar'],
+                           'wchar': t1['wchar'] - t0['wchar'],
+                           'child_read_bytes': (t1['child_inblock'] - t0['child_inblock'])*BLOCK_SIZE,
+                           'child_write_bytes': (t1['child_oublock'] - t0['child_oublock'])*BLOCK_SIZE})
+            self.records.append(record)
+            self.write_record(record)
+
+    def add_command(self, rusage):
+
+        """
+        Add the resource usage of a command (from os.wait4, i.e. by
+        projectlib_runner) to the running stage. On Linux the peak RSS
+        of a command is at least the RSS of the python process that
+        spawned it, the memory of the fork counts until the exec
+        """
+
+        with self._lock:
+            if self.current is None:
+                return
+            self.current['commands'] += 1
+            self.current['cmd_user'] += rusage.ru_utime
+            self.current['cmd_sys'] += rusage.ru_stime
+            self.current['cmd_maxrss_kb'] = max(self.current['cmd_maxrss_kb'], rusage.ru_maxrss)
+
+    def write_record(self, record):
+
+        """ Append a record to the JSON lines file """
+
+        if self.verb and self.enabled:
+            print(f"# [telemetry] {record['stage']}: wall={record['wall']:.2f}s "
+                  f"cpu={record['cpu_user']+record['cpu_sys']:.2f}s "
+                  f"child_cpu={record['child_user']+record['child_sys']:.2f}s "
+                  f"maxrss={record['maxrss_kb']/1024.:.0f}MB "
+                  f"child_maxrss={record['child_maxrss_kb']/1024.:.0f}MB")
+        if not self.jsonfile:
+            return
+        with open(self.jsonfile, 'a') as fobj:
+            fobj.write(json.dumps(record, sort_keys=True, default=str) + "\n")
+
+    def write_prometheus(self, promfile=None):
+
+        """
+        Write the per-stage metrics of this run as a Prometheus textfile,
+        atomically so the collector never reads a partial file
+        """
+
+        promfile = promfile or self.promfile
+        if not promfile or not self.records:
+            return
+        metrics = [('wall', 'wall_seconds', 'Wall time of the stage'),
+                   ('cpu_user', 'cpu_user_seconds', 'User CPU of the python process'),
+                   ('cpu_sys', 'cpu_sys_seconds', 'System CPU of the python process'),
+                   ('child_user', 'child_cpu_user_seconds', 'User CPU of the child processes'),
+                   ('child_sys', 'child_cpu_sys_seconds', 'System CPU of the child processes'),
+                   ('maxrss_kb', 'maxrss_kilobytes', 'Peak RSS of the python process'),
+                   ('child_maxrss_kb', 'child_maxrss_kilobytes', 'Peak RSS of the child processes'),
+                   ('commands', 'commands', 'Number of external commands of the stage'),
+                   ('cmd_maxrss_kb', 'cmd_maxrss_kilobytes', 'Peak RSS of the external commands'),
+                   ('read_bytes', 'read_bytes', 'Bytes read by the python process'),
+                   ('write_bytes', 'write_bytes', 'Bytes written by the python process')]
+        lines = []
+        for key, name, help_text in metrics:
+            metric = f"{self.prefix}_stage_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for record in self.records:
+                labels = f'job="{record["job"]}",stage="{record["stage"]}"'
+                lines.append(f"{metric}{{{labels}}} {record[key]}")
+        tmpfile = f"{promfile}.{os.getpid()}.tmp"
+        with open(tmpfile, 'w') as fobj:
+            fobj.write("\n".join(lines) + "\n")
+        os.replace(tmpfile, promfile)
+        return
+
+    def close(self):
+        self.write_prometheus()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+"""
+
+ A local (SQLite) index of the coadd tiles for color_tile:
+
+   tag -> tilename -> run -> band -> archive path
+
+ A sync step materializes a whole coadd tag (i.e. SVA1_COADD) from the
+ DESAR database with three bulk queries, once. After that the tiles
+ are resolved from the local index without touching the database, so
+ processing thousands of tiles does not cost thousands of full-tag
+ scans. The database is only needed to refresh a tag.
+
+ The database connection is opened lazily and kept, so all the
+ refreshes in a process share it. Instead of DESAR we can use a local
+ stand-in SQLite database with the same tables (archive_sites, coadd,
+ runtag, location, filepath_desar), see make_standin_db.
+
+ Author:
+  Felipe Menanteau, NCSA
+
+"""
+
+import os
+import time
+import sqlite3
+
+# The default location of the index, can be changed with the
+# PROJECTDECAM_TILEINDEX environment variable
+DEFAULT_INDEX = os.path.join(os.path.expanduser('~'), '.cache', 'projectDECam', 'tiles.sqlite')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    tag          TEXT PRIMARY KEY,
+    archive_root TEXT,
+    synced       REAL
+);
+CREATE TABLE IF NOT EXISTS tiles (
+    tag      TEXT,
+    tilename TEXT,
+    run      TEXT,
+    PRIMARY KEY (tag, tilename)
+);
+CREATE TABLE IF NOT EXISTS paths (
+    run   TEXT,
+    band  TEXT,
+    path  TEXT,
+    PRIMARY KEY (run, band)
+);
+"""
+
+# The bulk queries for a tag, with named binds (Oracle and SQLite)
+QUERY_ARCHIVE_ROOT = "select archive_root from archive_sites where location_name='desardata'"
+QUERY_TILES = """select distinct tilename, run from coadd
+where run in (select distinct run from runtag where tag=:tag)"""
+QUERY_PATHS = """select location.run, location.band, filepath_desar.path
+from filepath_desar, location
+where filepath_desar.id=location.id and location.filetype='coadd'
+and location.run in (select distinct run from runtag where tag=:tag)"""
+
+# The database connections, kept for the life of the process
+_DBH = {}
+
+
+def default_indexfile():
+
+    """ The index file from PROJECTDECAM_TILEINDEX or the default location """
+
+    return os.environ.get('PROJECTDECAM_TILEINDEX', DEFAULT_INDEX)
+
+
+def get_dbh(section='db-desoper', services=None, standin=None):
+
+    """
+    Get a (shared) database connection: DESAR through despydb or, if
+    standin is given, a local SQLite stand-in database
+    ----------
+    section: str
+        The section of the des_services file
+    services: str, optional
+        The des_services file [default=$des_services]
+    standin: str, optional
+        A SQLite file with the DESAR tables, for tests/benchmarks
+    """
+
+    if standin:
+        key = ('sqlite', standin)
+    else:
+        if services is None:
+            services = os.environ.get('des_services')
+        key = (services, section)
+    if key not in _DBH:
+        if standin:
+            print(f"# Using stand-in database: {standin}")
+            _DBH[key] = sqlite3.connect(standin)
+        else:
+            import despydb.desdbi
+            _DBH[key] = despydb.desdbi.DesDbi(services, section)
+    return _DBH[key]
+
+
+class TileIndex:
+
+    """ The local SQLite index of tiles, runs and band paths per tag """
+
+    def __init__(self, indexfile=None):
+
+        if indexfile is None:
+            indexfile = default_indexfile()
+        self.indexfile = indexfile
+        indexdir = os.path.dirname(self.indexfile)
+        if indexdir and not os.path.exists(indexdir):
+            os.makedirs(indexdir, exist_ok=True)
+        self.con = sqlite3.connect(self.indexfile, timeout=60)
+        self.con.executescript(SCHEMA)
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def has_tag(self, tag):
+
+        """ True if the tag has been synced """
+
+        row = self.con.execute("SELECT synced FROM tags WHERE tag=?", (tag,)).fetchone()
+        return row is not None
+
+    def sync(self, dbh, tag):
+
+        """
+        Materialize a tag from the database into the index, replacing
+        what we had for it (the tiles of the tag and the band paths of
+        its runs). Returns the number of tiles
+        """
+
+        t0 = time.time()
+        print(f"# Syncing tile index for {tag} into {self.indexfile}")
+        cur = dbh.cursor()
+        cur.execute(QUERY_ARCHIVE_ROOT)
+        archive_root = cur.fetchone()[0]
+        cur.execute(QUERY_TILES, {'tag': tag})
+        tiles = [(tag, tilename, run) for tilename, run in cur]
+        cur.execute(QUERY_PATHS, {'tag': tag})
+        paths = [(run, band, path) for run, band, path in cur]
+        cur.close()
+
+        runs = sorted({run for _, _, run in tiles} | {run for run, _, _ in paths})
+        with self.con:
+            self.con.execute("DELETE FROM tiles WHERE tag=?", (tag,))
+            # The bands a run no longer has must go too
+            self.con.executemany("DELETE FROM paths WHERE run=?", [(run,) for run in runs])
+            self.con.executemany("INSERT OR REPLACE INTO tiles VALUES (?,?,?)", tiles)
+            self.con.executemany("INSERT OR REPLACE INTO paths VALUES (?,?,?)", paths)
+            self.con.execute("INSERT OR REPLACE INTO tags VALUES (?,?,?)",
+                             (tag, archive_root, time.time()))
+        print(f"# Synced {len(tiles)} tiles and {len(paths)} band files in {time.time()-t0:.2f}s")
+        return len(tiles)
+
+    def tilenames(self, tag):
+
+        """ All the tilenames of a tag """
+
+        rows = self.con.execute("SELECT tilename FROM tiles WHERE tag=? ORDER BY tilename", (tag,))
+        return [row[0] for row in rows]
+
+    def lookup(self, tag, tilename):
+
+        """
+        Resolve a tile: returns (run, {band: full archive path}) or
+        None if the tile is not in the index
+        """
+
+        row = self.con.execute("""SELECT tiles.run, tags.archive_root FROM tiles, tags
+                                  WHERE tiles.tag=tags.tag AND tiles.tag=? AND tiles.tilename=?""",
+                               (tag, tilename)).fetchone()
+        if row is None:
+            return None
+        run, archive_root = row
+        rows = self.con.execute("SELECT band, path FROM paths WHERE run=?", (run,))
+        return run, {band: os.path.join(archive_root, path) for band, path in rows}
+
+
+def make_standin_db(filename, tiles, tag='SVA1_COADD', archive_root='/archive_data/Archive'):
+
+    """
+    Create a local stand-in of the DESAR tables used by color_tile
+    ----------
+    filename: str
+        The SQLite file to write
+    tiles: dict
+        {tilename: {band: path relative to the archive root}}
+    tag: str
+        The coadd tag of the tiles
+    archive_root: str
+        The archive root
+    """
+
+    con = sqlite3.connect(filename)
+    con.executescript("""
+    DROP TABLE IF EXISTS archive_sites;
+    DROP TABLE IF EXISTS coadd;
+    DROP TABLE IF EXISTS runtag;
+    DROP TABLE IF EXISTS location;
+    DROP TABLE IF EXISTS filepath_desar;
+    CREATE TABLE archive_sites (location_name TEXT, archive_root TEXT);
+    CREATE TABLE coadd (tilename TEXT, run TEXT);
+    CREATE TABLE runtag (run TEXT, tag TEXT);
+    CREATE TABLE location (id INTEGER, run TEXT, filetype TEXT, band TEXT);
+    CREATE TABLE filepath_desar (id INTEGER, path TEXT);
+    """)
+    con.execute("INSERT INTO archive_sites VALUES ('desardata', ?)", (archive_root,))
+    fid = 0
+    for k, (tilename, bands) in enumerate(sorted(tiles.items())):
+        run = f"20130904{k:06d}_{tilename}"
+        con.execute("INSERT INTO coadd VALUES (?,?)", (tilename, run))
+        con.execute("INSERT INTO runtag VALUES (?,?)", (run, tag))
+        for band, path in bands.items():
+            fid += 1
+            con.execute("INSERT INTO location VALUES (?,?,'coadd',?)", (fid, run, band))
+            con.execute("INSERT INTO filepath_desar VALUES (?,?)", (fid, path))
+    con.commit()
+    con.close()
+    return filename
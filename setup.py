@@ -9,7 +9,11 @@ setup(name='projectDECam',
       author_email="felipe@illinois.edu",
       packages=['projectDECam'],
       package_dir={'': 'python'},
-      scripts=['bin/projectDECamPNG', ],
+      scripts=['bin/projectDECamPNG',
+               'bin/projectDECamBatch',
+               'bin/projectDECamService',
+               'bin/projectDECamSubmit',
+               'bin/projectDECamCutout', ],
       data_files=[('ups', ['ups/projectDECam.table']),
                   ('etc', ['etc/default.stiff', 'etc/default.swarp'])]
       )
@@ -0,0 +1,11 @@
+"""
+
+ The tests run against the package in python/ (as eups/setup.py
+ install it), without installing it
+
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python'))
@@ -0,0 +1,56 @@
+"""
+
+ The threaded reader and the .npy cache of projectlib_catalogs
+
+"""
+
+import fitsio
+import numpy
+
+from projectDECam import projectlib_catalogs
+
+
+def write_catalog(filename, nobjects, seed):
+    """ A fake LDAC catalog: the objects table in ext=2 """
+    rng = numpy.random.default_rng(seed)
+    table = numpy.zeros(nobjects, dtype=projectlib_catalogs.DTYPE + [('FLUX_AUTO', 'f4')])
+    for name in table.dtype.names:
+        table[name] = rng.uniform(0, 100, nobjects)
+    with fitsio.FITS(filename, 'rw', clobber=True) as fits:
+        fits.write(None)
+        fits.write(numpy.zeros(1, dtype=[('FIELD_HEADER_CARD', 'S80')]), extname='LDAC_IMHEAD')
+        fits.write(table, extname='LDAC_OBJECTS')
+    return table
+
+
+def test_read_catalogs(tmp_path):
+    catfiles = [str(tmp_path / f"c{k}_cat.fits") for k in range(4)]
+    tables = [write_catalog(f, n, k) for k, (f, n) in enumerate(zip(catfiles, [10, 0, 25, 3]))]
+    cat = projectlib_catalogs.read_catalogs(catfiles, nthreads=3)
+    assert cat.dtype == numpy.dtype(projectlib_catalogs.DTYPE)
+    for name in projectlib_catalogs.COLUMNS:
+        expected = numpy.concatenate([t[name] for t in tables]).astype(cat.dtype[name])
+        assert numpy.array_equal(cat[name], expected)
+
+
+def test_cache_follows_the_catalogs(tmp_path):
+    catfiles = [str(tmp_path / f"c{k}_cat.fits") for k in range(3)]
+    for k, filename in enumerate(catfiles):
+        write_catalog(filename, 10 + k, k)
+    cachefile = str(tmp_path / 'expo_cat.npy')
+
+    full = projectlib_catalogs.read_catalogs(catfiles, cachefile=cachefile)
+    assert projectlib_catalogs.cache_is_valid(cachefile, catfiles)
+    assert numpy.array_equal(projectlib_catalogs.read_catalogs(catfiles, cachefile=cachefile), full)
+
+    # A smaller list for the same cache file is not served the stale cache
+    assert not projectlib_catalogs.cache_is_valid(cachefile, catfiles[:2])
+    subset = projectlib_catalogs.read_catalogs(catfiles[:2], cachefile=cachefile)
+    assert len(subset) == 10 + 11
+    assert projectlib_catalogs.cache_is_valid(cachefile, catfiles[:2])
+    assert not projectlib_catalogs.cache_is_valid(cachefile, catfiles)
+
+    # Nor after a catalog is rewritten
+    write_catalog(catfiles[0], 5, 99)
+    assert not projectlib_catalogs.cache_is_valid(cachefile, catfiles[:2])
+    assert len(projectlib_catalogs.read_catalogs(catfiles[:2], cachefile=cachefile)) == 5 + 11
@@ -0,0 +1,43 @@
+"""
+
+ The background of the cutouts of projectlib_cutout
+
+"""
+
+import numpy
+import pytest
+
+pytest.importorskip('despyastro')
+
+from projectDECam import projectlib_numpy  # noqa: E402
+from projectDECam import projectlib_cutout  # noqa: E402
+
+
+@pytest.mark.parametrize("section", [(0, 120, 0, 120), (500, 620, 1000, 1120), (904, 1024, 1930, 2048),
+                                     (127, 129, 1023, 1025)])
+def test_back_window_same_as_full_ccd(section):
+    ny, nx = 2048, 1024
+    rng = numpy.random.default_rng(0)
+    yy, xx = numpy.mgrid[:ny, :nx]
+    sci = (rng.normal(0.0, 1.0, (ny, nx)) + 5.0 + 0.002*xx + 3.0*numpy.sin(yy/300.0)).astype('f4')
+    wgt = numpy.ones_like(sci)
+    wgt[:, :20] = 0.0
+    full = projectlib_numpy.background_map(sci, wgt)
+
+    x0, x1, y0, y1 = section
+    bx0, bx1, by0, by1 = projectlib_cutout.back_window(section, nx, ny)
+    assert bx0 % projectlib_cutout.BACK_SIZE == 0 and by0 % projectlib_cutout.BACK_SIZE == 0
+    back = projectlib_numpy.background_map(sci[by0:by1, bx0:bx1], wgt[by0:by1, bx0:bx1])
+    assert numpy.array_equal(back[y0-by0:y1-by0, x0-bx0:x1-bx0], full[y0:y1, x0:x1])
+
+
+def test_stamp_keeps_source_flux():
+    # A bright source filling a stamp smaller than a mesh is not the background
+    ny, nx = 1024, 1024
+    sci = numpy.full((ny, nx), 10.0, dtype='f4')
+    sci[450:570, 450:570] += 100.0
+    wgt = numpy.ones_like(sci)
+    section = (450, 570, 450, 570)
+    bx0, bx1, by0, by1 = projectlib_cutout.back_window(section, nx, ny)
+    back = projectlib_numpy.background_map(sci[by0:by1, bx0:bx1], wgt[by0:by1, bx0:bx1])
+    assert numpy.allclose(back, 10.0)
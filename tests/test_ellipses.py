@@ -0,0 +1,109 @@
+"""
+
+ The pixel coverage of the raster ellipses of projectlib_ellipses
+
+"""
+
+import math
+
+import numpy
+import pytest
+
+from projectDECam import projectlib_ellipses
+
+
+def outline_pixels(x, y, a, b, theta):
+    """ The (col, row) pixels of one outline, as a set """
+    col, row = projectlib_ellipses.outline_points([x], [y], [a], [b], [theta])
+    return set(zip(col.tolist(), row.tolist()))
+
+
+def dense_pixels(x, y, a, b, theta, nvert=200000):
+    """ The pixels crossed by a densely sampled outline """
+    t = numpy.linspace(0, 2*math.pi, nvert, endpoint=False)
+    th = math.radians(theta)
+    px = x + a*numpy.cos(t)*math.cos(th) - b*numpy.sin(t)*math.sin(th)
+    py = y + a*numpy.cos(t)*math.sin(th) + b*numpy.sin(t)*math.cos(th)
+    col = numpy.floor(px + 0.5).astype(int) - 1
+    row = numpy.floor(py + 0.5).astype(int) - 1
+    return set(zip(col.tolist(), row.tolist()))
+
+
+def neighbours(pixel, pixels):
+    c, r = pixel
+    return sum((c + dc, r + dr) in pixels for dc in (-1, 0, 1) for dr in (-1, 0, 1)
+               if (dc, dr) != (0, 0))
+
+
+@pytest.mark.parametrize("a, b, theta", [(10.0, 10.0, 0.0), (25.0, 6.0, 30.0), (3.0, 1.5, -75.0),
+                                         (120.0, 40.0, 12.5)])
+def test_outline_coverage(a, b, theta):
+    x, y = 200.3, 150.7
+    pixels = outline_pixels(x, y, a, b, theta)
+    dense = dense_pixels(x, y, a, b, theta)
+    # Only pixels the outline crosses. It is drawn 8-connected, so the
+    # corners it barely cuts can be missed, but never more than that
+    assert pixels <= dense
+    assert all(p in pixels or neighbours(p, pixels) >= 1 for p in dense)
+    # A closed 8-connected ring, no gaps
+    assert all(neighbours(p, pixels) >= 2 for p in pixels)
+
+
+def test_outline_vertices_are_connected():
+    col, row = projectlib_ellipses.outline_points([50.0], [50.0], [30.0], [20.0], [45.0])
+    steps = numpy.maximum(numpy.abs(numpy.diff(numpy.append(col, col[0]))),
+                          numpy.abs(numpy.diff(numpy.append(row, row[0]))))
+    assert steps.max() <= 1
+
+
+def test_pixel_convention_and_orientation():
+    rgb = numpy.zeros((20, 30, 3), dtype=numpy.uint8)
+    # A point-like ellipse on FITS pixel (1,1), the bottom-left pixel,
+    # is the first column of the last PNG row
+    projectlib_ellipses.draw_ellipses(rgb, [([1.0], [1.0], [0.0], [0.0], [0.0], projectlib_ellipses.RED)])
+    drawn = numpy.argwhere(rgb.any(axis=2))
+    assert drawn.tolist() == [[19, 0]]
+    assert rgb[19, 0].tolist() == list(projectlib_ellipses.RED)
+
+
+def test_clipping_and_threads():
+    nx, ny = 300, 200
+    x, y, a, b, theta, flags = projectlib_ellipses.fake_objects(2000, nx, ny, seed=9)
+    # Some ellipses across the edges
+    a[:20] *= 30
+    gray = numpy.full((ny, nx), 100, dtype=numpy.uint8)
+    single = projectlib_ellipses.render_overlay(gray, x, y, a, b, theta, flags, nthreads=1)
+    threaded = projectlib_ellipses.render_overlay(gray, x, y, a, b, theta, flags, nthreads=7)
+    assert single.shape == (ny, nx, 3)
+    assert numpy.array_equal(single, threaded)
+    # The image is untouched outside the outlines
+    untouched = (single == 100).all(axis=2)
+    colored = (single == projectlib_ellipses.RED).all(axis=2) | (single == projectlib_ellipses.BLUE).all(axis=2)
+    assert (untouched | colored).all()
+    assert colored.any()
+
+
+def test_flagged_drawn_on_top():
+    gray = numpy.zeros((50, 50), dtype=numpy.uint8)
+    x = numpy.array([25.0, 25.0])
+    y = numpy.array([25.0, 25.0])
+    a = numpy.array([10.0, 10.0])
+    flags = numpy.array([0, 1])
+    rgb = projectlib_ellipses.render_overlay(gray, x, y, a, a, numpy.zeros(2), flags)
+    colored = rgb.any(axis=2)
+    assert (rgb[colored] == projectlib_ellipses.BLUE).all()
+
+
+def test_batches_match_single_ellipses(monkeypatch):
+    nx, ny = 120, 90
+    x, y, a, b, theta, _ = projectlib_ellipses.fake_objects(50, nx, ny, seed=4)
+    # Batches that do not divide the objects
+    monkeypatch.setattr(projectlib_ellipses, 'BATCH', 7)
+    batched = numpy.zeros((ny, nx, 3), dtype=numpy.uint8)
+    projectlib_ellipses.draw_ellipses(batched, [(x, y, a, b, theta, projectlib_ellipses.RED)], nthreads=3)
+    single = numpy.zeros((ny, nx, 3), dtype=numpy.uint8)
+    for k in range(len(x)):
+        projectlib_ellipses.draw_ellipses(single, [(x[k:k+1], y[k:k+1], a[k:k+1], b[k:k+1], theta[k:k+1],
+                                                    projectlib_ellipses.RED)])
+    assert numpy.array_equal(batched, single)
+    assert batched.any()
@@ -0,0 +1,138 @@
+"""
+
+ The multi-threaded PNG encoder of projectlib_pngenc
+
+"""
+
+import zlib
+
+import numpy
+import pytest
+from PIL import Image
+
+from projectDECam import projectlib_pngenc
+from projectDECam import projectlib_pngmeta
+
+
+@pytest.mark.parametrize("len1, len2", [(0, 10), (10, 0), (1, 1), (1000, 65520), (65521, 65522),
+                                        (200000, 300001)])
+def test_adler32_combine(len1, len2):
+    rng = numpy.random.default_rng(len1 + len2)
+    # All 0xff bytes push the sums to their largest values
+    for fill in (None, 255):
+        if fill is None:
+            data = rng.integers(0, 256, len1 + len2, dtype=numpy.uint8).tobytes()
+        else:
+            data = bytes([fill])*(len1 + len2)
+        block1, block2 = data[:len1], data[len1:]
+        combined = projectlib_pngenc.adler32_combine(zlib.adler32(block1), zlib.adler32(block2), len2)
+        assert combined == zlib.adler32(data)
+
+
+def test_adler32_combine_chain():
+    rng = numpy.random.default_rng(7)
+    blocks = [rng.integers(0, 256, n, dtype=numpy.uint8).tobytes() for n in (3, 70000, 0, 12345, 1)]
+    adler = 1
+    for block in blocks:
+        adler = projectlib_pngenc.adler32_combine(adler, zlib.adler32(block), len(block))
+    assert adler == zlib.adler32(b''.join(blocks))
+
+
+def image(shape, seed=11):
+    """ A smooth image with noise, so all the filters have work to do """
+    rng = numpy.random.default_rng(seed)
+    ny, nx = shape[:2]
+    yy, xx = numpy.mgrid[0:ny, 0:nx]
+    base = (xx*3 + yy*5) % 256
+    if len(shape) == 3:
+        base = base[:, :, numpy.newaxis] + numpy.arange(shape[2])*40
+    return ((base + rng.integers(0, 8, shape)) % 256).astype(numpy.uint8)
+
+
+@pytest.mark.parametrize("png_filter", ['none', 'sub', 'up', 'average', 'paeth', 'adaptive'])
+@pytest.mark.parametrize("nchannels", [1, 2, 3, 4])
+def test_roundtrip(tmp_path, png_filter, nchannels):
+    shape = (83, 61) if nchannels == 1 else (83, 61, nchannels)
+    array8 = image(shape)
+    pngfile = str(tmp_path / 'out.png')
+    # Stripes that do not divide the image, on several threads
+    stats = projectlib_pngenc.write_png(pngfile, array8, png_filter=png_filter, nthreads=3,
+                                        stripe_rows=16, verb=False)
+    assert stats['nstripes'] == 6
+    with Image.open(pngfile) as im:
+        im.load()
+        assert numpy.array_equal(numpy.asarray(im), array8)
+
+
+@pytest.mark.parametrize("level", [0, 1, 6, 9])
+def test_roundtrip_levels_single_thread(tmp_path, level):
+    array8 = image((40, 50, 3))
+    pngfile = str(tmp_path / 'out.png')
+    projectlib_pngenc.write_png(pngfile, array8, level=level, nthreads=1, stripe_rows=7, verb=False)
+    with Image.open(pngfile) as im:
+        assert numpy.array_equal(numpy.asarray(im), array8)
+
+
+def test_zlib_stream_and_text(tmp_path):
+    array8 = image((50, 20))
+    pngfile = str(tmp_path / 'out.png')
+    projectlib_pngenc.write_png(pngfile, array8, png_filter='paeth', nthreads=2, stripe_rows=8,
+                                text={'CRVAL1': 10.5, 'CTYPE1': 'RA---TAN'}, verb=False)
+    idat = b''
+    with open(pngfile, 'rb') as fobj:
+        for _, ctype, length in projectlib_pngmeta.iter_chunks(fobj):
+            if ctype == b'IDAT':
+                idat += fobj.read(length)
+    # The IDAT chunks make one zlib stream, its adler32 checked by zlib
+    raw = zlib.decompress(idat)
+    assert len(raw) == 50*(20 + 1)
+    assert projectlib_pngmeta.read_text(pngfile) == {'CRVAL1': '10.5', 'CTYPE1': 'RA---TAN'}
+
+
+def test_unknown_filter(tmp_path):
+    with pytest.raises(ValueError):
+        projectlib_pngenc.write_png(str(tmp_path / 'out.png'), image((4, 4)), png_filter='bogus')
+
+
+def reference_filter(raw, up, bpp, ftype):
+    """ The PNG filters byte by byte, as written in the specification """
+    out = numpy.zeros_like(raw)
+    for r in range(raw.shape[0]):
+        prior = up if r == 0 else raw[r - 1]
+        for i in range(raw.shape[1]):
+            a = int(raw[r, i - bpp]) if i >= bpp else 0
+            b = int(prior[i])
+            c = int(prior[i - bpp]) if i >= bpp else 0
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            paeth = a if pa <= pb and pa <= pc else (b if pb <= pc else c)
+            pred = [0, a, b, (a + b)//2, paeth][ftype]
+            out[r, i] = (int(raw[r, i]) - pred) % 256
+    return out
+
+
+@pytest.mark.parametrize("bpp", [1, 3])
+@pytest.mark.parametrize("ftype", [0, 1, 2, 3, 4])
+def test_filter_rows_match_the_spec(ftype, bpp):
+    rng = numpy.random.default_rng(ftype + 10*bpp)
+    raw = rng.integers(0, 256, (5, 4*bpp), dtype=numpy.uint8)
+    # The row above the stripe, from the previous stripe
+    up = rng.integers(0, 256, 4*bpp, dtype=numpy.uint8)
+    assert numpy.array_equal(projectlib_pngenc.filter_rows(raw, up, bpp, ftype),
+                             reference_filter(raw, up, bpp, ftype))
+
+
+def test_adaptive_picks_the_cheapest_filter():
+    array8 = image((30, 40, 3))
+    raw = array8.reshape(30, -1)
+    up = numpy.zeros(raw.shape[1], dtype=numpy.uint8)
+    out = projectlib_pngenc.filter_stripe(raw, up, 3, png_filter='adaptive')
+    for r in range(30):
+        ftype = out[r, 0]
+        filtered = projectlib_pngenc.filter_rows(raw, up, 3, ftype)[r]
+        assert numpy.array_equal(out[r, 1:], filtered)
+        # Minimum sum of the absolute signed bytes, the first one on ties
+        costs = [numpy.abs(projectlib_pngenc.filter_rows(raw, up, 3, f)[r].view(numpy.int8).astype(int)).sum()
+                 for f in range(5)]
+        assert costs[ftype] == min(costs)
+        assert ftype == costs.index(min(costs))
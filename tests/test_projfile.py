@@ -0,0 +1,43 @@
+"""
+
+ The storage of the projected images of projectlib_projfile
+
+"""
+
+import os
+
+import numpy
+import pytest
+
+from projectDECam import projectlib_projfile
+
+
+@pytest.mark.parametrize("compress", ['rice', 'hcompress'])
+def test_lossless_needs_gzip(tmp_path, compress):
+    with pytest.raises(ValueError):
+        projectlib_projfile.check_compression(compress, 0)
+    filename = str(tmp_path / 'expo_proj.fits')
+    with pytest.raises(ValueError):
+        projectlib_projfile.write_image(filename, numpy.ones((64, 64), 'f4'), {}, compress=compress,
+                                        qlevel=0)
+    assert os.listdir(tmp_path) == []
+
+
+def test_write_failure_removes_tmp(tmp_path, monkeypatch):
+    # What cfitsio does with lossless rice floats, if we let it through
+    monkeypatch.setattr(projectlib_projfile, 'compression_kwargs',
+                        lambda *args: {'compress': 'rice', 'qlevel': None, 'qmethod': 'NO_DITHER'})
+    filename = str(tmp_path / 'expo_proj.fits')
+    with pytest.raises(OSError):
+        projectlib_projfile.write_image(filename, numpy.ones((64, 64), 'f4'), {}, compress='rice',
+                                        qlevel=0)
+    assert os.listdir(tmp_path) == []
+
+
+def test_lossless_gzip_roundtrip(tmp_path):
+    image = numpy.random.default_rng(1).normal(0.0, 1.0, (300, 200)).astype('f4')
+    filename = str(tmp_path / 'expo_proj.fits')
+    projectlib_projfile.write_image(filename, image, {'CRPIX1': 1.0}, compress='gzip_2', qlevel=0)
+    assert projectlib_projfile.is_compressed(filename)
+    assert numpy.array_equal(projectlib_projfile.read_image(filename), image)
+    assert projectlib_projfile.read_header(filename)['NAXIS1'] == 200
@@ -0,0 +1,40 @@
+"""
+
+ The thumbnail and Deep Zoom pyramid of projectlib_pyramid
+
+"""
+
+import os
+
+import numpy
+import pytest
+from PIL import Image
+
+from projectDECam import projectlib_pyramid
+
+
+def test_reduce2x_odd():
+    array = numpy.array([[0, 4, 8], [4, 8, 12], [8, 12, 255]], dtype=numpy.uint8)
+    # The last row/column is repeated for odd sizes
+    assert projectlib_pyramid.reduce2x(array).tolist() == [[4, 10], [10, 255]]
+
+
+@pytest.mark.parametrize("shape", [(1001, 777), (300, 500, 3), (90, 60)])
+def test_pyramid_one_chain(tmp_path, shape, monkeypatch):
+    rng = numpy.random.default_rng(2)
+    array = rng.integers(0, 256, shape, dtype=numpy.uint8)
+    calls = []
+    reduce2x = projectlib_pyramid.reduce2x
+    monkeypatch.setattr(projectlib_pyramid, 'reduce2x', lambda a: calls.append(a.shape) or reduce2x(a))
+    basename = str(tmp_path / 'expo')
+    projectlib_pyramid.build_pyramid(array, basename, TNsize=200, zoom=True, tilesize=128)
+
+    maxlevel = int(numpy.ceil(numpy.log2(max(shape[:2]))))
+    # One 2x reduction per DZI level, none more for the thumbnail
+    assert len(calls) == maxlevel
+    assert sorted(os.listdir(f"{basename}_files"), key=int) == [str(k) for k in range(maxlevel + 1)]
+    with Image.open(f"{basename}_TN.png") as im:
+        thumb = numpy.asarray(im)
+    # The same thumbnail as from the full-size array
+    monkeypatch.setattr(projectlib_pyramid, 'reduce2x', reduce2x)
+    assert numpy.array_equal(thumb, projectlib_pyramid.thumbnail(array, 200))
@@ -0,0 +1,121 @@
+"""
+
+ The error bounds of the streaming quantile sketch of projectlib_quantile
+
+"""
+
+import fitsio
+import numpy
+import pytest
+
+from projectDECam import projectlib_quantile
+
+QUANTILES = [0.001, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.98, 0.995, 0.999]
+
+
+def exact(values, q):
+    """ The order statistic the sketch estimates, at rank q*(n-1) """
+    values = numpy.sort(values)
+    return values[int(q*(values.size - 1))]
+
+
+def check_bounds(sketch, values, rel_err):
+    for q in QUANTILES:
+        x = exact(values, q)
+        assert abs(sketch.quantile(q) - x) <= rel_err*abs(x) + 1e-12, q
+
+
+@pytest.mark.parametrize("rel_err", [0.001, 0.005, 0.02])
+def test_relative_error(rel_err):
+    rng = numpy.random.default_rng(1)
+    # Sky-like noise with negatives plus a long tail of sources
+    values = numpy.concatenate([rng.normal(5.0, 10.0, 200000),
+                                rng.lognormal(5.0, 2.0, 20000)])
+    sketch = projectlib_quantile.QuantileSketch(rel_err=rel_err).update(values)
+    assert sketch.count == values.size
+    check_bounds(sketch, values, rel_err)
+    assert sketch.quantile(0) == values.min()
+    assert sketch.quantile(1) == values.max()
+
+
+def test_merge_is_exact():
+    rng = numpy.random.default_rng(2)
+    values = rng.lognormal(3.0, 1.5, 100000) - 20.0
+    whole = projectlib_quantile.QuantileSketch(rel_err=0.005).update(values)
+    merged = projectlib_quantile.QuantileSketch(rel_err=0.005)
+    # Chunks with different ranges grow the stores both ways
+    for chunk in numpy.array_split(numpy.sort(values)[::-1], 7):
+        merged.merge(projectlib_quantile.QuantileSketch(rel_err=0.005).update(chunk))
+    assert merged.quantile(QUANTILES) == whole.quantile(QUANTILES)
+    check_bounds(merged, values, 0.005)
+    with pytest.raises(ValueError):
+        merged.merge(projectlib_quantile.QuantileSketch(rel_err=0.01))
+
+
+def test_zeros_and_non_finite():
+    values = numpy.array([0.0]*50 + [numpy.nan, numpy.inf] + list(range(1, 51)), dtype='f8')
+    sketch = projectlib_quantile.QuantileSketch(rel_err=0.01).update(values)
+    assert sketch.count == 100
+    assert sketch.zeros == 50
+    assert sketch.quantile(0.25) == 0.0
+    assert sketch.quantile(0.75) == pytest.approx(25.0, rel=0.01)
+    assert numpy.isnan(projectlib_quantile.QuantileSketch().quantile(0.5))
+
+
+def test_sketch_file_strips(tmp_path):
+    rng = numpy.random.default_rng(4)
+    data = rng.normal(1000.0, 30.0, (523, 301)).astype('f4')
+    data[:10] = 0.0
+    data[100, :5] = 50000.0
+    filename = str(tmp_path / 'image.fits')
+    fitsio.write(filename, data)
+    sketch = projectlib_quantile.sketch_file(filename, rel_err=0.002, nrows=64, satur_level=40000.0)
+    # Blank (zero) and saturated pixels are not counted
+    good = data[(data != 0) & (data < 40000.0)]
+    assert sketch.count == good.size
+    check_bounds(sketch, good, 0.002)
+    # Same pixels read in strips or from memory
+    in_memory = projectlib_quantile.sketch_array(data, rel_err=0.002, satur_level=40000.0)
+    assert in_memory.quantile(QUANTILES) == sketch.quantile(QUANTILES)
+
+
+def test_subsample_keeps_the_grid():
+    data = numpy.arange(100*90, dtype='f4').reshape(100, 90) + 1
+    strips = projectlib_quantile.iter_array_strips(data, nrows=7, subsample=3)
+    rows = numpy.concatenate([strip for _, strip in strips])
+    # Every 3rd row and column of the image, whatever the strip size
+    assert numpy.array_equal(rows, data[::3, ::3])
+
+
+@pytest.mark.parametrize("compress", [None, 'rice'])
+def test_subsample_file_reads_the_grid(tmp_path, compress):
+    # Integers, so rice is lossless
+    data = numpy.arange(100*90, dtype='i4').reshape(100, 90) + 1
+    filename = str(tmp_path / 'image.fits')
+    with fitsio.FITS(filename, 'rw', clobber=True) as fits:
+        fits.write(None)
+        fits.write(data, compress=compress)
+    # Strips smaller than the step are skipped, not read
+    for nrows in (2, 7, 64):
+        strips = projectlib_quantile.iter_strips(filename, ext=1, nrows=nrows, subsample=3)
+        rows = numpy.concatenate([strip for _, strip in strips])
+        assert numpy.array_equal(rows, data[::3, ::3])
+
+
+def test_band_quantiles(tmp_path):
+    rng = numpy.random.default_rng(5)
+    files, data = {}, {}
+    for k, band in enumerate('gri'):
+        data[band] = rng.normal(100.0*(k + 1), 10.0*(k + 1), (211, 157)).astype('f4')
+        data[band][:, :7] = 0.0
+        files[band] = str(tmp_path / f"tile_{band}.fits")
+        fitsio.write(files[band], data[band])
+    quantiles = [0.5, 0.9, 0.999]
+    levels = projectlib_quantile.band_quantiles(files, quantiles, rel_err=0.002)
+    assert list(levels) == ['g', 'r', 'i']
+    for band in 'gri':
+        assert list(levels[band]) == quantiles
+        # Each band on its own pixels, without the zeros
+        good = data[band][data[band] != 0]
+        for q in quantiles:
+            assert abs(levels[band][q] - exact(good, q)) <= 0.002*abs(exact(good, q)), (band, q)
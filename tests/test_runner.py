@@ -0,0 +1,56 @@
+"""
+
+ The external commands of projectlib_runner and their telemetry
+
+"""
+
+import io
+import sys
+import subprocess
+
+import pytest
+
+from projectDECam import projectlib_runner
+from projectDECam import projectlib_telemetry
+
+# A command that allocates 256MB, so its peak RSS stands out. The peak
+# RSS of any command is at least the RSS of the process that spawns it
+ALLOC = [sys.executable, '-c', "x = bytearray(256*1024*1024); x[::4096] = b'x'*len(x[::4096])"]
+MB256 = 256*1024
+
+
+def test_run_logs_and_exit_codes():
+    stream = io.StringIO()
+    runner = projectlib_runner.Runner(stream=stream)
+    assert runner.run_sync([sys.executable, '-c', "print('hello'); print('world')"], prefix='py') == 0
+    log = stream.getvalue().splitlines()
+    assert '[py] hello' in log and '[py] world' in log
+    with pytest.raises(subprocess.CalledProcessError):
+        runner.run_sync([sys.executable, '-c', "import sys; sys.exit(3)"])
+    assert runner.run_sync([sys.executable, '-c', "import sys; sys.exit(3)"], check=False) == 3
+
+
+def test_timeout():
+    runner = projectlib_runner.Runner(stream=io.StringIO())
+    with pytest.raises(subprocess.TimeoutExpired):
+        runner.run_sync([sys.executable, '-c', "import time; time.sleep(30)"], timeout=0.5)
+
+
+def test_command_rusage_goes_to_the_stage(tmp_path):
+    telemetry = projectlib_telemetry.Telemetry(jsonfile=str(tmp_path / 't.jsonl'), verb=False)
+    runner = projectlib_runner.Runner(limits={'alloc': 2}, stream=io.StringIO())
+    with telemetry.stage('first'):
+        runner.run_all_sync([{'argv': ALLOC, 'tool': 'alloc'}]*3, telemetry=telemetry)
+    with telemetry.stage('second'):
+        runner.run_sync([sys.executable, '-c', "pass"], telemetry=telemetry)
+    # Not in a stage, nothing recorded
+    runner.run_sync(ALLOC, telemetry=telemetry)
+    first, second = telemetry.records
+    assert first['commands'] == 3
+    assert first['cmd_maxrss_kb'] > MB256
+    assert first['child_maxrss_kb'] >= first['cmd_maxrss_kb']
+    assert first['cmd_user'] + first['cmd_sys'] > 0
+    # The peak of the second stage is its own, not the one of the first
+    assert second['commands'] == 1
+    assert second['cmd_maxrss_kb'] < first['cmd_maxrss_kb'] - MB256//2
+    assert second['child_maxrss_kb'] < first['child_maxrss_kb'] - MB256//2
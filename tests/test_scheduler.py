@@ -0,0 +1,89 @@
+"""
+
+ The resumable pipelined scheduler of projectlib_scheduler
+
+"""
+
+import os
+import sys
+import json
+
+from projectDECam import projectlib_scheduler
+from projectDECam import projectlib_telemetry
+
+Task = projectlib_scheduler.Task
+
+
+class Tile:
+
+    """ A group whose first task only sets state in memory, like color_tile's levels """
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.levels = {}
+        self.calls = []
+
+    def compute_levels(self):
+        self.calls.append('levels')
+        self.levels['g'] = 1.5
+
+    def write(self):
+        self.calls.append('write')
+        with open(self.outfile, 'w') as fobj:
+            fobj.write(str(self.levels['g']))
+
+    def tasks(self):
+        return [Task('t:levels', func=self.compute_levels, inline=True),
+                Task('t:write', deps=['t:levels'], func=self.write, inline=True,
+                     outputs=[self.outfile])]
+
+
+def test_resume_reruns_tasks_without_outputs(tmp_path):
+    outfile = str(tmp_path / 'out.txt')
+    progress = projectlib_scheduler.Progress(str(tmp_path / 'progress.sqlite'))
+    # A previous run did the levels and crashed before writing
+    progress.record_task('t:levels', 'ok', 0.0, 1.0)
+    tile = Tile(outfile)
+    scheduler = projectlib_scheduler.Scheduler(nworkers=1, progress=progress)
+    assert scheduler.run_sync([('t', tile.tasks())]) == []
+    assert tile.calls == ['levels', 'write']
+    with open(outfile) as fobj:
+        assert fobj.read() == '1.5'
+    assert progress.group_done('t')
+
+    # Tasks with outputs that are done are skipped, the rest run again
+    progress.reset_group('t', [])
+    tile = Tile(outfile)
+    assert scheduler.run_sync([('t', tile.tasks())]) == []
+    assert tile.calls == ['levels']
+    os.remove(outfile)
+    progress.reset_group('t', [])
+    tile = Tile(outfile)
+    assert scheduler.run_sync([('t', tile.tasks())]) == []
+    assert tile.calls == ['levels', 'write']
+    progress.close()
+
+
+def test_task_records(tmp_path):
+    jsonfile = str(tmp_path / 'telemetry.jsonl')
+    telemetry = projectlib_telemetry.Telemetry(jsonfile=jsonfile, promfile=str(tmp_path / 'ct.prom'))
+    groups = []
+    for name in ('tileA', 'tileB'):
+        groups.append((name, [Task(f"{name}:cmd:g", argv=[sys.executable, '-c', 'pass'], tool='python'),
+                              Task(f"{name}:fail", argv=[sys.executable, '-c', 'import sys; sys.exit(2)']),
+                              Task(f"{name}:clean", deps=[f"{name}:cmd:g"], func=len, args=([],),
+                                   inline=True)]))
+    scheduler = projectlib_scheduler.Scheduler(nworkers=1, telemetry=telemetry)
+    assert sorted(scheduler.run_sync(groups)) == ['tileA', 'tileB']
+    telemetry.close()
+
+    with open(jsonfile) as fobj:
+        records = {(r['job'], r['stage']): r for r in map(json.loads, fobj)}
+    assert sorted(records) == [(name, stage) for name in ('tileA', 'tileB')
+                               for stage in ('clean', 'cmd:g', 'fail')]
+    assert records['tileA', 'cmd:g']['commands'] == 1
+    assert records['tileA', 'cmd:g']['status'] == 'ok'
+    assert records['tileB', 'fail']['status'] == 'failed'
+    assert records['tileB', 'clean']['commands'] == 0
+    with open(tmp_path / 'ct.prom') as fobj:
+        assert 'projectdecam_stage_commands{job="tileB",stage="cmd:g"} 1' in fobj.read().splitlines()
@@ -0,0 +1,103 @@
+"""
+
+ The stiff-like levels and stretch of projectlib_stretch
+
+"""
+
+import math
+
+import fitsio
+import numpy
+import pytest
+from PIL import Image
+
+from projectDECam import projectlib_stretch
+from projectDECam import projectlib_pngmeta
+
+
+def grey(value, vmin, vmax, gamma):
+    """ The display grey level (0-1) of a value, the POWER-LAW of stiff """
+    return ((value - vmin)/(vmax - vmin))**(1.0/gamma)
+
+
+@pytest.mark.parametrize("sky, vmax, min_level, gamma", [
+    (100.0, 1100.0, 0.005, 2.2),
+    (0.0, 35.0, 0.005, 2.2),
+    (-3.5, 12.0, 0.05, 1.0),
+    (2500.0, 2600.0, 0.1, 3.0),
+])
+def test_min_from_greylevel_puts_sky_at_min_level(sky, vmax, min_level, gamma):
+    # MIN_TYPE GREYLEVEL: the min is such that the sky is displayed at
+    # the grey level MIN_LEVEL after the gamma
+    vmin = projectlib_stretch.min_from_greylevel(sky, vmax, min_level, gamma)
+    assert vmin < sky < vmax
+    assert grey(sky, vmin, vmax, gamma) == pytest.approx(min_level, rel=1e-9)
+
+
+def test_min_from_greylevel_values():
+    # Linear gamma: (sky - min_level*max)/(1 - min_level)
+    assert projectlib_stretch.min_from_greylevel(100.0, 1100.0, 0.005, 1.0) == \
+        pytest.approx((100.0 - 5.5)/0.995)
+    # The stiff defaults of projectDECam, g = 0.005**2.2
+    g = math.exp(2.2*math.log(0.005))
+    assert projectlib_stretch.min_from_greylevel(100.0, 1100.0) == \
+        pytest.approx((100.0 - g*1100.0)/(1.0 - g))
+    assert projectlib_stretch.min_from_greylevel(100.0, 1100.0) == pytest.approx(99.991336, abs=1e-5)
+
+
+def test_stretch_sky_and_max():
+    vmin = projectlib_stretch.min_from_greylevel(100.0, 1100.0)
+    data = numpy.array([[100.0, 1100.0, 5000.0, 50000.0, -50.0, numpy.nan]], dtype='f4')
+    out = projectlib_stretch.stretch(data, vmin, 1100.0, flip=False)
+    # sky at 0.005*255 (+0.5, truncated), max and above white, saturated
+    # pixels white, below min and NaN black
+    assert out.tolist() == [[1, 255, 255, 255, 0, 0]]
+
+
+def test_stretch_flip_and_strips():
+    rng = numpy.random.default_rng(3)
+    data = rng.normal(100.0, 10.0, (37, 11)).astype('f4')
+    ref = projectlib_stretch.stretch(data, 80.0, 140.0, flip=False, nrows=1000)
+    assert numpy.array_equal(projectlib_stretch.stretch(data, 80.0, 140.0, flip=False, nrows=5), ref)
+    assert numpy.array_equal(projectlib_stretch.stretch(data, 80.0, 140.0, flip=True, nrows=5), ref[::-1])
+
+
+def test_stiff_levels():
+    rng = numpy.random.default_rng(5)
+    data = rng.normal(1000.0, 20.0, (300, 300)).astype('f4')
+    # Blank pixels (zeros) and saturated ones are not in the levels
+    data[:20] = 0.0
+    data[-5:] = 60000.0
+    sky, vmin, vmax = projectlib_stretch.stiff_levels(data, max_level=0.98)
+    good = data[20:-5]
+    rel_err = projectlib_stretch.REL_ERR
+    assert sky == pytest.approx(numpy.median(good), rel=2*rel_err)
+    assert vmax == pytest.approx(numpy.quantile(good, 0.98), rel=2*rel_err)
+    assert vmin == pytest.approx(projectlib_stretch.min_from_greylevel(sky, vmax))
+
+
+def test_stiff_levels_empty():
+    assert projectlib_stretch.stiff_levels(numpy.zeros((10, 10), dtype='f4')) == (0.0, 0.0, 1.0)
+
+
+def test_stretch_png(tmp_path):
+    rng = numpy.random.default_rng(8)
+    data = rng.normal(100.0, 10.0, (1500, 40)).astype('f4')
+    data[700:710, 10:20] += 3000.0
+    header = [{'name': 'CTYPE1', 'value': 'RA---TAN'}, {'name': 'CTYPE2', 'value': 'DEC--TAN'},
+              {'name': 'CRVAL1', 'value': 10.5}, {'name': 'CRVAL2', 'value': -30.0},
+              {'name': 'CRPIX1', 'value': 20.5}, {'name': 'CRPIX2', 'value': 750.5},
+              {'name': 'CD1_1', 'value': -7.3e-5}, {'name': 'CD1_2', 'value': 0.0},
+              {'name': 'CD2_1', 'value': 0.0}, {'name': 'CD2_2', 'value': 7.3e-5}]
+    filename = str(tmp_path / 'image.fits')
+    fitsio.write(filename, data, header=header)
+    pngfile = str(tmp_path / 'image.png')
+    projectlib_stretch.stretch_png(filename, pngfile)
+    # Read in strips, the same pixels as the image stretched in memory
+    with Image.open(pngfile) as im:
+        assert numpy.array_equal(numpy.asarray(im), projectlib_stretch.stretch_image(data))
+    # With the WCS of the image
+    text = projectlib_pngmeta.read_text(pngfile)
+    assert set(text) == set(projectlib_pngmeta.WCSKEYS) | {'Copyright'}
+    assert float(text['CRVAL1']) == 10.5
+    assert float(text['CRPIX2']) == 750.5
@@ -0,0 +1,143 @@
+"""
+
+ The local tile index of projectlib_tileindex, synced from a stand-in
+ database, and color_tile resolving its tiles from it
+
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+import fitsio
+import numpy
+import pytest
+
+from projectDECam import projectlib_tileindex
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TAG = 'Y1A1_COADD'
+
+
+def relpath(tilename, band):
+    return f"OPS/coadd/{tilename}/coadd/{tilename}_{band}.fits.fz"
+
+
+def test_sync_lookup_and_resync(tmp_path):
+    standin = str(tmp_path / 'desar.sqlite')
+    tiles = {'DES0001-3000': {band: relpath('DES0001-3000', band) for band in 'griz'},
+             'DES0002-3000': {band: relpath('DES0002-3000', band) for band in 'gri'}}
+    projectlib_tileindex.make_standin_db(standin, tiles, tag=TAG, archive_root='/archive')
+    dbh = projectlib_tileindex.get_dbh(standin=standin)
+    # The connection is shared
+    assert projectlib_tileindex.get_dbh(standin=standin) is dbh
+
+    index = projectlib_tileindex.TileIndex(str(tmp_path / 'index' / 'tiles.sqlite'))
+    assert not index.has_tag(TAG)
+    assert index.lookup(TAG, 'DES0001-3000') is None
+    assert index.sync(dbh, TAG) == 2
+    assert index.has_tag(TAG)
+    assert index.tilenames(TAG) == ['DES0001-3000', 'DES0002-3000']
+    run, paths = index.lookup(TAG, 'DES0001-3000')
+    assert run.endswith('_DES0001-3000')
+    assert paths == {band: os.path.join('/archive', relpath('DES0001-3000', band)) for band in 'griz'}
+    assert index.tilenames('SVA1_COADD') == []
+
+    # Re-sync after a tile is dropped, a band removed and a path moved
+    tiles = {'DES0001-3000': {'g': 'moved/DES0001-3000_g.fits.fz',
+                              'r': relpath('DES0001-3000', 'r')}}
+    projectlib_tileindex.make_standin_db(standin, tiles, tag=TAG, archive_root='/archive')
+    assert index.sync(dbh, TAG) == 1
+    assert index.tilenames(TAG) == ['DES0001-3000']
+    assert index.lookup(TAG, 'DES0002-3000') is None
+    run, paths = index.lookup(TAG, 'DES0001-3000')
+    assert paths == {'g': '/archive/moved/DES0001-3000_g.fits.fz',
+                     'r': os.path.join('/archive', relpath('DES0001-3000', 'r'))}
+    index.close()
+
+
+def write_fz(filename, image, ra):
+    """ An fpacked coadd: empty primary and the image tile-compressed in HDU 1 """
+    header = [{'name': 'CTYPE1', 'value': 'RA---TAN'}, {'name': 'CTYPE2', 'value': 'DEC--TAN'},
+              {'name': 'CRVAL1', 'value': ra}, {'name': 'CRVAL2', 'value': -30.0},
+              {'name': 'CRPIX1', 'value': 64.5}, {'name': 'CRPIX2', 'value': 64.5},
+              {'name': 'CD1_1', 'value': -7.3e-5}, {'name': 'CD1_2', 'value': 0.0},
+              {'name': 'CD2_1', 'value': 0.0}, {'name': 'CD2_2', 'value': 7.3e-5}]
+    with fitsio.FITS(filename, 'rw', clobber=True) as fits:
+        fits.write(None)
+        fits.write(image, header=header, compress='rice')
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """ Two small fpacked tiles in an archive tree and their stand-in database """
+    root = tmp_path / 'archive'
+    rng = numpy.random.default_rng(3)
+    tiles = {}
+    for k, tilename in enumerate(['DES0001-3000', 'DES0002-3000']):
+        tiles[tilename] = {}
+        for band in 'gri':
+            path = relpath(tilename, band)
+            os.makedirs(os.path.dirname(root / path), exist_ok=True)
+            image = rng.normal(0.0, 1.0, (128, 128)).astype(numpy.float32)
+            image[60:68, 60:68] += 100.0
+            write_fz(str(root / path), image, ra=0.1*(k + 1))
+            tiles[tilename][band] = path
+    standin = str(tmp_path / 'desar.sqlite')
+    projectlib_tileindex.make_standin_db(standin, tiles, tag=TAG, archive_root=str(root))
+    return standin, tiles
+
+
+def color_tile(tmp_path, *args):
+    env = dict(os.environ, PYTHONPATH=os.path.join(REPO, 'python'))
+    argv = [sys.executable, os.path.join(REPO, 'bin', 'color_tile'),
+            '--stretch', 'numpy', '--noMP', '--TNsize', '32',
+            '--tileindex', str(tmp_path / 'tiles.sqlite'),
+            '--outdir', str(tmp_path / 'out'),
+            '--scratchdir', str(tmp_path / 'scratch')] + list(args)
+    return subprocess.run(argv, env=env, capture_output=True, text=True)
+
+
+def test_color_tile_tilelist(tmp_path, archive):
+    standin, tiles = archive
+    tilelist = tmp_path / 'tiles.list'
+    tilelist.write_text("# tiles\nDES0001-3000\nDES0002-3000\n")
+    jsonfile = tmp_path / 'telemetry.jsonl'
+    proc = color_tile(tmp_path, '--standin_db', standin, '--refresh', '--tilelist', str(tilelist),
+                      '--telemetry', str(jsonfile), '--prometheus', str(tmp_path / 'ct.prom'), TAG)
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+    for tilename in tiles:
+        for name in ['g', 'r', 'i', 'RGB']:
+            assert os.path.exists(tmp_path / 'out' / tilename / f"{tilename}_{name}.png")
+            assert os.path.exists(tmp_path / 'out' / tilename / f"{tilename}_{name}_TN.png")
+    # One record per task, with the tile as job
+    records = [json.loads(line) for line in jsonfile.read_text().splitlines()]
+    stages = {(r['job'], r['stage']) for r in records}
+    for tilename in tiles:
+        assert {(tilename, 'compose'), (tilename, 'TN:RGB'), (tilename, 'clean')} <= stages
+    assert 'color_tile_stage_wall_seconds{job="DES0001-3000",stage="compose"}' in \
+        (tmp_path / 'ct.prom').read_text()
+
+    # A tile that is gone from the database after a refresh is an error
+    del tiles['DES0002-3000']
+    projectlib_tileindex.make_standin_db(standin, tiles, tag=TAG,
+                                         archive_root=str(tmp_path / 'archive'))
+    proc = color_tile(tmp_path, '--standin_db', standin, '--refresh', '--force',
+                      '--tilelist', str(tilelist), TAG)
+    assert proc.returncode != 0
+    assert 'DES0002-3000 not in' in proc.stdout
+    assert '1 tiles failed: DES0002-3000' in proc.stderr
+
+
+def test_color_tile_one_tile(tmp_path, archive):
+    standin, _ = archive
+    # Without --refresh the tag is synced the first time only
+    proc = color_tile(tmp_path, '--standin_db', standin, 'DES0002-3000', TAG)
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+    assert 'Syncing tile index' in proc.stdout
+    assert os.path.exists(tmp_path / 'out' / 'DES0002-3000' / 'DES0002-3000_RGB_TN.png')
+    proc = color_tile(tmp_path, '--standin_db', standin, 'DES0001-3000', TAG)
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+    assert 'Syncing tile index' not in proc.stdout
+    assert os.path.exists(tmp_path / 'out' / 'DES0001-3000' / 'DES0001-3000_i.png')